@@ -0,0 +1,135 @@
+import time
+
+from rest_framework import serializers
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Prefetch
+
+from temba.api.v2.serializers import ContactReadSerializer, FlowRunReadSerializer, MsgReadSerializer
+from temba.channels.models import Channel
+from temba.contacts.models import Contact, ContactField, ContactGroup, ContactURN
+from temba.flows.models import Flow, FlowRun, FlowStart
+from temba.msgs.models import Label, Msg
+from temba.orgs.models import Org
+from temba.utils import json
+
+
+class Command(BaseCommand):  # pragma: no cover
+    help = "Benchmarks the per-row cost of the compact API read serializers against their declared field serializers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--org", type=int, action="store", dest="org_id", required=True, help="ID of org to use")
+        parser.add_argument("--rows", type=int, action="store", dest="num_rows", default=1000)
+        parser.add_argument("--repeat", type=int, action="store", dest="repeat", default=5)
+        parser.add_argument(
+            "--endpoints",
+            type=str,
+            action="store",
+            dest="endpoints",
+            default="contacts,runs,messages",
+            help="Comma separated endpoints to benchmark.",
+        )
+
+    def handle(self, org_id, num_rows, repeat, endpoints, *args, **options):
+        org = Org.objects.filter(id=org_id, is_active=True).first()
+        if not org:
+            raise CommandError(f"No active org with id {org_id}")
+
+        benchmarks = {"contacts": self.bench_contacts, "runs": self.bench_runs, "messages": self.bench_messages}
+        names = endpoints.split(",")
+        for name in names:
+            if name not in benchmarks:
+                raise CommandError(f"Unknown endpoint '{name}', must be one of {', '.join(benchmarks.keys())}")
+
+        context = {"org": org, "user": org.administrators.first()}
+
+        for name in names:
+            serializer, rows = benchmarks[name](org, num_rows, context)
+            if not rows:
+                self.stdout.write(f" > {name}: no rows to serialize")
+                continue
+
+            self.stdout.write(self.format_result(name, len(rows), *self.run_benchmark(serializer, rows, repeat)))
+
+    def bench_contacts(self, org, num_rows, context):
+        rows = list(
+            Contact.objects.filter(org=org, is_active=True)
+            .order_by("-modified_on", "-id")
+            .prefetch_related(
+                Prefetch(
+                    "all_groups",
+                    queryset=ContactGroup.user_groups.only("uuid", "name").order_by("pk"),
+                    to_attr="prefetched_user_groups",
+                )
+            )[:num_rows]
+        )
+        Contact.bulk_cache_initialize(org, rows)
+
+        context = dict(context, contact_fields=ContactField.user_fields.active_for_org(org=org))
+        return ContactReadSerializer(context=context), rows
+
+    def bench_runs(self, org, num_rows, context):
+        rows = list(
+            FlowRun.objects.filter(org=org)
+            .order_by("-modified_on", "-id")
+            .prefetch_related(
+                Prefetch("flow", queryset=Flow.objects.only("uuid", "name", "base_language")),
+                Prefetch("contact", queryset=Contact.objects.only("uuid", "name", "language")),
+                Prefetch("start", queryset=FlowStart.objects.only("uuid")),
+            )[:num_rows]
+        )
+        return FlowRunReadSerializer(context=context), rows
+
+    def bench_messages(self, org, num_rows, context):
+        rows = list(
+            Msg.objects.filter(org=org)
+            .exclude(visibility=Msg.VISIBILITY_DELETED)
+            .order_by("-created_on", "-id")
+            .prefetch_related(
+                Prefetch("contact", queryset=Contact.objects.only("uuid", "name")),
+                Prefetch("contact_urn", queryset=ContactURN.objects.only("scheme", "path", "display")),
+                Prefetch("channel", queryset=Channel.objects.only("uuid", "name")),
+                Prefetch("labels", queryset=Label.label_objects.only("uuid", "name").order_by("pk")),
+            )[:num_rows]
+        )
+        return MsgReadSerializer(context=context), rows
+
+    def run_benchmark(self, serializer, rows, repeat):
+        """
+        Serializes the rows with both paths, returning the best time of each and the number of rows which differ
+        """
+
+        def declared(obj):
+            return serializers.ModelSerializer.to_representation(serializer, obj)
+
+        def time_path(path):
+            best = None
+            for r in range(repeat):
+                start = time.perf_counter()
+                for obj in rows:
+                    path(obj)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            return best
+
+        mismatches = sum(
+            1 for obj in rows if json.dumps(declared(obj)) != json.dumps(serializer.to_representation(obj))
+        )
+
+        return time_path(declared), time_path(serializer.to_representation), mismatches
+
+    def format_result(self, name, num_rows, declared_time, compact_time, mismatches):
+        declared_per_row = 1_000_000 * declared_time / num_rows
+        compact_per_row = 1_000_000 * compact_time / num_rows
+
+        line = (
+            f" > {name} ({num_rows} rows): declared {declared_per_row:.1f}µs/row, "
+            f"compact {compact_per_row:.1f}µs/row ({declared_time / compact_time:.1f}x)"
+        )
+
+        if mismatches:
+            line += " " + self.style.ERROR(f"{mismatches} rows differ")
+        else:
+            line += " " + self.style.SUCCESS("identical")
+
+        return line
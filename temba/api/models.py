@@ -1,9 +1,11 @@
 import hmac
 import logging
+import pickle
 import uuid
 from datetime import timedelta
 from hashlib import sha1
 
+from django_redis import get_redis_connection
 from rest_framework.permissions import BasePermission
 from smartmin.models import SmartModel
 
@@ -11,6 +13,8 @@ from django.conf import settings
 from django.contrib.auth.models import Group, User
 from django.db import models
 from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
@@ -35,22 +39,23 @@ class APIPermission(BasePermission):
 
             org = request.user.get_org()
 
+            codename = view.permission.split(".")[-1]
+
             if request.auth:
                 role_group = request.auth.role
-                allowed_roles = APIToken.get_allowed_roles(org, request.user)
 
                 # check that user is still allowed to use the token's role
-                if role_group not in allowed_roles:
+                if not request.auth.is_role_allowed():
                     return False
+
+                has_perm = codename in request.auth.get_role_permissions()
             elif org:
                 # user may not have used token authentication
                 role_group = org.get_user_org_group(request.user)
+                has_perm = role_group.permissions.filter(codename=codename).exists()
             else:
                 return False
 
-            codename = view.permission.split(".")[-1]
-            has_perm = role_group.permissions.filter(codename=codename).exists()
-
             # viewers can only ever get from the API
             if role_group.name == "Viewers":
                 return has_perm and request.method == "GET"
@@ -222,6 +227,11 @@ class APIToken(models.Model):
 
     CODE_TO_ROLE = {"A": "Administrators", "E": "Editors", "S": "Surveyors"}
 
+    # active tokens are cached with their user, org and role for this many seconds
+    CACHE_KEY = "api_token:%s"
+    CACHE_TTL = 60
+    CACHE_STATS_KEY = "api_token_cache_stats"
+
     ROLE_GRANTED_TO = {
         "Administrators": ("Administrators",),
         "Editors": ("Administrators", "Editors"),
@@ -268,6 +278,60 @@ class APIToken(models.Model):
 
         return token
 
+    @classmethod
+    def lookup(cls, key):
+        """
+        Gets the active token with the given key for an active user, with its user, org and role loaded and its role
+        checks calculated.
+        Recently used tokens come from a short lived cache so most API requests don't need to hit the database. Looking
+        up a cached token and counting the lookup take a single round trip to Redis.
+        """
+        r = get_redis_connection()
+        cache_key = cls.CACHE_KEY % key
+
+        pipe = r.pipeline()
+        pipe.get(cache_key)
+        pipe.hincrby(cls.CACHE_STATS_KEY, "lookups", 1)
+        cached = pipe.execute()[0]
+
+        if cached is not None:
+            return pickle.loads(cached)
+
+        r.hincrby(cls.CACHE_STATS_KEY, "misses", 1)
+
+        token = cls.objects.filter(is_active=True, key=key).select_related("user", "org", "role").first()
+        if not token or not token.user.is_active:
+            return None
+
+        token.user.set_org(token.org)
+
+        # calculate role checks now so that they're cached too
+        token.is_role_allowed()
+        token.get_role_permissions()
+
+        r.set(cache_key, pickle.dumps(token), ex=cls.CACHE_TTL)
+        return token
+
+    @classmethod
+    def invalidate_cache(cls, keys):
+        """
+        Removes the tokens with the given keys from the cache
+        """
+        cache_keys = [cls.CACHE_KEY % key for key in keys]
+        if cache_keys:
+            get_redis_connection().delete(*cache_keys)
+
+    @classmethod
+    def get_cache_stats(cls):
+        """
+        Gets the number of cache hits and misses for token lookups, and the resulting hit ratio
+        """
+        stats = get_redis_connection().hgetall(cls.CACHE_STATS_KEY)
+        lookups, misses = int(stats.get(b"lookups", 0)), int(stats.get(b"misses", 0))
+        hits = lookups - misses
+
+        return {"hits": hits, "misses": misses, "ratio": hits / lookups if lookups else 0.0}
+
     @classmethod
     def get_orgs_for_role(cls, user, role):
         """
@@ -322,14 +386,74 @@ class APIToken(models.Model):
         unique = uuid.uuid4()
         return hmac.new(unique.bytes, digestmod=sha1).hexdigest()
 
+    def is_role_allowed(self):
+        """
+        Whether this token's user is still allowed to use its role
+        """
+        return get_cacheable_attr(
+            self, "_role_allowed", lambda: self.role in APIToken.get_allowed_roles(self.org, self.user)
+        )
+
+    def get_role_permissions(self):
+        """
+        Gets the codenames of the permissions granted to this token's role
+        """
+        return get_cacheable_attr(
+            self, "_role_permissions", lambda: set(self.role.permissions.values_list("codename", flat=True))
+        )
+
     def release(self):
         self.is_active = False
         self.save()
 
+        APIToken.invalidate_cache([self.key])
+
     def __str__(self):
         return self.key
 
 
+@receiver(post_save, sender=User)
+def invalidate_user_api_tokens(sender, instance, **kwargs):
+    """
+    Removes the cached API tokens of users who are deactivated
+    """
+    if not instance.is_active:
+        APIToken.invalidate_cache(APIToken.objects.filter(user=instance).values_list("key", flat=True))
+
+
+@receiver(post_save, sender=Org)
+def invalidate_org_api_tokens(sender, instance, created, **kwargs):
+    """
+    Removes the cached API tokens of orgs which are saved, so that requests never see a stale org, e.g. one which has
+    since been suspended
+    """
+    if not created:
+        APIToken.invalidate_cache(APIToken.objects.filter(org=instance).values_list("key", flat=True))
+
+
+def invalidate_org_user_api_tokens(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Removes the cached API tokens of users whose roles in an org change, as they may no longer be allowed
+    """
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if reverse:  # instance is a user and pk_set are org ids
+        tokens = APIToken.objects.filter(user=instance)
+        if pk_set:
+            tokens = tokens.filter(org_id__in=pk_set)
+    else:
+        tokens = APIToken.objects.filter(org=instance)
+        if pk_set:
+            tokens = tokens.filter(user_id__in=pk_set)
+
+    APIToken.invalidate_cache(tokens.values_list("key", flat=True))
+
+
+for org_users in (Org.administrators, Org.editors, Org.viewers, Org.surveyors):
+    m2m_changed.connect(invalidate_org_user_api_tokens, sender=org_users.through)
+
+
 def get_or_create_api_token(user):
     """
     Gets or creates an API token for this user. If user doen't have access to the API, this returns None.
@@ -27,18 +27,13 @@ class APITokenAuthentication(TokenAuthentication):
     model = APIToken
 
     def authenticate_credentials(self, key):
-        try:
-            token = self.model.objects.get(is_active=True, key=key)
-        except self.model.DoesNotExist:
-            raise exceptions.AuthenticationFailed("Invalid token")
-
-        if token.user.is_active:
-            # set the org on this user
-            token.user.set_org(token.org)
+        # lookup only returns tokens of active users, and sets the org on the token's user
+        token = self.model.lookup(key)
 
-            return token.user, token
+        if not token:
+            raise exceptions.AuthenticationFailed("Invalid token")
 
-        raise exceptions.AuthenticationFailed("Invalid token")
+        return token.user, token
 
 
 class APIBasicAuthentication(BasicAuthentication):
@@ -51,21 +46,13 @@ class APIBasicAuthentication(BasicAuthentication):
     """
 
     def authenticate_credentials(self, userid, password, request=None):
-        try:
-            token = APIToken.objects.get(is_active=True, key=password)
-        except APIToken.DoesNotExist:
-            raise exceptions.AuthenticationFailed("Invalid token or email")
+        # lookup only returns tokens of active users, and sets the org on the token's user
+        token = APIToken.lookup(password)
 
-        if token.user.username != userid:
+        if not token or token.user.username != userid:
             raise exceptions.AuthenticationFailed("Invalid token or email")
 
-        if token.user.is_active:
-            # set the org on this user
-            token.user.set_org(token.org)
-
-            return token.user, token
-
-        raise exceptions.AuthenticationFailed("Invalid token or email")
+        return token.user, token
 
 
 class OrgUserRateThrottle(ScopedRateThrottle):
@@ -78,6 +78,49 @@ class APITokenTest(TembaTest):
         # user from another org has no API roles
         self.assertIsNone(APIToken.get_default_role(self.org, self.admin2))
 
+    def test_lookup(self):
+        token = APIToken.get_or_create(self.org, self.admin, self.surveyors_group)
+
+        self.assertIsNone(APIToken.lookup("1234567890"))
+
+        # first lookup hits the database and caches the token with its role checks
+        looked_up = APIToken.lookup(token.key)
+        self.assertEqual(token, looked_up)
+        self.assertEqual(self.org, looked_up.user.get_org())
+        self.assertTrue(looked_up.is_role_allowed())
+        self.assertIn("contact_api", looked_up.get_role_permissions())
+
+        with self.assertNumQueries(0):
+            looked_up = APIToken.lookup(token.key)
+            self.assertEqual(token, looked_up)
+            self.assertTrue(looked_up.is_role_allowed())
+            self.assertIn("contact_api", looked_up.get_role_permissions())
+
+        self.assertEqual({"hits": 1, "misses": 2, "ratio": 1 / 3}, APIToken.get_cache_stats())
+
+        # saving the org invalidates the cache so that changes to it are seen immediately
+        self.org.set_suspended()
+        self.assertTrue(APIToken.lookup(token.key).user.get_org().is_suspended())
+        self.org.set_restored()
+
+        # as does changing the user's roles
+        self.org.administrators.remove(self.admin)
+        self.org.viewers.add(self.admin)
+        self.assertFalse(APIToken.lookup(token.key).is_role_allowed())
+
+        # or releasing the token
+        token.release()
+        self.assertIsNone(APIToken.lookup(token.key))
+
+        # or deactivating the user
+        token = APIToken.get_or_create(self.org2, self.admin2)
+        self.assertEqual(token, APIToken.lookup(token.key))
+
+        self.admin2.is_active = False
+        self.admin2.save()
+
+        self.assertIsNone(APIToken.lookup(token.key))
+
 
 class WebHookTest(TembaTest):
     def test_trim_events_and_results(self):
@@ -35,8 +35,28 @@ def format_datetime(value):
     return json.encode_datetime(value, micros=True) if value else None
 
 
+def serialize_datetime(value):
+    """
+    Formats a datetime exactly as a DateTimeField(default_timezone=pytz.UTC) would, for use by compact serializers
+    """
+    if not value:
+        return None
+
+    value = value.astimezone(pytz.UTC).isoformat()
+    return value[:-6] + "Z" if value.endswith("+00:00") else value
+
+
+def serialize_ref(obj):
+    """
+    Formats a reference to another object exactly as a TembaModelField would
+    """
+    return {"uuid": obj.uuid, "name": obj.name} if obj is not None else None
+
+
 def migrate_translations(translations):
-    return {lang: mailroom.get_client().expression_migrate(s) for lang, s in translations.items()}
+    langs = list(translations.keys())
+    migrated = mailroom.get_client().expressions_migrate([translations[lang] for lang in langs])
+    return dict(zip(langs, migrated))
 
 
 def normalize_extra(extra):
@@ -96,6 +116,30 @@ class ReadSerializer(serializers.ModelSerializer):
         raise ValueError("Can't call save on a read serializer")
 
 
+class CompactReadSerializer(ReadSerializer):
+    """
+    Read serializer with a compact fast path for the fields which subclasses can build directly. Output still follows
+    Meta.fields, and any field without a compact value is serialized by its declared field.
+    """
+
+    def get_compact_values(self, obj):
+        return {}
+
+    def to_representation(self, obj):
+        values = self.get_compact_values(obj)
+        output = OrderedDict()
+
+        for name in self.Meta.fields:
+            if name in values:
+                output[name] = values[name]
+            else:
+                field = self.fields[name]
+                attribute = field.get_attribute(obj)
+                output[name] = field.to_representation(attribute) if attribute is not None else None
+
+        return output
+
+
 class WriteSerializer(serializers.Serializer):
     """
     The normal REST framework way is to have the view decide if it's an update on existing instance or a create for a
@@ -497,7 +541,7 @@ class ClassifierReadSerializer(ReadSerializer):
         fields = ("uuid", "name", "type", "intents", "created_on")
 
 
-class ContactReadSerializer(ReadSerializer):
+class ContactReadSerializer(CompactReadSerializer):
     name = serializers.SerializerMethodField()
     language = serializers.SerializerMethodField()
     urns = serializers.SerializerMethodField()
@@ -542,6 +586,48 @@ class ContactReadSerializer(ReadSerializer):
     def get_stopped(self, obj):
         return obj.is_stopped if obj.is_active else None
 
+    def get_field_lookups(self):
+        """
+        Gets the key, UUID and value type of each contact field, computed once and shared by all contacts in a page
+        """
+        lookups = self.context.get("contact_field_lookups")
+        if lookups is None:
+            lookups = [(f.key, str(f.uuid), f.value_type) for f in self.context["contact_fields"]]
+            self.context["contact_field_lookups"] = lookups
+        return lookups
+
+    def get_compact_values(self, obj):
+        """
+        Builds the same values as the declared fields without per-field dispatch
+        """
+        if obj.is_active:
+            urns = [] if self.context["org"].is_anon else [str(urn) for urn in obj.get_urns()]
+            groups = obj.prefetched_user_groups if hasattr(obj, "prefetched_user_groups") else obj.user_groups.all()
+            values = obj.fields or {}
+            fields = {
+                key: Contact.serialize_field_json(value_type, values.get(uuid))
+                for key, uuid, value_type in self.get_field_lookups()
+            }
+            name, language, blocked, stopped = obj.name, obj.language, obj.is_blocked, obj.is_stopped
+        else:
+            urns, groups, fields = [], [], {}
+            name, language, blocked, stopped = None, None, None, None
+
+        return dict(
+            (
+                ("uuid", str(obj.uuid)),
+                ("name", name),
+                ("language", language),
+                ("urns", urns),
+                ("groups", [{"uuid": g.uuid, "name": g.name} for g in groups]),
+                ("fields", fields),
+                ("blocked", blocked),
+                ("stopped", stopped),
+                ("created_on", serialize_datetime(obj.created_on)),
+                ("modified_on", serialize_datetime(obj.modified_on)),
+            )
+        )
+
     class Meta:
         model = Contact
         fields = (
@@ -875,7 +961,7 @@ class FlowReadSerializer(ReadSerializer):
         )
 
 
-class FlowRunReadSerializer(ReadSerializer):
+class FlowRunReadSerializer(CompactReadSerializer):
     EXIT_TYPES = {
         FlowRun.EXIT_TYPE_COMPLETED: "completed",
         FlowRun.EXIT_TYPE_INTERRUPTED: "interrupted",
@@ -919,6 +1005,27 @@ class FlowRunReadSerializer(ReadSerializer):
     def get_exit_type(self, obj):
         return self.EXIT_TYPES.get(obj.exit_type)
 
+    def get_compact_values(self, obj):
+        """
+        Builds the same values as the declared fields without per-field dispatch
+        """
+        return dict(
+            (
+                ("id", obj.id),
+                ("uuid", str(obj.uuid)),
+                ("flow", serialize_ref(obj.flow)),
+                ("contact", serialize_ref(obj.contact)),
+                ("start", self.get_start(obj)),
+                ("responded", obj.responded),
+                ("path", self.get_path(obj)),
+                ("values", self.get_values(obj)),
+                ("created_on", serialize_datetime(obj.created_on)),
+                ("modified_on", serialize_datetime(obj.modified_on)),
+                ("exited_on", serialize_datetime(obj.exited_on)),
+                ("exit_type", self.EXIT_TYPES.get(obj.exit_type)),
+            )
+        )
+
     class Meta:
         model = FlowRun
         fields = (
@@ -1064,7 +1171,7 @@ class LabelWriteSerializer(WriteSerializer):
             return Label.get_or_create(self.context["org"], self.context["user"], name)
 
 
-class MsgReadSerializer(ReadSerializer):
+class MsgReadSerializer(CompactReadSerializer):
 
     broadcast = serializers.SerializerMethodField()
     contact = fields.ContactField()
@@ -1107,6 +1214,36 @@ class MsgReadSerializer(ReadSerializer):
     def get_visibility(self, obj):
         return Msg.VISIBILITIES.get(obj.visibility)
 
+    def get_compact_values(self, obj):
+        """
+        Builds the same values as the declared fields without per-field dispatch
+        """
+        urn = obj.contact_urn
+        if urn is not None:
+            urn = None if self.context["org"].is_anon else str(urn)
+
+        return dict(
+            (
+                ("id", obj.id),
+                ("broadcast", obj.broadcast_id),
+                ("contact", serialize_ref(obj.contact)),
+                ("urn", urn),
+                ("channel", serialize_ref(obj.channel)),
+                ("direction", Msg.DIRECTIONS.get(obj.direction)),
+                ("type", Msg.MSG_TYPES.get(obj.msg_type)),
+                ("status", self.get_status(obj)),
+                ("archived", obj.visibility == Msg.VISIBILITY_ARCHIVED),
+                ("visibility", Msg.VISIBILITIES.get(obj.visibility)),
+                ("text", obj.text),
+                ("labels", [serialize_ref(label) for label in obj.labels.all()]),
+                ("attachments", self.get_attachments(obj)),
+                ("created_on", serialize_datetime(obj.created_on)),
+                ("sent_on", serialize_datetime(obj.sent_on)),
+                ("modified_on", serialize_datetime(obj.modified_on)),
+                ("media", obj.attachments[0] if obj.attachments else None),
+            )
+        )
+
     class Meta:
         model = Msg
         fields = (
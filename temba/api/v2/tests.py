@@ -1,6 +1,6 @@
 import base64
 from collections import OrderedDict
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
 from unittest.mock import patch
 from urllib.parse import quote_plus
@@ -38,7 +38,13 @@ from temba.utils import json
 from temba.values.constants import Value
 
 from . import fields
-from .serializers import format_datetime, normalize_extra
+from .serializers import (
+    ContactReadSerializer,
+    FlowRunReadSerializer,
+    MsgReadSerializer,
+    format_datetime,
+    normalize_extra,
+)
 
 NUM_BASE_REQUEST_QUERIES = 7  # number of db queries required for any API request
 
@@ -274,6 +280,58 @@ class APITest(TembaTest):
             serializers.ValidationError, field.to_internal_value, {"eng": "HelloHello1"}
         )  # base lang not provided
 
+    def test_compact_serializers(self):
+        def assertSameAsDeclared(serializer, objs):
+            for obj in objs:
+                declared = serializers.ModelSerializer.to_representation(serializer, obj)
+                self.assertEqual(json.dumps(declared), json.dumps(serializer.to_representation(obj)))
+
+        self.create_field("age", "Age", value_type=Value.TYPE_NUMBER)
+        group = self.create_group("Customers", contacts=[self.joe])
+        self.joe.set_field(self.user, "age", "32")
+        self.joe.set_field(self.user, "gender", "Male", label="Gender")
+        self.frank.release(self.user)
+
+        contacts = list(Contact.objects.filter(org=self.org).order_by("id"))
+        contacts[0].created_on = contacts[0].created_on.replace(microsecond=0)  # DRF omits zero microseconds
+        Contact.bulk_cache_initialize(self.org, contacts)
+
+        context = {"org": self.org, "contact_fields": ContactField.user_fields.active_for_org(org=self.org)}
+        serializer = ContactReadSerializer(context=context)
+        assertSameAsDeclared(serializer, contacts)
+
+        joe = serializer.to_representation([c for c in contacts if c.id == self.joe.id][0])
+        self.assertEqual({"age": "32", "gender": "Male"}, joe["fields"])
+        self.assertEqual([{"uuid": group.uuid, "name": "Customers"}], joe["groups"])
+
+        label = self.create_label("Spam")
+        msg1 = self.create_incoming_msg(self.joe, "Hello", attachments=["image/jpeg:http://example.com/a.jpg"])
+        msg2 = self.create_outgoing_msg(self.joe, "Hi there", channel=self.channel)
+        label.toggle_label([msg1], add=True)
+
+        assertSameAsDeclared(MsgReadSerializer(context={"org": self.org}), [msg1, msg2])
+
+        with AnonymousOrg(self.org):
+            assertSameAsDeclared(MsgReadSerializer(context={"org": self.org}), [msg1, msg2])
+
+        flow = self.get_flow("color_v13")
+        color_prompt = flow.as_json()["nodes"][0]
+        start = FlowStart.create(flow, self.admin, contacts=[self.joe])
+        ann = self.create_contact("Ann", "0788000001")
+
+        run1 = MockSessionWriter(self.joe, flow, start=start).visit(color_prompt).wait().save().session.runs.get()
+        run2 = MockSessionWriter(ann, flow).visit(color_prompt).complete().save().session.runs.get()
+
+        assertSameAsDeclared(FlowRunReadSerializer(context={"org": self.org}), [run1, run2])
+
+        # declared fields without compact values are still serialized
+        serializer = MsgReadSerializer(context={"org": self.org})
+        declared = serializers.ModelSerializer.to_representation(serializer, msg1)
+
+        with patch.object(MsgReadSerializer, "get_compact_values", return_value={"id": 123}):
+            self.assertEqual(dict(declared, id=123), serializer.to_representation(msg1))
+            self.assertEqual(list(MsgReadSerializer.Meta.fields), list(serializer.to_representation(msg1).keys()))
+
     @override_settings(FLOW_START_PARAMS_SIZE=4)
     def test_normalize_extra(self):
         self.assertEqual(OrderedDict(), normalize_extra({}))
@@ -1920,6 +1978,67 @@ class APITest(TembaTest):
         response = self.deleteJSON(url, "uuid=%s" % hans.uuid)
         self.assert404(response)
 
+    def fetchStream(self, url, query=""):
+        response = self.client.get(url + ".json?stream=true" + query, HTTP_X_FORWARDED_HTTPS="https")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+
+        lines = [json.loads(line) for line in b"".join(response.streaming_content).decode("utf-8").splitlines()]
+        return lines[:-1], lines[-1]
+
+    @patch("temba.api.v2.views.ContactsEndpoint.stream_batch_size", 2)
+    def test_contacts_stream(self):
+        url = reverse("api.v2.contacts")
+        self.login(self.admin)
+
+        contact1 = self.create_contact("Ann", "0788000001")
+        contact2 = self.create_contact("Bob", "0788000002")
+        contact1.set_field(self.user, "nickname", "Annie", label="Nick name")
+
+        group = ContactGroup.get_or_create(self.org, self.admin, "Customers")
+        group.update_contacts(self.user, [self.joe], add=True)
+
+        for contact in (contact1, contact2, self.joe):
+            contact.refresh_from_db()
+
+        self.create_contact("Hans", "0788000004", org=self.org2)
+
+        # contacts are streamed oldest modified first, with groups, fields and URNs loaded in batches
+        results, end = self.fetchStream(url)
+
+        self.assertEqual([self.frank.uuid, contact2.uuid, contact1.uuid, self.joe.uuid], [r["uuid"] for r in results])
+        self.assertEqual({"nickname": "Annie"}, results[2]["fields"])
+        self.assertEqual(["tel:+250788000001"], results[2]["urns"])
+        self.assertEqual([{"uuid": group.uuid, "name": "Customers"}], results[3]["groups"])
+        self.assertEqual(4, end["count"])
+
+        # nothing new to stream from the returned cursor
+        results, end2 = self.fetchStream(url, "&resume=" + end["cursor"])
+        self.assertEqual([], results)
+        self.assertEqual({"cursor": end["cursor"], "count": 0}, end2)
+
+        # modify a contact and we only get that one, but only in streams started after it was modified
+        contact2.block(self.user)
+        contact2.refresh_from_db()
+
+        with patch("temba.api.v2.views_base.timezone.now", return_value=contact2.modified_on - timedelta(seconds=1)):
+            results, end3 = self.fetchStream(url, "&resume=" + end["cursor"])
+            self.assertEqual([], results)
+            self.assertEqual(end["cursor"], end3["cursor"])
+
+        results, end3 = self.fetchStream(url, "&resume=" + end["cursor"])
+        self.assertEqual([contact2.uuid], [r["uuid"] for r in results])
+        self.assertTrue(results[0]["blocked"])
+        self.assertNotEqual(end["cursor"], end3["cursor"])
+
+        # stream can be combined with filters
+        results, end = self.fetchStream(url, "&group=Customers")
+        self.assertEqual([self.joe.uuid], [r["uuid"] for r in results])
+
+        # error if resume cursor is invalid
+        response = self.fetchJSON(url, "stream=true&resume=xyz")
+        self.assertResponseError(response, None, "Invalid resume cursor")
+
     def test_prevent_modifying_contacts_with_fields_that_have_null_chars(self):
         """
         Verifies fix for: https://sentry.io/nyaruka/textit/issues/770220071/
@@ -3345,6 +3464,30 @@ class APITest(TembaTest):
         response = self.fetchJSON(url, "contact=%s&flow=%s" % (self.joe.uuid, flow1.uuid))
         self.assertResponseError(response, None, "You may only specify one of the contact, flow parameters")
 
+    def test_runs_stream(self):
+        url = reverse("api.v2.runs")
+        self.login(self.admin)
+
+        flow = self.get_flow("color_v13")
+        color_prompt = flow.as_json()["nodes"][0]
+
+        joe_run = MockSessionWriter(self.joe, flow).visit(color_prompt).wait().save().session.runs.get()
+        frank_run = MockSessionWriter(self.frank, flow).visit(color_prompt).wait().save().session.runs.get()
+
+        results, end = self.fetchStream(url)
+        self.assertEqual([joe_run.id, frank_run.id], [r["id"] for r in results])
+        self.assertEqual({"uuid": self.frank.uuid, "name": self.frank.name}, results[1]["contact"])
+        self.assertEqual({"uuid": flow.uuid, "name": "Colors"}, results[1]["flow"])
+        self.assertEqual(2, end["count"])
+
+        joe_run.refresh_from_db()
+        joe_run.exit_type = FlowRun.EXIT_TYPE_INTERRUPTED
+        joe_run.save(update_fields=("exit_type", "modified_on"))
+
+        results, end = self.fetchStream(url, "&resume=" + end["cursor"])
+        self.assertEqual([joe_run.id], [r["id"] for r in results])
+        self.assertEqual("interrupted", results[0]["exit_type"])
+
     def test_runs_with_action_results(self):
         """
         Runs from save_run_result actions may have some fields missing
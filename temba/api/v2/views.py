@@ -1275,6 +1275,18 @@ class ContactsEndpoint(ListAPIMixin, WriteAPIMixin, DeleteAPIMixin, BaseAPIView)
             }]
         }
 
+    ## Streaming Contacts
+
+    Passing the "stream=true" parameter returns all matching contacts as newline delimited JSON, oldest modified first,
+    rather than as pages. The last line contains a cursor which can be passed as the `resume` parameter to fetch only
+    those contacts modified since the stream ended:
+
+        GET /api/v2/contacts.json?stream=true&after=2015-01-01T00:00:00.000
+
+        {"uuid": "09d23a05-47fe-11e4-bfe9-b8f6b119e9ab", "name": "Ben Haggerty", ...}
+        {"uuid": "f1ba6e6c-9f39-4ec3-8f51-2fc4fbd6a8e5", "name": "Ryan Lewis", ...}
+        {"cursor": "MjAxNS0xMS0xMVQxMzowNTo1Ny41NzYwNTYrMDA6MDB8MTIz", "count": 2}
+
     ## Adding Contacts
 
     You can add a new contact to your account by sending a **POST** request to this URL with the following JSON data:
@@ -1360,6 +1372,7 @@ class ContactsEndpoint(ListAPIMixin, WriteAPIMixin, DeleteAPIMixin, BaseAPIView)
     serializer_class = ContactReadSerializer
     write_serializer_class = ContactWriteSerializer
     pagination_class = ModifiedOnCursorPagination
+    stream_field = "modified_on"
     throttle_scope = "v2.contacts"
     lookup_params = {"uuid": "uuid", "urn": "urns__identity"}
 
@@ -1451,6 +1464,8 @@ class ContactsEndpoint(ListAPIMixin, WriteAPIMixin, DeleteAPIMixin, BaseAPIView)
                     "required": False,
                     "help": "Only return contacts modified after this date, ex: 2015-01-28T18:00:00.000",
                 },
+                {"name": "stream", "required": False, "help": "Whether to stream all contacts, ex: true"},
+                {"name": "resume", "required": False, "help": "A cursor returned by a previous stream to resume from"},
             ],
             "example": {"query": "urn=tel%3A%2B250788123123"},
         }
@@ -2974,12 +2989,24 @@ class RunsEndpoint(ListAPIMixin, BaseAPIView):
             },
             ...
         }
+
+    ## Streaming Flow Runs
+
+    Passing the "stream=true" parameter returns all matching runs as newline delimited JSON, oldest modified first,
+    rather than as pages. The last line contains a cursor which can be passed as the `resume` parameter to fetch only
+    those runs modified since the stream ended:
+
+        GET /api/v2/runs.json?stream=true&flow=f5901b62-ba76-4003-9c62-72fdacc1b7b7
+
+        {"id": 12345678, "flow": {"uuid": "f5901b62-ba76-4003-9c62-72fdacc1b7b7", "name": "Favorite Color"}, ...}
+        {"cursor": "MjAxNS0xMS0xMVQxMzowNTo1Ny41NzYwNTYrMDA6MDB8MTIzNDU2Nzg=", "count": 1}
     """
 
     permission = "flows.flow_api"
     model = FlowRun
     serializer_class = FlowRunReadSerializer
     pagination_class = ModifiedOnCursorPagination
+    stream_field = "modified_on"
     exclusive_params = ("contact", "flow")
     throttle_scope = "v2.runs"
 
@@ -3058,6 +3085,8 @@ class RunsEndpoint(ListAPIMixin, BaseAPIView):
                     "required": False,
                     "help": "Only return runs modified after this date, ex: 2015-01-28T18:00:00.000",
                 },
+                {"name": "stream", "required": False, "help": "Whether to stream all runs, ex: true"},
+                {"name": "resume", "required": False, "help": "A cursor returned by a previous stream to resume from"},
             ],
             "example": {"query": "after=2016-01-01T00:00:00.000"},
         }
@@ -1,15 +1,22 @@
+import base64
+import json
 from uuid import UUID
 
 import iso8601
 from rest_framework import generics, mixins, status
 from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 
 from django.db import transaction
+from django.db.models import Q, prefetch_related_objects
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 
 from temba.api.models import APIPermission, SSLPermission
 from temba.api.support import InvalidQueryError
 from temba.contacts.models import URN
+from temba.utils import str_to_bool
 from temba.utils.views import NonAtomicMixin
 
 from .serializers import BulkActionFailure
@@ -101,6 +108,10 @@ class ListAPIMixin(mixins.ListModelMixin):
 
     exclusive_params = ()
 
+    # endpoints which support streaming set this to the timestamp field which results are streamed in order of
+    stream_field = None
+    stream_batch_size = 1000
+
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
@@ -110,9 +121,77 @@ class ListAPIMixin(mixins.ListModelMixin):
         if not kwargs.get("format", None):
             # if this is just a request to browse the endpoint docs, don't make a query
             return Response([])
+        elif self.stream_field and str_to_bool(self.request.query_params.get("stream")):
+            return self.stream(request)
         else:
             return super().list(request, *args, **kwargs)
 
+    def stream(self, request):
+        """
+        Streams all matching objects as newline delimited JSON, oldest first. Objects are fetched in batches using the
+        (timestamp, id) of the last object of each batch as a keyset, so that each batch is an indexed range query
+        rather than an ever growing offset. The last line is an object containing a cursor which can be passed back
+        as the resume param to continue from where the stream ended.
+
+        Only objects with timestamps up to when the stream started are included, so that objects modified during the
+        stream don't keep extending it. They are picked up by resuming.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        queryset = queryset.filter(**{self.stream_field + "__lte": timezone.now()})
+
+        # prefetches are applied to each batch rather than to the queryset
+        prefetches = queryset._prefetch_related_lookups
+        queryset = queryset.prefetch_related(None).order_by(self.stream_field, "id")
+
+        resume = self.request.query_params.get("resume")
+        start = self.decode_stream_cursor(resume) if resume else None
+        context = self.get_serializer_context()
+
+        def after(keyset):
+            if not keyset:
+                return queryset
+            last_time, last_id = keyset
+            return queryset.filter(
+                Q(**{self.stream_field + "__gt": last_time}) | Q(**{self.stream_field: last_time, "id__gt": last_id})
+            )
+
+        def generate():
+            keyset, cursor, count = start, resume, 0
+
+            while True:
+                batch = list(after(keyset)[: self.stream_batch_size])
+                if not batch:
+                    break
+
+                prefetch_related_objects(batch, *prefetches)
+                self.prepare_for_serialization(batch)
+
+                for item in self.get_serializer_class()(batch, many=True, context=context).data:
+                    yield json.dumps(item, cls=JSONEncoder) + "\n"
+
+                keyset = (getattr(batch[-1], self.stream_field), batch[-1].id)
+                cursor = self.encode_stream_cursor(*keyset)
+                count += len(batch)
+
+                if len(batch) < self.stream_batch_size:
+                    break
+
+            yield json.dumps({"cursor": cursor, "count": count}) + "\n"
+
+        return StreamingHttpResponse(generate(), content_type="application/x-ndjson")
+
+    @staticmethod
+    def encode_stream_cursor(timestamp, id):
+        return base64.urlsafe_b64encode(("%s|%d" % (timestamp.isoformat(), id)).encode("utf-8")).decode("utf-8")
+
+    @staticmethod
+    def decode_stream_cursor(cursor):
+        try:
+            timestamp, id = base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8").split("|")
+            return iso8601.parse_date(timestamp), int(id)
+        except Exception:
+            raise InvalidQueryError("Invalid resume cursor")
+
     def check_query(self, params):
         # check user hasn't provided values for more than one of any exclusive params
         if sum([(1 if params.get(p) else 0) for p in self.exclusive_params]) > 1:
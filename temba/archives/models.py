@@ -1,8 +1,18 @@
-import gzip
+import base64
+import hashlib
+import itertools
+import logging
+import queue
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from gettext import gettext as _
 from urllib.parse import urlparse
 
 import boto3
+import iso8601
+import regex
+from botocore.exceptions import ClientError
 from dateutil.relativedelta import relativedelta
 
 from django.conf import settings
@@ -11,6 +21,8 @@ from django.utils import timezone
 
 from temba.utils import json, sizeof_fmt
 
+logger = logging.getLogger(__name__)
+
 
 class Archive(models.Model):
     DOWNLOAD_EXPIRES = 60 * 60 * 24  # Up to 24 hours
@@ -118,33 +130,461 @@ class Archive(models.Model):
         else:
             return ""
 
-    def iter_records(self):
+    def index_location(self):
+        location = self.s3_location()
+        return dict(Bucket=location["Bucket"], Key=location["Key"] + ArchiveIndex.KEY_SUFFIX)
+
+    def iter_lines(self, build_index=False):
         """
-        Creates an iterator for the records in this archive, streaming and decompressing on the fly
+        Creates an iterator for the raw JSON lines in this archive, streaming and decompressing on the fly. If
+        build_index is true, an index of the archive is built as it's read and saved alongside it once fully read.
+        Failing to save the index isn't fatal as the archive will just be indexed again by a later read.
         """
         s3 = self.s3_client()
         s3_obj = s3.get_object(**self.s3_location())
-        stream = gzip.GzipFile(fileobj=s3_obj["Body"])
 
-        while True:
-            line = stream.readline()
-            if not line:
-                break
+        reader = GzipLineReader(s3_obj["Body"])
+        builder = ArchiveIndexBuilder(self.hash, self.size) if build_index else None
+
+        for start, line in reader:
+            if builder:
+                builder.add(start, line, reader.position)
+            yield line
+
+        if builder:
+            self._index = builder.finish()
+            try:
+                s3.put_object(Body=json.dumps(self._index.as_json()).encode("utf-8"), **self.index_location())
+            except ClientError as e:
+                logger.error(f"Unable to save index for archive #{self.id}: {str(e)}", exc_info=True)
+
+    def iter_range_lines(self, start, end):
+        """
+        Creates an iterator for the raw JSON lines decompressed from the byte range [start, end) of this archive, which
+        must start at a gzip member. The range may end mid-member in which case the last line yielded may be partial.
+        """
+        s3 = self.s3_client()
+        s3_obj = s3.get_object(Range=f"bytes={start}-{end - 1}", **self.s3_location())
+
+        for line_start, line in GzipLineReader(s3_obj["Body"]):
+            yield line
+
+    def get_index(self):
+        """
+        Gets the index of this archive if one has been built for its current content, or None
+        """
+        if not hasattr(self, "_index"):
+            try:
+                s3_obj = self.s3_client().get_object(**self.index_location())
+                index = ArchiveIndex.from_json(json.loads(s3_obj["Body"].read().decode("utf-8")))
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "NoSuchKey":  # pragma: no cover
+                    raise
+                return None
+
+            # an index built before the archive was rewritten is ignored, and replaced once the archive is read again
+            if index.hash != self.hash or index.size != self.size:
+                return None
 
+            self._index = index
+
+        return self._index
+
+    def iter_records(self):
+        """
+        Creates an iterator for the records in this archive, streaming and decompressing on the fly
+        """
+        for line in self.iter_lines():
             yield json.loads(line.decode("utf-8"))
 
+    @classmethod
+    def scan_records(cls, archives, *, prefilters=(), timestamp_field=None, block_filter=None):
+        """
+        Creates a scan of the records in the given archives, see ArchiveScan
+        """
+        return ArchiveScan(archives, prefilters=prefilters, timestamp_field=timestamp_field, block_filter=block_filter)
+
     def release(self):
 
         # detach us from our rollups
         Archive.objects.filter(rollup=self).update(rollup=None)
 
-        # delete our archive file from s3
+        # delete our archive file and its index from s3
         if self.url:
             s3 = self.s3_client()
             s3.delete_object(**self.s3_location())
+            s3.delete_object(**self.index_location())
 
         # and lastly delete ourselves
         self.delete()
 
     class Meta:
         unique_together = ("org", "archive_type", "start_date", "period")
+
+
+class ArchiveScan:
+    """
+    Scans the records of a sequence of archives, fetching and decompressing several archives at once in a pool of
+    threads but still yielding records in the order of the given archives.
+
+    Each prefilter is a collection of strings of which at least one must appear in a raw line for that line to be
+    parsed, e.g. the UUIDs of the flows being exported. Prefilters can only rule records out so callers must still
+    check the records they are given.
+
+    If timestamp_field is provided, the latest value of that field across all records, including those skipped by
+    the prefilters, is available as latest_timestamp once the scan has been consumed.
+
+    If block_filter is provided, archives are read using their indexes (see ArchiveIndex) and only the blocks for
+    which block_filter returns true are parsed, with archives only fetched up to the last block they need. Archives
+    without an index are read in full and, if ARCHIVE_INDEX_WRITES is enabled, indexed as they are.
+    """
+
+    MAX_WORKERS = 4
+    CHUNK_SIZE = 1000  # number of lines scanned per chunk handed from a worker to the consumer
+    READ_AHEAD = 5  # max number of chunks each worker can buffer ahead of the consumer
+
+    def __init__(self, archives, *, prefilters=(), timestamp_field=None, block_filter=None):
+        self.archives = list(archives)
+        self.block_filter = block_filter
+        self.prefilters = [tuple(v.encode("utf-8") for v in p) for p in prefilters]
+        self.timestamp_field = timestamp_field
+        self.timestamp_regex = (
+            regex.compile(rb'"%s"\s*:\s*"([^"]+)"' % timestamp_field.encode("utf-8")) if timestamp_field else None
+        )
+        self.latest_timestamp = None
+
+    def __iter__(self):
+        if not self.archives:
+            return
+
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.READ_AHEAD) for a in self.archives]
+
+        with ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS, len(self.archives))) as executor:
+            # the pool starts archives in submission order, which is also the order we consume them in, so a worker
+            # blocked on a full queue is always one we will get to
+            futures = [executor.submit(self._scan, a, q, stop) for a, q in zip(self.archives, queues)]
+
+            try:
+                for q, future in zip(queues, futures):
+                    while True:
+                        records, latest = q.get()
+                        if records is None:
+                            break
+
+                        yield from records
+
+                    future.result()  # re-raises any exception from the worker
+
+                    if latest and (self.latest_timestamp is None or latest > self.latest_timestamp):
+                        self.latest_timestamp = latest
+            finally:
+                stop.set()
+
+    def _scan(self, archive, q, stop):
+        """
+        Scans a single archive on a worker thread, putting chunks of matching records on the given queue followed by
+        a final (None, latest_timestamp) item
+        """
+        latest = None
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            matching = []
+            scanned = 0
+
+            for line, timestamp in self._iter_lines(archive):
+                if stop.is_set():
+                    return
+
+                if line is not None:
+                    if self._prefilter(line):
+                        record = json.loads(line.decode("utf-8"))
+                        matching.append(record)
+
+                        if self.timestamp_field:
+                            timestamp = record[self.timestamp_field]
+
+                    elif self.timestamp_regex:
+                        match = self.timestamp_regex.search(line)
+                        if match:
+                            timestamp = match.group(1).decode("utf-8")
+
+                    if timestamp:
+                        timestamp = iso8601.parse_date(timestamp)
+
+                if timestamp and (latest is None or timestamp > latest):
+                    latest = timestamp
+
+                scanned += 1
+                if scanned % self.CHUNK_SIZE == 0 and matching:
+                    if not put((matching, None)):
+                        return
+                    matching = []
+
+            if matching:
+                put((matching, None))
+        finally:
+            put((None, latest))
+
+    def _iter_lines(self, archive):
+        """
+        Iterates the lines of an archive as (line, None) tuples, with blocks skipped by our block filter instead
+        yielding a single (None, latest_timestamp) tuple
+        """
+        index = archive.get_index() if self.block_filter else None
+
+        if not index:
+            build_index = bool(self.block_filter) and settings.ARCHIVE_INDEX_WRITES
+            for line in archive.iter_lines(build_index=build_index):
+                yield line, None
+            return
+
+        # blocks which share a start are in the same gzip member(s) so can only be read by decompressing from there
+        for start, blocks in itertools.groupby(index.blocks, key=lambda b: b.start):
+            blocks = [(b, self.block_filter(b)) for b in blocks]
+
+            while blocks and not blocks[-1][1]:
+                yield None, self._get_latest_timestamp(blocks.pop()[0])
+
+            if not blocks:
+                continue
+
+            lines = archive.iter_range_lines(start, blocks[-1][0].end)
+
+            for block, wanted in blocks:
+                block_lines = itertools.islice(lines, block.num_records)
+                if wanted:
+                    for line in block_lines:
+                        yield line, None
+                else:
+                    for line in block_lines:  # consume the lines we don't need
+                        pass
+                    yield None, self._get_latest_timestamp(block)
+
+    def _get_latest_timestamp(self, block):
+        timestamps = block.timestamps.get(self.timestamp_field) if self.timestamp_field else None
+        return timestamps[1] if timestamps else None
+
+    def _prefilter(self, line):
+        for values in self.prefilters:
+            if not any(v in line for v in values):
+                return False
+        return True
+
+
+class ArchiveIndex:
+    """
+    A sidecar index of an archive, stored next to it in S3. It splits the archive into blocks of up to BLOCK_RECORDS
+    lines, and records the range of timestamps, the flows and a bloom filter of the contacts of the records in each
+    block, so that scans can skip blocks which can't contain matching records.
+
+    A block can only be decompressed from the start of the gzip member it's in, so blocks record that offset, the
+    offset by which all of their lines have been decompressed, and the number of lines before them in that member.
+    The hash and size of the archive when it was indexed are recorded so that an index can't outlive the content it
+    describes.
+    """
+
+    KEY_SUFFIX = ".index.json"
+    BLOCK_RECORDS = 10000
+    TIMESTAMP_FIELDS = ("created_on", "modified_on")
+
+    def __init__(self, hash, size, blocks):
+        self.hash = hash
+        self.size = size
+        self.blocks = blocks
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data.get("hash"), data.get("size"), [ArchiveIndexBlock.from_json(b) for b in data["blocks"]])
+
+    def as_json(self):
+        return {"hash": self.hash, "size": self.size, "blocks": [b.as_json() for b in self.blocks]}
+
+
+class ArchiveIndexBlock:
+    """
+    A block of an archive index, whose lines are decompressed from the bytes [start, end) after skipping the first
+    offset lines
+    """
+
+    def __init__(self, start, end, offset, num_records, timestamps, flows, contacts):
+        self.start = start
+        self.end = end
+        self.offset = offset
+        self.num_records = num_records
+        self.timestamps = timestamps  # field name -> (min, max)
+        self.flows = flows
+        self.contacts = contacts  # a BloomFilter of contact UUIDs
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data["start"],
+            data["end"],
+            data["offset"],
+            data["records"],
+            {f: (iso8601.parse_date(r[0]), iso8601.parse_date(r[1])) for f, r in data["timestamps"].items()},
+            set(data["flows"]),
+            BloomFilter.from_json(data["contacts"]),
+        )
+
+    def as_json(self):
+        return {
+            "start": self.start,
+            "end": self.end,
+            "offset": self.offset,
+            "records": self.num_records,
+            "timestamps": {f: [r[0].isoformat(), r[1].isoformat()] for f, r in self.timestamps.items()},
+            "flows": sorted(self.flows),
+            "contacts": self.contacts.as_json(),
+        }
+
+
+class BloomFilter:
+    """
+    A set of strings which can be tested for membership with no false negatives and around 1% false positives
+    """
+
+    BITS_PER_ITEM = 10
+    NUM_HASHES = 7
+
+    def __init__(self, bits):
+        self.bits = bits
+
+    @classmethod
+    def create(cls, items):
+        bloom = cls(bytearray(max(len(items) * cls.BITS_PER_ITEM // 8, 1)))
+        for item in items:
+            for p in bloom._positions(item):
+                bloom.bits[p // 8] |= 1 << (p % 8)
+        return bloom
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(bytearray(base64.b64decode(data)))
+
+    def as_json(self):
+        return base64.b64encode(bytes(self.bits)).decode("ascii")
+
+    def __contains__(self, item):
+        return all(self.bits[p // 8] & (1 << (p % 8)) for p in self._positions(item))
+
+    def _positions(self, item):
+        digest = hashlib.md5(item.encode("utf-8")).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+        num_bits = len(self.bits) * 8
+        return [(h1 + i * h2) % num_bits for i in range(self.NUM_HASHES)]
+
+
+class ArchiveIndexBuilder:
+    """
+    Builds an archive index from the lines of an archive as they are read by a GzipLineReader. Like the prefilters of
+    a scan, this works on the raw bytes of each line rather than parsing them.
+    """
+
+    FLOW_REGEX = regex.compile(rb'"flow"\s*:\s*\{\s*"uuid"\s*:\s*"([^"]+)"')
+    CONTACT_REGEX = regex.compile(rb'"contact"\s*:\s*\{\s*"uuid"\s*:\s*"([^"]+)"')
+
+    # these also match any nested values with the same name, which only widens the ranges we record
+    TIMESTAMP_REGEXES = {
+        f: regex.compile(rb'"%s"\s*:\s*"([^"]+)"' % f.encode("utf-8")) for f in ArchiveIndex.TIMESTAMP_FIELDS
+    }
+
+    def __init__(self, hash, size):
+        self.hash = hash
+        self.size = size
+        self.blocks = []
+        self.current = None
+        self.contacts = set()
+
+    def add(self, start, line, end):
+        """
+        Adds a line which was read from the gzip member(s) beginning at start and fully decompressed by end
+        """
+        block = self.current
+        if block is None or block.start != start or block.num_records >= ArchiveIndex.BLOCK_RECORDS:
+            offset = block.offset + block.num_records if block and block.start == start else 0
+            self._end_block()
+            block = self.current = ArchiveIndexBlock(start, end, offset, 0, {}, set(), None)
+
+        block.end = end
+        block.num_records += 1
+
+        for field, field_regex in self.TIMESTAMP_REGEXES.items():
+            for match in field_regex.findall(line):
+                value = iso8601.parse_date(match.decode("utf-8"))
+                lower, upper = block.timestamps.get(field, (value, value))
+                block.timestamps[field] = (min(lower, value), max(upper, value))
+
+        flow = self.FLOW_REGEX.search(line)
+        if flow:
+            block.flows.add(flow.group(1).decode("utf-8"))
+
+        contact = self.CONTACT_REGEX.search(line)
+        if contact:
+            self.contacts.add(contact.group(1).decode("utf-8"))
+
+    def finish(self):
+        self._end_block()
+        return ArchiveIndex(self.hash, self.size, self.blocks)
+
+    def _end_block(self):
+        if self.current:
+            self.current.contacts = BloomFilter.create(self.contacts)
+            self.blocks.append(self.current)
+            self.contacts = set()
+
+
+class GzipLineReader:
+    """
+    Reads the lines of a stream of one or more concatenated gzip members, yielding each line with the offset of the
+    member it must be decompressed from, i.e. the start of the first member of a run where only the last member ends
+    on a line boundary. When a line is yielded, position is the offset by which it has been fully decompressed.
+    """
+
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0  # number of compressed bytes consumed
+        self.member_start = 0
+
+    def __iter__(self):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        pending = b""
+
+        while True:
+            chunk = self.stream.read(self.READ_SIZE)
+            if not chunk:
+                break
+
+            while chunk:
+                lines = (pending + decompressor.decompress(chunk)).split(b"\n")
+                pending = lines.pop()
+
+                unused = decompressor.unused_data if decompressor.eof else b""
+                self.position += len(chunk) - len(unused)
+
+                for line in lines:
+                    yield self.member_start, line + b"\n"
+
+                if decompressor.eof:
+                    if not pending:
+                        self.member_start = self.position
+
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    chunk = unused
+                else:
+                    chunk = b""
+
+        if pending:
+            yield self.member_start, pending
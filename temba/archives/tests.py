@@ -1,7 +1,11 @@
-from datetime import date
+from datetime import date, datetime
 from unittest.mock import patch
 from uuid import uuid4
 
+import pytz
+from botocore.exceptions import ClientError
+
+from django.test import override_settings
 from django.urls import reverse
 from django.utils import timezone
 
@@ -36,6 +40,213 @@ class ArchiveTest(TembaTest):
             self.assertEqual(next(records_iter), {"id": 3})
             self.assertRaises(StopIteration, next, records_iter)
 
+    def test_scan_records(self):
+        mock_s3 = MockS3Client()
+        archives = []
+        for i in range(5):
+            archives.append(
+                Archive.objects.create(
+                    org=self.org,
+                    archive_type=Archive.TYPE_FLOWRUN,
+                    size=10,
+                    hash=uuid4().hex,
+                    url=f"http://s3-bucket.aws.com/my/{i}.jsonl.gz",
+                    record_count=3,
+                    start_date=date(2018, 2, i + 1),
+                    period="D",
+                    build_time=23425,
+                )
+            )
+            mock_s3.put_jsonl(
+                "s3-bucket",
+                f"my/{i}.jsonl.gz",
+                [
+                    {"id": i * 3 + j, "flow": {"uuid": f"flow-{j}"}, "modified_on": f"2018-02-0{i + 1}T1{j}:00:00Z"}
+                    for j in range(3)
+                ],
+            )
+
+        with patch("temba.archives.models.Archive.s3_client", return_value=mock_s3):
+            # records come back in archive order even though archives are read concurrently
+            scan = Archive.scan_records(archives, timestamp_field="modified_on")
+            self.assertEqual(list(range(15)), [r["id"] for r in scan])
+            self.assertEqual(datetime(2018, 2, 5, 12, 0, 0, 0, pytz.UTC), scan.latest_timestamp)
+
+            # prefiltered records aren't returned but do count towards latest timestamp
+            scan = Archive.scan_records(archives, prefilters=[["flow-0", "flow-1"]], timestamp_field="modified_on")
+            self.assertEqual([0, 1, 3, 4, 6, 7, 9, 10, 12, 13], [r["id"] for r in scan])
+            self.assertEqual(datetime(2018, 2, 5, 12, 0, 0, 0, pytz.UTC), scan.latest_timestamp)
+
+            # all prefilters must match
+            scan = Archive.scan_records(archives, prefilters=[["flow-0", "flow-1"], ["flow-1", "flow-2"]])
+            self.assertEqual([1, 4, 7, 10, 13], [r["id"] for r in scan])
+            self.assertIsNone(scan.latest_timestamp)
+
+            # consumer can stop early
+            scan_iter = iter(Archive.scan_records(archives))
+            self.assertEqual(0, next(scan_iter)["id"])
+            scan_iter.close()
+
+            self.assertEqual([], list(Archive.scan_records([])))
+
+    @override_settings(ARCHIVE_INDEX_WRITES=True)
+    @patch("temba.archives.models.ArchiveIndex.BLOCK_RECORDS", 2)
+    @patch("temba.archives.models.GzipLineReader.READ_SIZE", 32)
+    def test_index(self):
+        mock_s3 = MockS3Client()
+        archive = Archive.objects.create(
+            org=self.org,
+            archive_type=Archive.TYPE_FLOWRUN,
+            size=10,
+            hash=uuid4().hex,
+            url="http://s3-bucket.aws.com/my/run.jsonl.gz",
+            record_count=6,
+            start_date=date(2018, 2, 1),
+            period="M",
+            build_time=23425,
+        )
+        mock_s3.put_jsonl(
+            "s3-bucket",
+            "my/run.jsonl.gz",
+            [
+                {
+                    "id": i,
+                    "flow": {"uuid": f"flow-{i // 2}"},
+                    "contact": {"uuid": f"contact-{i % 2}"},
+                    "modified_on": f"2018-02-0{i + 1}T10:00:00Z",
+                }
+                for i in range(6)
+            ],
+        )
+
+        def flow_filter(*uuids):
+            return lambda block: not block.flows.isdisjoint(uuids)
+
+        with patch("temba.archives.models.Archive.s3_client", return_value=mock_s3):
+            self.assertIsNone(archive.get_index())
+
+            # first scan with a block filter reads the whole archive and builds its index
+            scan = Archive.scan_records(
+                [archive], prefilters=[["flow-1"]], timestamp_field="modified_on", block_filter=flow_filter("flow-1")
+            )
+            self.assertEqual([2, 3], [r["id"] for r in scan])
+            self.assertEqual(datetime(2018, 2, 6, 10, 0, 0, 0, pytz.UTC), scan.latest_timestamp)
+
+            # archive is a single gzip member so its blocks are all decompressed from its start
+            index = Archive.objects.get(id=archive.id).get_index()
+            self.assertEqual(3, len(index.blocks))
+            self.assertEqual([0, 0, 0], [b.start for b in index.blocks])
+            self.assertEqual([0, 2, 4], [b.offset for b in index.blocks])
+            self.assertLessEqual(index.blocks[0].end, index.blocks[1].end)
+            self.assertLessEqual(index.blocks[1].end, index.blocks[2].end)
+            self.assertEqual(len(mock_s3.objects[("s3-bucket", "my/run.jsonl.gz")].getvalue()), index.blocks[2].end)
+            self.assertEqual([2, 2, 2], [b.num_records for b in index.blocks])
+            self.assertEqual({"flow-1"}, index.blocks[1].flows)
+            self.assertIn("contact-0", index.blocks[1].contacts)
+            self.assertIn("contact-1", index.blocks[1].contacts)
+            self.assertNotIn("contact-2", index.blocks[1].contacts)
+            self.assertEqual(
+                (datetime(2018, 2, 3, 10, 0, 0, 0, pytz.UTC), datetime(2018, 2, 4, 10, 0, 0, 0, pytz.UTC)),
+                index.blocks[1].timestamps["modified_on"],
+            )
+
+            # subsequent scans only fetch the archive up to the last block which passes the filter, and skipped
+            # blocks count towards latest timestamp
+            archive = Archive.objects.get(id=archive.id)
+            with patch.object(mock_s3, "get_object", wraps=mock_s3.get_object) as mock_get:
+                scan = Archive.scan_records(
+                    [archive], timestamp_field="modified_on", block_filter=flow_filter("flow-0")
+                )
+                self.assertEqual([0, 1], [r["id"] for r in scan])
+                self.assertEqual(datetime(2018, 2, 6, 10, 0, 0, 0, pytz.UTC), scan.latest_timestamp)
+
+                scan = Archive.scan_records([archive], block_filter=flow_filter("flow-0", "flow-2"))
+                self.assertEqual([0, 1, 4, 5], [r["id"] for r in scan])
+
+                scan = Archive.scan_records([archive], block_filter=flow_filter("flow-3"))
+                self.assertEqual([], list(scan))
+
+            ranges = [c[1].get("Range") for c in mock_get.call_args_list]
+            self.assertEqual(
+                [None, f"bytes=0-{index.blocks[0].end - 1}", f"bytes=0-{index.blocks[2].end - 1}"], ranges
+            )
+
+            # an index which doesn't match the archive's current hash is ignored and rebuilt by the next scan
+            Archive.objects.filter(id=archive.id).update(hash=uuid4().hex)
+            archive = Archive.objects.get(id=archive.id)
+            self.assertIsNone(archive.get_index())
+
+            scan = Archive.scan_records([archive], block_filter=flow_filter("flow-0"))
+            self.assertEqual([0, 1, 2, 3, 4, 5], [r["id"] for r in scan])
+            self.assertEqual(archive.hash, Archive.objects.get(id=archive.id).get_index().hash)
+
+            # failing to save an index doesn't fail the scan
+            archive = Archive.objects.get(id=archive.id)
+            mock_s3.delete_object(**archive.index_location())
+            with patch.object(mock_s3, "put_object", side_effect=ClientError({"Error": {"Code": "AccessDenied"}}, "")):
+                scan = Archive.scan_records([archive], block_filter=flow_filter("flow-0"))
+                self.assertEqual([0, 1, 2, 3, 4, 5], [r["id"] for r in scan])
+
+            self.assertIsNone(Archive.objects.get(id=archive.id).get_index())
+
+            # and no index is saved if index writes aren't enabled
+            with override_settings(ARCHIVE_INDEX_WRITES=False):
+                scan = Archive.scan_records([archive], block_filter=flow_filter("flow-0"))
+                self.assertEqual([0, 1, 2, 3, 4, 5], [r["id"] for r in scan])
+
+            self.assertIsNone(Archive.objects.get(id=archive.id).get_index())
+
+            # index is deleted with the archive
+            archive.release()
+            self.assertEqual({}, mock_s3.objects)
+
+    @override_settings(ARCHIVE_INDEX_WRITES=True)
+    @patch("temba.archives.models.ArchiveIndex.BLOCK_RECORDS", 3)
+    def test_index_multiple_members(self):
+        mock_s3 = MockS3Client()
+        archive = Archive.objects.create(
+            org=self.org,
+            archive_type=Archive.TYPE_MSG,
+            size=10,
+            hash=uuid4().hex,
+            url="http://s3-bucket.aws.com/my/msg.jsonl.gz",
+            record_count=6,
+            start_date=date(2018, 2, 1),
+            period="M",
+            build_time=23425,
+        )
+        mock_s3.put_jsonl(
+            "s3-bucket",
+            "my/msg.jsonl.gz",
+            [{"id": i, "created_on": f"2018-02-0{i + 1}T10:00:00Z"} for i in range(6)],
+            member_size=4,
+        )
+
+        def date_filter(day):
+            return lambda block: block.timestamps["created_on"][1].day >= day
+
+        with patch("temba.archives.models.Archive.s3_client", return_value=mock_s3):
+            scan = Archive.scan_records([archive], block_filter=date_filter(1))
+            self.assertEqual([0, 1, 2, 3, 4, 5], [r["id"] for r in scan])
+
+            # a new block starts at each member which begins on a line boundary, as well as every 3 lines
+            index = Archive.objects.get(id=archive.id).get_index()
+            self.assertEqual([3, 1, 2], [b.num_records for b in index.blocks])
+            self.assertEqual([0, 3, 0], [b.offset for b in index.blocks])
+            self.assertEqual(index.blocks[0].start, index.blocks[1].start)
+            self.assertEqual(index.blocks[1].end, index.blocks[2].start)
+
+            archive = Archive.objects.get(id=archive.id)
+            with patch.object(mock_s3, "get_object", wraps=mock_s3.get_object) as mock_get:
+                scan = Archive.scan_records([archive], block_filter=date_filter(4))
+                self.assertEqual([3, 4, 5], [r["id"] for r in scan])
+
+            ranges = [c[1].get("Range") for c in mock_get.call_args_list]
+            self.assertEqual(
+                [f"bytes=0-{index.blocks[1].end - 1}", f"bytes={index.blocks[2].start}-{index.blocks[2].end - 1}"],
+                ranges,
+            )
+
     def test_end_date(self):
 
         daily = Archive.objects.create(
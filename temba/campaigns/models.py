@@ -1,5 +1,8 @@
+import logging
 from datetime import timedelta
 
+import iso8601
+
 from django.db import models
 from django.db.models import Model
 from django.utils import timezone
@@ -10,9 +13,11 @@ from temba.flows.models import Flow
 from temba.msgs.models import Msg
 from temba.orgs.models import Org
 from temba.utils import json, on_transaction_commit
-from temba.utils.models import TembaModel, TranslatableField
+from temba.utils.models import TembaModel, TranslatableField, iter_keyset_batches
 from temba.values.constants import Value
 
+logger = logging.getLogger(__name__)
+
 
 class Campaign(TembaModel):
     MAX_NAME_LEN = 255
@@ -555,6 +560,9 @@ class EventFire(Model):
     RESULT_SKIPPED = "S"
     RESULTS = ((RESULT_FIRED, "Fired"), (RESULT_SKIPPED, "Skipped"))
 
+    # number of contacts whose fires are calculated and inserted at a time
+    CREATE_BATCH_SIZE = 5000
+
     event = models.ForeignKey(CampaignEvent, on_delete=models.PROTECT, related_name="fires")
 
     contact = models.ForeignKey(Contact, on_delete=models.PROTECT, related_name="campaign_fires")
@@ -594,39 +602,51 @@ class EventFire(Model):
 
     @classmethod
     def do_create_eventfires_for_event(cls, event):
-
+        """
+        Creates fires for every contact in the event's campaign group, fetching the contacts' relative to values in
+        batches and inserting the fires for each batch as we go
+        """
         if EventFire.objects.filter(event=event).exists():
             return
 
-        if event.is_active and not event.campaign.is_archived:
-
-            # create fires for our event
-            field = event.relative_to
-            if field.field_type == ContactField.FIELD_TYPE_USER:
-                field_uuid = str(field.uuid)
-
-                contacts = event.campaign.group.contacts.filter(is_active=True, is_blocked=False).extra(
-                    where=['%s::text[] <@ (extract_jsonb_keys("contacts_contact"."fields"))'], params=[[field_uuid]]
-                )
-            elif field.field_type == ContactField.FIELD_TYPE_SYSTEM:
-                contacts = event.campaign.group.contacts.filter(is_active=True, is_blocked=False)
-            else:  # pragma: no cover
-                raise ValueError(f"Unhandled ContactField type {field.field_type}.")
-
-            now = timezone.now()
-            events = []
+        if not event.is_active or event.campaign.is_archived:
+            return
 
-            org = event.campaign.org
-            for contact in contacts:
-                contact.org = org
-                scheduled = event.calculate_scheduled_fire_for_value(contact.get_field_value(field), now)
+        field = event.relative_to
+        contacts = event.campaign.group.contacts.filter(is_active=True, is_blocked=False)
 
-                # and if we have a date, then schedule it
+        # only fetch the value we need, rather than full contact instances
+        if field.field_type == ContactField.FIELD_TYPE_USER:
+            contacts = contacts.extra(
+                select={"relative_value": '"contacts_contact"."fields"->%s->>%s'},
+                select_params=[str(field.uuid), ContactField.DATETIME_KEY],
+                where=['%s::text[] <@ (extract_jsonb_keys("contacts_contact"."fields"))'],
+                params=[[str(field.uuid)]],
+            )
+            values = contacts.values_list("id", "relative_value")
+        elif field.field_type == ContactField.FIELD_TYPE_SYSTEM:
+            values = contacts.values_list("id", field.key)
+        else:  # pragma: no cover
+            raise ValueError(f"Unhandled ContactField type {field.field_type}.")
+
+        now = timezone.now()
+        num_fires = 0
+
+        # page by id rather than using iterator() as server-side cursors are disabled and it would fetch every row
+        for batch in iter_keyset_batches(values, "id", cls.CREATE_BATCH_SIZE):
+            fires = []
+            for contact_id, value in batch:
+                if isinstance(value, str):
+                    value = iso8601.parse_date(value)
+
+                scheduled = event.calculate_scheduled_fire_for_value(value, now)
                 if scheduled:
-                    events.append(EventFire(event=event, contact=contact, scheduled=scheduled))
+                    fires.append(EventFire(event=event, contact_id=contact_id, scheduled=scheduled))
 
-            # bulk create our event fires
-            EventFire.objects.bulk_create(events)
+            EventFire.objects.bulk_create(fires)
+            num_fires += len(fires)
+
+            logger.info(f"created {num_fires} fires for campaign event #{event.id}")
 
     @classmethod
     def update_events_for_contact_groups(cls, contact, groups):
@@ -671,6 +691,74 @@ class EventFire(Model):
             if scheduled:
                 EventFire.objects.create(event=event, contact=contact, scheduled=scheduled)
 
+    @classmethod
+    def update_events_for_contacts(cls, org, contacts, fields=(), groups=()):
+        """
+        Updates the events for many contacts at once, across all campaigns. Should be called when contact fields or
+        group memberships have changed for a batch of contacts, e.g. by an import or a bulk action.
+        """
+        contacts = {c.id: c for c in contacts}
+        if not contacts or not (fields or groups):
+            return
+
+        contact_ids = list(contacts.keys())
+        memberships = ContactGroup.contacts.through.objects.filter(contact_id__in=contact_ids)
+        members_by_group = {}
+
+        def get_members(group_id):
+            if group_id not in members_by_group:
+                members = memberships.filter(contactgroup_id=group_id).values_list("contact_id", flat=True)
+                members_by_group[group_id] = list(members)
+            return members_by_group[group_id]
+
+        now = timezone.now()
+        fires = []
+
+        def schedule(event, member_ids):
+            for contact_id in member_ids:
+                contact = contacts[contact_id]
+                contact.org = org
+                scheduled = event.calculate_scheduled_fire_for_value(contact.get_field_value(event.relative_to), now)
+                if scheduled:
+                    fires.append(EventFire(event=event, contact=contact, scheduled=scheduled))
+
+        # campaigns whose group membership changed have all their events rescheduled
+        campaigns = Campaign.objects.filter(org=org, group__in=groups, is_active=True, is_archived=False).distinct()
+        campaign_ids = set()
+
+        for campaign in campaigns:
+            campaign_ids.add(campaign.id)
+
+            # remove any unfired events, they will get recreated below for contacts still in the group
+            EventFire.objects.filter(event__campaign=campaign, contact_id__in=contact_ids, fired=None).delete()
+
+            for event in campaign.get_events().select_related("relative_to", "campaign__org"):
+                schedule(event, get_members(campaign.group_id))
+
+        # events relative to changed fields are rescheduled for the contacts in their campaign's group
+        if fields:
+            keys = set(fields) | set(ContactField.IMMUTABLE_FIELDS)
+            events = (
+                CampaignEvent.objects.filter(
+                    campaign__org=org,
+                    campaign__group__in=memberships.values("contactgroup_id"),
+                    relative_to__key__in=keys,
+                    campaign__is_archived=False,
+                    is_active=True,
+                )
+                .exclude(campaign_id__in=campaign_ids)
+                .select_related("relative_to", "campaign__org")
+            )
+
+            for event in events:
+                member_ids = get_members(event.campaign.group_id)
+
+                EventFire.objects.filter(event=event, contact_id__in=member_ids, fired=None).delete()
+
+                schedule(event, member_ids)
+
+        EventFire.objects.bulk_create(fires, batch_size=1000)
+
     @classmethod
     def update_campaign_events_for_contact(cls, campaign, contact):
         """
@@ -1,4 +1,5 @@
 from datetime import timedelta
+from unittest.mock import patch
 
 import pytz
 
@@ -201,6 +202,63 @@ class CampaignTest(TembaTest):
         EventFire.do_create_eventfires_for_event(event)
         self.assertEqual(EventFire.objects.filter(event=event).count(), 1)
 
+    def test_event_fire_creation_batched(self):
+        self.farmer1.set_field(self.user, "planting_date", "1/10/2030")
+        self.farmer2.set_field(self.user, "planting_date", "15/3/2030 10:30")
+        farmer3 = self.create_contact("Ann Smith", "+250788333333")
+        self.farmers.update_contacts(self.admin, [farmer3], add=True)
+
+        campaign = Campaign.create(self.org, self.admin, "Planting Reminders", self.farmers)
+        field = ContactField.get_by_key(self.org, "planting_date")
+        event1 = CampaignEvent.create_message_event(
+            self.org, self.admin, campaign, field, 2, "W", "Hi", delivery_hour=9
+        )
+        event2 = CampaignEvent.create_message_event(
+            self.org, self.admin, campaign, ContactField.get_by_key(self.org, "created_on"), 1, "D", "Hi"
+        )
+
+        with patch("temba.campaigns.models.EventFire.CREATE_BATCH_SIZE", 1):
+            EventFire.do_create_eventfires_for_event(event1)
+            EventFire.do_create_eventfires_for_event(event2)
+
+        # contact without a value doesn't get a fire, others match what we'd calculate for each contact
+        fires = list(EventFire.objects.filter(event=event1).order_by("contact_id"))
+        self.assertEqual([self.farmer1, self.farmer2], [f.contact for f in fires])
+        for fire in fires:
+            self.assertEqual(event1.calculate_scheduled_fire(fire.contact), fire.scheduled)
+
+        fires = list(EventFire.objects.filter(event=event2).order_by("contact_id"))
+        self.assertEqual([self.farmer1, self.farmer2, farmer3], [f.contact for f in fires])
+        self.assertEqual(event2.calculate_scheduled_fire(farmer3), fires[2].scheduled)
+
+    def test_update_events_for_contacts(self):
+        campaign = Campaign.create(self.org, self.admin, "Planting Reminders", self.farmers)
+        field = ContactField.get_by_key(self.org, "planting_date")
+        event = CampaignEvent.create_message_event(self.org, self.admin, campaign, field, 1, "D", "Hi")
+        farmer3 = self.create_contact("Ann Smith", "+250788333333")
+
+        for contact in (self.farmer1, self.farmer2, farmer3):
+            contact.set_field(self.user, "planting_date", "1/10/2030")
+        EventFire.objects.all().delete()
+
+        # only contacts in the campaign group get fires
+        EventFire.update_events_for_contacts(self.org, [self.farmer1, self.farmer2, farmer3], fields=["planting_date"])
+        self.assertEqual({self.farmer1, self.farmer2}, {f.contact for f in EventFire.objects.filter(event=event)})
+
+        # updating again replaces unfired fires rather than duplicating them
+        EventFire.update_events_for_contacts(self.org, [self.farmer1, self.farmer2], fields=["planting_date"])
+        self.assertEqual(2, EventFire.objects.filter(event=event).count())
+
+        # contacts removed from the group lose their fires, contacts added get them
+        self.farmers.contacts.remove(self.farmer2)
+        self.farmers.contacts.add(farmer3)
+        EventFire.update_events_for_contacts(self.org, [self.farmer2, farmer3], groups=[self.farmers])
+        self.assertEqual({self.farmer1, farmer3}, {f.contact for f in EventFire.objects.filter(event=event)})
+
+        # changes to fields which no event is relative to don't affect fires
+        EventFire.update_events_for_contacts(self.org, [self.farmer1], fields=["color"])
+        self.assertEqual(2, EventFire.objects.filter(event=event).count())
+
     def test_message_event_editing(self):
         # update the planting date for our contacts
         self.farmer1.set_field(self.user, "planting_date", "1/10/2020")
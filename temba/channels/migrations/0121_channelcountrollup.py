@@ -0,0 +1,55 @@
+# Generated by Django 2.2.4 on 2019-11-27 14:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+INDEX_SQL = """
+CREATE INDEX channels_channelcountrollup_unsquashed
+ON channels_channelcountrollup(org_id, channel_type, count_type, period, day) WHERE NOT is_squashed;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("orgs", "0058_auto_20190723_2129"), ("channels", "0120_channellog_msg")]
+
+    operations = [
+        migrations.CreateModel(
+            name="ChannelCountRollup",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "is_squashed",
+                    models.BooleanField(default=False, help_text="Whether this row was created by squashing"),
+                ),
+                ("channel_type", models.CharField(max_length=3)),
+                (
+                    "count_type",
+                    models.CharField(
+                        choices=[
+                            ("IM", "Incoming Message"),
+                            ("OM", "Outgoing Message"),
+                            ("IV", "Incoming Voice"),
+                            ("OV", "Outgoing Voice"),
+                            ("LS", "Success Log Record"),
+                            ("LE", "Error Log Record"),
+                        ],
+                        max_length=2,
+                    ),
+                ),
+                ("period", models.CharField(choices=[("D", "Daily"), ("M", "Monthly")], max_length=1)),
+                ("day", models.DateField(help_text="The first day of the period this count is for")),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "org",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="channel_count_rollups",
+                        to="orgs.Org",
+                    ),
+                ),
+            ],
+            options={"index_together": {("org", "period", "day")}},
+        ),
+        migrations.RunSQL(INDEX_SQL, "DROP INDEX channels_channelcountrollup_unsquashed"),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.4 on 2019-11-27 14:15
+
+from django.db import migrations
+
+# only squashed counts are rolled up here, unsquashed counts are rolled up as they are squashed
+POPULATE_SQL = """
+INSERT INTO channels_channelcountrollup
+    ("org_id", "channel_type", "count_type", "period", "day", "count", "is_squashed")
+SELECT c."org_id", c."channel_type", cc."count_type", 'D', cc."day", SUM(cc."count"), TRUE
+FROM channels_channelcount cc INNER JOIN channels_channel c ON c."id" = cc."channel_id"
+WHERE cc."is_squashed" AND cc."day" IS NOT NULL AND c."org_id" IS NOT NULL
+    AND cc."count_type" IN ('IM', 'OM', 'IV', 'OV')
+GROUP BY 1, 2, 3, 5
+UNION ALL
+SELECT c."org_id", c."channel_type", cc."count_type", 'M', date_trunc('month', cc."day")::date, SUM(cc."count"), TRUE
+FROM channels_channelcount cc INNER JOIN channels_channel c ON c."id" = cc."channel_id"
+WHERE cc."is_squashed" AND cc."day" IS NOT NULL AND c."org_id" IS NOT NULL
+    AND cc."count_type" IN ('IM', 'OM', 'IV', 'OV')
+GROUP BY 1, 2, 3, 5
+"""
+
+
+def populate_rollups(apps, schema_editor):  # pragma: no cover
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(POPULATE_SQL)
+        print(f" > Created {cursor.rowcount} channel count rollups")
+
+
+def reverse(apps, schema_editor):  # pragma: no cover
+    pass
+
+
+def apply_manual():  # pragma: no cover
+    from django.db import connection
+
+    with connection.schema_editor() as schema_editor:
+        populate_rollups(None, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("channels", "0121_channelcountrollup")]
+
+    operations = [migrations.RunPython(populate_rollups, reverse)]
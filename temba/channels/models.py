@@ -1,12 +1,16 @@
 import logging
 import time
 from abc import ABCMeta
+from collections import Counter
 from datetime import timedelta
 from enum import Enum
+from uuid import uuid4
 from xml.sax.saxutils import escape
 
 import phonenumbers
+from dateutil.relativedelta import relativedelta
 from django_countries.fields import CountryField
+from django_redis import get_redis_connection
 from phonenumbers import NumberParseException
 from pyfcm import FCMNotification
 from smartmin.models import SmartModel
@@ -18,7 +22,8 @@ from django.contrib.auth.models import Group, User
 from django.contrib.postgres.fields import ArrayField
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
-from django.db.models import Max, Q, Sum
+from django.db.models import F, Max, Q, Sum
+from django.db.models.functions import TruncMonth
 from django.db.models.signals import pre_save
 from django.dispatch import receiver
 from django.template import Context, Engine, TemplateDoesNotExist
@@ -29,6 +34,7 @@ from django.utils.translation import ugettext_lazy as _
 from temba import mailroom
 from temba.orgs.models import Org
 from temba.utils import get_anonymous_user, json, on_transaction_commit, redact
+from temba.utils.cache import LRUCache
 from temba.utils.email import send_template_email
 from temba.utils.gsm7 import calculate_num_segments
 from temba.utils.models import JSONAsTextField, SquashableModel, TembaModel, generate_uuid
@@ -36,6 +42,11 @@ from temba.utils.text import random_string
 
 logger = logging.getLogger(__name__)
 
+# process-local cache of channel routing tables
+ROUTES_CACHE_SIZE = 1000
+
+routes_cache = LRUCache(ROUTES_CACHE_SIZE)
+
 
 class Encoding(Enum):
     GSM7 = 1
@@ -313,6 +324,12 @@ class Channel(TembaModel):
 
     DEFAULT_ROLE = ROLE_SEND + ROLE_RECEIVE
 
+    # redis key of a token which changes whenever any of an org's channels change, used to invalidate routing tables
+    CACHE_VERSION_KEY = "channels_version:%d"
+
+    # fields which affect routing, saving only other fields (e.g. device info on sync) doesn't invalidate routes
+    ROUTING_FIELDS = {"org", "is_active", "role", "schemes", "country", "address", "config", "parent", "channel_type"}
+
     ROLE_CONFIG = {
         ROLE_SEND: "send",
         ROLE_RECEIVE: "receive",
@@ -723,6 +740,43 @@ class Channel(TembaModel):
             code = random_string(length)
         return code
 
+    @classmethod
+    def get_cache_version(cls, org):
+        """
+        Gets the current cache version token for the channels of the given org
+        """
+        r = get_redis_connection()
+        key = cls.CACHE_VERSION_KEY % org.id
+
+        version = r.get(key)
+        if version is None:
+            r.set(key, uuid4().hex, nx=True)
+            version = r.get(key)
+
+        return version.decode()
+
+    @classmethod
+    def bump_cache_version(cls, org_id):
+        """
+        Invalidates anything cached against the channels of the given org
+        """
+        r = get_redis_connection()
+        r.set(cls.CACHE_VERSION_KEY % org_id, uuid4().hex)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not Channel.ROUTING_FIELDS.intersection(update_fields):
+            return
+
+        # bump now so that this transaction sees the change, and again after commit in case another process cached
+        # a routing table built from the old state in the meantime
+        org_id = self.org_id
+        if org_id:
+            Channel.bump_cache_version(org_id)
+            on_transaction_commit(lambda: Channel.bump_cache_version(org_id))
+
     def has_channel_log(self):
         return self.channel_type != Channel.TYPE_ANDROID
 
@@ -1140,6 +1194,128 @@ class Channel(TembaModel):
         ordering = ("-last_seen", "-pk")
 
 
+class ChannelRoutes:
+    """
+    An in-memory routing table of the active channels of an org, with delegates resolved and a prefix trie over the
+    sender addresses for each role and country, so that choosing a channel for a URN doesn't require any database
+    queries. Tables are cached per process until any of the org's channels change, which is checked by fetching the
+    org's channel cache version from Redis on every lookup, so each lookup still costs a single Redis GET.
+    """
+
+    class PrefixNode:
+        __slots__ = ("children", "sender")
+
+        def __init__(self):
+            self.children = {}
+            self.sender = None
+
+    def __init__(self, channels):
+        self.channels = sorted(channels, key=lambda c: c.id)
+        self.by_id = {c.id: c for c in self.channels}
+        self.tries = {}
+
+        # delegates of each channel by role, first created first
+        self.delegates = {}
+        for channel in self.channels:
+            if channel.parent_id in self.by_id:
+                self.delegates.setdefault(channel.parent_id, {}).setdefault(channel.role, channel)
+
+    @classmethod
+    def for_org(cls, org):
+        # a GET of the version is much cheaper than the queries to build a table, and means a table is never stale
+        cache_key = (org.id, Channel.get_cache_version(org))
+
+        routes = routes_cache.get(cache_key)
+        if routes is None:
+            routes = cls(Channel.objects.filter(org=org, is_active=True))
+            routes_cache.set(cache_key, routes)
+        return routes
+
+    def get(self, channel_id):
+        return self.by_id.get(channel_id)
+
+    def get_delegate(self, channel, role):
+        """
+        Gets the channel that should perform the given role for the given channel, same as Channel.get_delegate
+        """
+        if channel.role == role:
+            return channel
+
+        delegate = self.delegates.get(channel.id, {}).get(role)
+        if not delegate and role in channel.role:
+            delegate = channel
+
+        return delegate
+
+    def get_channel(self, scheme, country_code, role):
+        """
+        Gets the newest channel which supports the given scheme and role, preferring those in the given country
+        """
+        channel = None
+        candidates = [c for c in reversed(self.channels) if role in c.role and (scheme is None or scheme in c.schemes)]
+
+        if country_code:
+            channel = next((c for c in candidates if c.country == country_code), None)
+
+        if not channel and candidates:
+            channel = candidates[0]
+
+        if channel and (role == Channel.ROLE_SEND or role == Channel.ROLE_CALL):
+            return self.get_delegate(channel, role)
+        else:
+            return channel
+
+    def get_tel_sender(self, role, number, country_code):
+        """
+        Gets the tel channel with the given role whose address or matching prefixes overlap most with the given number
+        """
+        key = (role, country_code)
+        if key not in self.tries:
+            self.tries[key] = self._build_tel_senders(role, country_code)
+
+        senders, trie = self.tries[key]
+        if len(senders) <= 1:
+            return senders[0] if senders else None
+
+        # walk the trie as far as the number takes us, the deepest node having the sender with the most overlap
+        sender, node = None, trie
+        for char in number:
+            node = node.children.get(char)
+            if node is None:
+                break
+            sender = node.sender
+
+        return sender
+
+    def _build_tel_senders(self, role, country_code):
+        from temba.contacts.models import TEL_SCHEME
+
+        channels = []
+        if country_code:
+            channels = [c for c in self.channels if c.country == country_code and TEL_SCHEME in c.schemes]
+
+        # no country specific channel, try to find any channel at all
+        if not channels:
+            channels = [c for c in self.channels if TEL_SCHEME in c.schemes]
+
+        senders = [c for c in channels if c.address and role in c.role and not c.parent_id]
+
+        # senders are added in order so that on a tie the last one added wins
+        trie = ChannelRoutes.PrefixNode()
+        for sender in senders:
+            prefixes = sender.config.get(Channel.CONFIG_SHORTCODE_MATCHING_PREFIXES, [])
+            if not prefixes or not isinstance(prefixes, list):
+                prefixes = [sender.address.strip("+")]
+
+            for prefix in prefixes:
+                node = trie
+                for char in prefix:
+                    node = node.children.setdefault(char, ChannelRoutes.PrefixNode())
+                    node.sender = sender
+
+        return senders, trie
+
+
 SOURCE_AC = "AC"
 SOURCE_USB = "USB"
 SOURCE_WIRELESS = "WIR"
@@ -1189,6 +1365,34 @@ class ChannelCount(SquashableModel):
     day = models.DateField(null=True, help_text=_("The day this count is for"))
     count = models.IntegerField(default=0, help_text=_("The count of messages on this day and type"))
 
+    # count types which are rolled up per org and channel type
+    ROLLUP_TYPES = (INCOMING_MSG_TYPE, OUTGOING_MSG_TYPE, INCOMING_IVR_TYPE, OUTGOING_IVR_TYPE)
+
+    @classmethod
+    def get_squash_side_effects(cls):
+        """
+        Adds the deltas of the unsquashed rows being squashed to the daily and monthly rollups
+        """
+        rollup_cols = '"org_id", "channel_type", "count_type", "period", "day", "count", "is_squashed"'
+        count_types = ", ".join(f"'{t}'" for t in cls.ROLLUP_TYPES)
+
+        return f"""
+        , deltas AS (
+            SELECT c."org_id", c."channel_type", r."count_type", r."day", r."count"
+            FROM removed r INNER JOIN {Channel._meta.db_table} c ON c."id" = r."channel_id"
+            WHERE NOT r."is_squashed" AND r."day" IS NOT NULL AND c."org_id" IS NOT NULL
+            AND r."count_type" IN ({count_types})
+        ), rolled_up AS (
+            INSERT INTO {ChannelCountRollup._meta.db_table}({rollup_cols})
+            SELECT "org_id", "channel_type", "count_type", '{ChannelCountRollup.PERIOD_DAILY}', "day",
+                SUM("count"), FALSE
+            FROM deltas GROUP BY 1, 2, 3, 5
+            UNION ALL
+            SELECT "org_id", "channel_type", "count_type", '{ChannelCountRollup.PERIOD_MONTHLY}',
+                date_trunc('month', "day")::date, SUM("count"), FALSE
+            FROM deltas GROUP BY 1, 2, 3, 5
+        )"""
+
     @classmethod
     def get_day_count(cls, channel, count_type, day):
         count = ChannelCount.objects.filter(channel=channel, count_type=count_type, day=day)
@@ -1196,40 +1400,98 @@ class ChannelCount(SquashableModel):
 
         return count["count_sum"] if count["count_sum"] is not None else 0
 
+    def __str__(self):  # pragma: no cover
+        return "ChannelCount(%d) %s %s count: %d" % (self.channel_id, self.count_type, self.day, self.count)
+
+    class Meta:
+        index_together = ["channel", "count_type", "day"]
+
+
+class ChannelCountRollup(SquashableModel):
+    """
+    Daily and monthly totals of message and IVR counts per org and channel type. These are maintained from the deltas
+    of channel counts as they are squashed, so that the dashboard doesn't have to aggregate every channel count.
+    """
+
+    SQUASH_OVER = ("org_id", "channel_type", "count_type", "period", "day")
+
+    PERIOD_DAILY = "D"
+    PERIOD_MONTHLY = "M"
+
+    PERIOD_CHOICES = ((PERIOD_DAILY, _("Daily")), (PERIOD_MONTHLY, _("Monthly")))
+
+    # how fields we can sum by are accessed on rollups and on channel counts that are yet to be rolled up
+    ROLLUP_FIELDS = {"org": "org", "channel_type": "channel_type", "count_type": "count_type", "day": "day"}
+    PENDING_FIELDS = {
+        "org": "channel__org",
+        "channel_type": "channel__channel_type",
+        "count_type": "count_type",
+        "day": "period_day",
+    }
+
+    org = models.ForeignKey(Org, on_delete=models.PROTECT, related_name="channel_count_rollups")
+    channel_type = models.CharField(max_length=3)
+    count_type = models.CharField(choices=ChannelCount.COUNT_TYPE_CHOICES, max_length=2)
+    period = models.CharField(choices=PERIOD_CHOICES, max_length=1)
+    day = models.DateField(help_text=_("The first day of the period this count is for"))
+    count = models.IntegerField(default=0)
+
     @classmethod
-    def get_squash_query(cls, distinct_set):
-        if distinct_set.day:
-            sql = """
-            WITH removed as (
-                DELETE FROM %(table)s WHERE "channel_id" = %%s AND "count_type" = %%s AND "day" = %%s RETURNING "count"
-            )
-            INSERT INTO %(table)s("channel_id", "count_type", "day", "count", "is_squashed")
-            VALUES (%%s, %%s, %%s, GREATEST(0, (SELECT SUM("count") FROM removed)), TRUE);
-            """ % {
-                "table": cls._meta.db_table
-            }
+    def get_counts(cls, period, count_types, since, until, orgs=None, by=("day", "count_type")):
+        """
+        Gets the counts of the given period between the since and until days inclusive, summed by the given fields
+        which can be any of org, channel_type, count_type and day. Includes channel counts yet to be rolled up.
+        """
+        rollups = cls.objects.filter(period=period, count_type__in=count_types, day__gte=since, day__lte=until)
 
-            params = (distinct_set.channel_id, distinct_set.count_type, distinct_set.day) * 2
+        if period == cls.PERIOD_MONTHLY:
+            period_day = TruncMonth("day", output_field=models.DateField())
         else:
-            sql = """
-            WITH removed as (
-                DELETE FROM %(table)s WHERE "channel_id" = %%s AND "count_type" = %%s AND "day" IS NULL RETURNING "count"
-            )
-            INSERT INTO %(table)s("channel_id", "count_type", "day", "count", "is_squashed")
-            VALUES (%%s, %%s, NULL, GREATEST(0, (SELECT SUM("count") FROM removed)), TRUE);
-            """ % {
-                "table": cls._meta.db_table
-            }
+            period_day = F("day")
 
-            params = (distinct_set.channel_id, distinct_set.count_type) * 2
+        pending = (
+            ChannelCount.get_unsquashed()
+            .filter(count_type__in=count_types, channel__org__isnull=False)
+            .annotate(period_day=period_day)
+            .filter(period_day__gte=since, period_day__lte=until)
+        )
 
-        return sql, params
+        if orgs is not None:
+            rollups = rollups.filter(org__in=orgs)
+            pending = pending.filter(channel__org__in=orgs)
 
-    def __str__(self):  # pragma: no cover
-        return "ChannelCount(%d) %s %s count: %d" % (self.channel_id, self.count_type, self.day, self.count)
+        counts = Counter()
+        for qs, fields in ((rollups, cls.ROLLUP_FIELDS), (pending, cls.PENDING_FIELDS)):
+            cols = [fields[f] for f in by]
+            for row in qs.values(*cols).annotate(count_sum=Sum("count")).values_list(*cols, "count_sum").order_by():
+                counts[tuple(row[:-1])] += row[-1]
+
+        return counts
+
+    @classmethod
+    def get_range_counts(cls, count_types, begin, end, orgs=None, by=("count_type",)):
+        """
+        Gets counts between the begin and end days inclusive, reading any whole months from the monthly rollups. Since
+        months are coarser than days, by can't include day.
+        """
+        months_start = begin if begin.day == 1 else begin.replace(day=1) + relativedelta(months=1)
+        months_end = (end + timedelta(days=1)).replace(day=1)
+
+        if months_start >= months_end:
+            return cls.get_counts(cls.PERIOD_DAILY, count_types, begin, end, orgs, by)
+
+        one_day = timedelta(days=1)
+
+        counts = cls.get_counts(cls.PERIOD_MONTHLY, count_types, months_start, months_end - one_day, orgs, by)
+        if begin < months_start:
+            counts.update(cls.get_counts(cls.PERIOD_DAILY, count_types, begin, months_start - one_day, orgs, by))
+        if months_end <= end:
+            counts.update(cls.get_counts(cls.PERIOD_DAILY, count_types, months_end, end, orgs, by))
+
+        return counts
 
     class Meta:
-        index_together = ["channel", "count_type", "day"]
+        index_together = ["org", "period", "day"]
 
 
 class ChannelEvent(models.Model):
@@ -8,7 +8,7 @@ from celery.task import task
 
 from temba.utils.celery import nonoverlapping_task
 
-from .models import Alert, Channel, ChannelCount, ChannelLog, SyncEvent
+from .models import Alert, Channel, ChannelCount, ChannelCountRollup, ChannelLog, SyncEvent
 
 logger = logging.getLogger(__name__)
 
@@ -80,3 +80,4 @@ def trim_channel_log_task():  # pragma: needs cover
 )
 def squash_channelcounts():
     ChannelCount.squash()
+    ChannelCountRollup.squash()
@@ -3,7 +3,7 @@ import copy
 import hashlib
 import hmac
 import time
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from unittest.mock import call, patch
 from urllib.parse import quote
 
@@ -30,7 +30,7 @@ from temba.triggers.models import Trigger
 from temba.utils import dict_to_struct, get_anonymous_user, json
 from temba.utils.dates import datetime_to_ms, ms_to_datetime
 
-from .models import Alert, Channel, ChannelCount, ChannelEvent, ChannelLog, SyncEvent
+from .models import Alert, Channel, ChannelCount, ChannelCountRollup, ChannelEvent, ChannelLog, SyncEvent
 from .tasks import check_channels_task, squash_channelcounts, sync_old_seen_channels_task, trim_sync_events_task
 
 
@@ -2235,6 +2235,66 @@ class ChannelCountTest(TembaTest):
         calculated_count = ChannelCount.get_day_count(channel, count_type, day)
         self.assertEqual(assert_count, calculated_count)
 
+    def test_rollups(self):
+        twitter = Channel.create(self.org, self.admin, None, "TT", "Twitter", "nyaruka")
+
+        def add_count(channel, count_type, day, count):
+            ChannelCount.objects.create(channel=channel, count_type=count_type, day=day, count=count)
+
+        def get_daily_counts(orgs=None):
+            return ChannelCountRollup.get_counts(
+                ChannelCountRollup.PERIOD_DAILY, ChannelCount.ROLLUP_TYPES, date(2019, 1, 1), date(2019, 12, 31), orgs
+            )
+
+        def get_range_counts(begin, end):
+            return ChannelCountRollup.get_range_counts(ChannelCount.ROLLUP_TYPES, begin, end, by=("channel_type",))
+
+        add_count(self.channel, ChannelCount.INCOMING_MSG_TYPE, date(2019, 1, 31), 3)
+        add_count(self.channel, ChannelCount.INCOMING_MSG_TYPE, date(2019, 2, 1), 2)
+        add_count(self.channel, ChannelCount.ERROR_LOG_TYPE, date(2019, 2, 1), 1)
+        add_count(twitter, ChannelCount.OUTGOING_MSG_TYPE, date(2019, 2, 15), 4)
+
+        expected = {
+            (date(2019, 1, 31), ChannelCount.INCOMING_MSG_TYPE): 3,
+            (date(2019, 2, 1), ChannelCount.INCOMING_MSG_TYPE): 2,
+            (date(2019, 2, 15), ChannelCount.OUTGOING_MSG_TYPE): 4,
+        }
+
+        # counts which haven't been rolled up yet are included
+        self.assertFalse(ChannelCountRollup.objects.exists())
+        self.assertEqual(expected, get_daily_counts())
+        self.assertEqual({("A",): 5, ("TT",): 4}, get_range_counts(date(2019, 1, 31), date(2019, 2, 28)))
+
+        squash_channelcounts()
+
+        # squashing rolls up counts by day and month, excluding log counts
+        self.assertEqual(6, ChannelCountRollup.objects.filter(is_squashed=True).count())
+        self.assertEqual(
+            [("A", "IM", date(2019, 1, 1), 3), ("A", "IM", date(2019, 2, 1), 2), ("TT", "OM", date(2019, 2, 1), 4)],
+            list(
+                ChannelCountRollup.objects.filter(period=ChannelCountRollup.PERIOD_MONTHLY)
+                .order_by("channel_type", "day")
+                .values_list("channel_type", "count_type", "day", "count")
+            ),
+        )
+        self.assertEqual(expected, get_daily_counts())
+
+        # squashing a set which already has a squashed count only rolls up the new delta
+        add_count(self.channel, ChannelCount.INCOMING_MSG_TYPE, date(2019, 2, 1), 5)
+        squash_channelcounts()
+
+        expected[(date(2019, 2, 1), ChannelCount.INCOMING_MSG_TYPE)] = 7
+        self.assertEqual(expected, get_daily_counts())
+
+        # whole months are read from monthly rollups and the remaining days from daily rollups
+        self.assertEqual({("A",): 10, ("TT",): 4}, get_range_counts(date(2019, 1, 31), date(2019, 2, 28)))
+        self.assertEqual({("A",): 7}, get_range_counts(date(2019, 2, 1), date(2019, 2, 14)))
+        self.assertEqual({("A",): 3}, get_range_counts(date(2019, 1, 1), date(2019, 1, 31)))
+
+        # counts can be limited to orgs
+        self.assertEqual(expected, get_daily_counts(orgs=[self.org.id]))
+        self.assertEqual({}, get_daily_counts(orgs=[self.org2.id]))
+
     def test_daily_counts(self):
         self.admin.set_org(self.org)
 
@@ -2136,6 +2136,7 @@ class ChannelEventCRUDL(SmartCRUDL):
         fields = ("contact", "event_type", "channel", "occurred_on")
         default_order = "-occurred_on"
         search_fields = ("contact__urns__path__icontains", "contact__name__icontains")
+        search_contact_field = None
         system_label = SystemLabel.TYPE_CALLS
         select_related = ("contact", "channel")
 
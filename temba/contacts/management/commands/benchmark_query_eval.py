@@ -0,0 +1,63 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from temba.contacts.models import Contact
+from temba.contacts.search import SearchException, parse_query
+from temba.orgs.models import Org
+
+
+class Command(BaseCommand):  # pragma: no cover
+    help = "Compares tree walking and compiled evaluation of a contact query against the contacts of an org"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--org", type=int, action="store", dest="org_id", required=True, help="ID of org")
+        parser.add_argument("--query", type=str, action="store", dest="query", required=True, help="Query to test")
+        parser.add_argument(
+            "--contacts", type=int, action="store", dest="num_contacts", default=10000, help="Max contacts to test"
+        )
+
+    def handle(self, org_id, query, num_contacts, *args, **options):
+        org = Org.objects.get(id=org_id)
+
+        try:
+            parsed = parse_query(query, as_anon=org.is_anon)
+        except SearchException as e:
+            raise CommandError(f"Invalid query: {str(e)}")
+
+        contacts = (
+            Contact.objects.filter(org=org, is_active=True).prefetch_related("urns").order_by("id")[:num_contacts]
+        )
+        contact_jsons = []
+        for contact in contacts:
+            contact.org = org
+            contact_jsons.append(contact.as_search_json())
+
+        self.stdout.write(f"Evaluating '{parsed.as_text()}' against {len(contact_jsons)} contacts...")
+
+        start = time.perf_counter()
+        walked = [parsed.evaluate(org, j) for j in contact_jsons]
+        walk_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        matcher = parsed.compile(org)
+        compile_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        compiled = [matcher(j) for j in contact_jsons]
+        compiled_time = time.perf_counter() - start
+
+        if walked != compiled:
+            mismatches = sum(1 for w, c in zip(walked, compiled) if w != c)
+            raise CommandError(f"Compiled evaluation disagrees with tree walk for {mismatches} contacts")
+
+        num = max(len(contact_jsons), 1)
+
+        self.stdout.write(f" > matches: {sum(compiled)}")
+        self.stdout.write(f" > tree walk: {walk_time * 1000:.1f}ms ({walk_time * 1_000_000 / num:.1f}µs per contact)")
+        self.stdout.write(
+            f" > compiled: {compiled_time * 1000:.1f}ms ({compiled_time * 1_000_000 / num:.1f}µs per contact) "
+            f"+ {compile_time * 1000:.1f}ms to compile"
+        )
+        if compiled_time:
+            self.stdout.write(f" > speedup: {walk_time / compiled_time:.1f}x")
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.4 on 2019-11-20 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("contacts", "0104_remove_contact_is_test")]
+
+    operations = [
+        migrations.AddField(
+            model_name="contactgroup",
+            name="evaluated_on",
+            field=models.DateTimeField(
+                help_text="When this dynamic group was last evaluated against modified contacts", null=True
+            ),
+        )
+    ]
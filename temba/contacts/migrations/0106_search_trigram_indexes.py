@@ -0,0 +1,25 @@
+# Generated by Django 2.2.4 on 2019-12-02 10:21
+
+from django.contrib.postgres.operations import BtreeGinExtension, TrigramExtension
+from django.db import migrations
+
+# trigram indexes on the uppercased values since that's what icontains lookups compare, scoped by org so that a search
+# only scans the matches in its own org, and created one statement at a time since concurrent index creation can't run
+# in a transaction
+INDEX_SQL = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS contacts_contact_name_trgm "
+    "ON contacts_contact USING GIN (org_id, UPPER(name) gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS contacts_contacturn_path_trgm "
+    "ON contacts_contacturn USING GIN (org_id, UPPER(path) gin_trgm_ops)",
+]
+
+REVERSE_SQL = ["DROP INDEX IF EXISTS contacts_contact_name_trgm", "DROP INDEX IF EXISTS contacts_contacturn_path_trgm"]
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [("contacts", "0105_contactgroup_evaluated_on")]
+
+    operations = [TrigramExtension(), BtreeGinExtension(), migrations.RunSQL(INDEX_SQL, REVERSE_SQL)]
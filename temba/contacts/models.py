@@ -3,6 +3,7 @@ import logging
 import os
 import time
 import uuid
+from collections import defaultdict
 from decimal import Decimal
 from itertools import chain
 
@@ -31,7 +32,15 @@ from temba.utils.dates import str_to_datetime
 from temba.utils.export import BaseExportAssetStore, BaseExportTask, TableExporter
 from temba.utils.languages import _get_language_name_iso6393
 from temba.utils.locks import NonBlockingLock
-from temba.utils.models import JSONField, RequireUpdateFieldsMixin, SquashableModel, TembaModel, mapEStoDB
+from temba.utils.models import (
+    JSONField,
+    RequireUpdateFieldsMixin,
+    SquashableModel,
+    TembaModel,
+    iter_keyset_batches,
+    mapEStoDB,
+)
+from temba.utils.sheets import get_file_type, iter_rows, read_header
 from temba.utils.text import truncate
 from temba.utils.urns import ParsedURN, parse_urn
 from temba.values.constants import Value
@@ -435,6 +444,9 @@ class ContactField(SmartModel):
     EXPORT_NAME = "name"
     EXPORT_TYPE = "type"
 
+    # redis key of a token which changes whenever any of an org's fields change, used to invalidate local caches
+    CACHE_VERSION_KEY = "contactfields_version:%d"
+
     GOFLOW_TYPES = {
         Value.TYPE_TEXT: "text",
         Value.TYPE_NUMBER: "number",
@@ -642,6 +654,35 @@ class ContactField(SmartModel):
             ContactField.EXPORT_TYPE: ContactField.GOFLOW_TYPES[self.value_type],
         }
 
+    @classmethod
+    def get_cache_version(cls, org):
+        """
+        Gets the current cache version token for the fields of the given org
+        """
+        r = get_redis_connection()
+        key = cls.CACHE_VERSION_KEY % org.id
+
+        version = r.get(key)
+        if version is None:
+            r.set(key, uuid.uuid4().hex, nx=True)
+            version = r.get(key)
+
+        return version.decode()
+
+    @classmethod
+    def bump_cache_version(cls, org_id):
+        """
+        Invalidates anything cached against the fields of the given org
+        """
+        r = get_redis_connection()
+        r.set(cls.CACHE_VERSION_KEY % org_id, uuid.uuid4().hex)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        org_id = self.org_id
+        on_transaction_commit(lambda: ContactField.bump_cache_version(org_id))
+
     def release(self, user):
         self.is_active = False
         self.modified_by = user
@@ -702,6 +743,9 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
     ID = "id"
     CREATED_ON_TITLE = "created on"
 
+    # number of rows resolved and imported at a time
+    IMPORT_BATCH_SIZE = 1000
+
     RESERVED_ATTRIBUTES = {
         ID,
         NAME,
@@ -782,24 +826,30 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
         return obj
 
     @classmethod
-    def query_summary(cls, org, query, max_results=10):
+    def query_summary(cls, org, query, max_results=10, after=None):
+        """
+        Gets the total and a page of the contacts matching the given query, along with the sort values to fetch the
+        next page after, if there is one
+        """
         from .search import contact_es_search
         from temba.utils.es import ES
 
         search_object, parsed_query = contact_es_search(org, query)
-        results = search_object.source(include=["id"]).using(ES)[0:max_results].execute()
+        results, next_after = search_object.source(include=["id"]).using(ES).search_after(after, size=max_results)
         contact_sample = list(mapEStoDB(Contact, results))
-        return {"total": results.hits.total, "sample": contact_sample, "query": parsed_query}
+        return {"total": results.hits.total, "sample": contact_sample, "query": parsed_query, "next": next_after}
 
     @classmethod
     def query_elasticsearch_for_ids(cls, org, query, group=None):
+        """
+        Returns a sorted array of the ids of all contacts matching the given query
+        """
         from .search import contact_es_search, SearchException
         from temba.utils.es import ES
 
         try:
             search_object, _ = contact_es_search(org, query, group)
-            es_search = search_object.source(include=["id"]).using(ES).scan()
-            return mapEStoDB(Contact, es_search, only_ids=True)
+            return search_object.using(ES).scan_ids(sort=True)
         except SearchException:
             logger.error("Error evaluating query", exc_info=True)
             raise  # reraise the exception
@@ -942,25 +992,31 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
         """
         Given the passed in contact field object, returns the value (as a string) for this contact or None.
         """
-        json_value = self.get_field_json(field)
+        return self.serialize_field_json(field.value_type, self.get_field_json(field))
+
+    @staticmethod
+    def serialize_field_json(value_type, json_value):
+        """
+        Given the JSON value of a field of the given value type, returns the value as a string or None
+        """
         if not json_value:
             return
 
-        if field.value_type == Value.TYPE_TEXT:
+        if value_type == Value.TYPE_TEXT:
             return json_value.get(ContactField.TEXT_KEY)
-        elif field.value_type == Value.TYPE_DATETIME:
+        elif value_type == Value.TYPE_DATETIME:
             return json_value.get(ContactField.DATETIME_KEY)
-        elif field.value_type == Value.TYPE_NUMBER:
+        elif value_type == Value.TYPE_NUMBER:
             dec_value = json_value.get(ContactField.NUMBER_KEY, json_value.get("decimal"))
             return format_number(Decimal(dec_value)) if dec_value is not None else None
-        elif field.value_type == Value.TYPE_STATE:
+        elif value_type == Value.TYPE_STATE:
             return json_value.get(ContactField.STATE_KEY)
-        elif field.value_type == Value.TYPE_DISTRICT:
+        elif value_type == Value.TYPE_DISTRICT:
             return json_value.get(ContactField.DISTRICT_KEY)
-        elif field.value_type == Value.TYPE_WARD:
+        elif value_type == Value.TYPE_WARD:
             return json_value.get(ContactField.WARD_KEY)
 
-        raise ValueError("unknown contact field value type: %s", field.value_type)
+        raise ValueError("unknown contact field value type: %s", value_type)
 
     def get_field_value(self, field):
         """
@@ -1124,7 +1180,7 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
         if has_changed:
             self.handle_update(fields=[field.key])
 
-    def set_fields(self, user, fields):
+    def set_fields(self, user, fields, update_campaigns=True):
         if self.fields is None:
             self.fields = {}
 
@@ -1185,14 +1241,17 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
         self.modified_on = modified_on
 
         if changed_field_keys:
-            self.handle_update(fields=list(fields.keys()))
+            self.handle_update(fields=list(fields.keys()), update_campaigns=update_campaigns)
 
-    def handle_update(self, urns=(), fields=None, group=None, is_new=False):
+    def handle_update(self, urns=(), fields=None, group=None, is_new=False, update_campaigns=True):
         """
         Handles an update to a contact which can be one of
           1. A change to one or more attributes
           2. A change to the specified contact field
           3. A manual change to a group membership
+
+        If update_campaigns is false, the changed fields and groups are recorded on the contact so that the caller can
+        update campaigns for many contacts at once with EventFire.update_events_for_contacts
         """
         changed_groups = set([group]) if group else set()
 
@@ -1200,6 +1259,11 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
             # ensure dynamic groups are up to date
             changed_groups.update(self.reevaluate_dynamic_groups(for_fields=fields, urns=urns))
 
+        if not update_campaigns:
+            self.campaign_fields = getattr(self, "campaign_fields", set()).union(fields or ())
+            self.campaign_groups = getattr(self, "campaign_groups", set()).union(changed_groups)
+            return
+
         # ensure our campaigns are up to date
         from temba.campaigns.models import EventFire
 
@@ -1277,7 +1341,17 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
 
     @classmethod
     def get_or_create_by_urns(
-        cls, org, user, name=None, urns=None, channel=None, uuid=None, language=None, force_urn_update=False, auth=None
+        cls,
+        org,
+        user,
+        name=None,
+        urns=None,
+        channel=None,
+        uuid=None,
+        language=None,
+        force_urn_update=False,
+        auth=None,
+        update_campaigns=True,
     ):
         """
         Gets or creates a contact with the given URNs
@@ -1348,7 +1422,7 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
                         if updated_attrs:
                             contact.save(update_fields=updated_attrs + ["modified_on"], handle_update=False)
                         # handle group and campaign updates
-                        contact.handle_update(fields=updated_attrs)
+                        contact.handle_update(fields=updated_attrs, update_campaigns=update_campaigns)
                         return contact
 
         # perform everything in a org-level lock to prevent duplication by different instances
@@ -1421,7 +1495,9 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
             analytics.gauge("temba.contact_created")
 
         # handle group and campaign updates
-        contact.handle_update(fields=updated_attrs, urns=updated_urns, is_new=contact.is_new)
+        contact.handle_update(
+            fields=updated_attrs, urns=updated_urns, is_new=contact.is_new, update_campaigns=update_campaigns
+        )
         return contact
 
     @classmethod
@@ -1432,9 +1508,25 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
         if "org" not in field_dict or "created_by" not in field_dict:
             raise ValueError("Import fields dictionary must include org and created_by")
 
+        org = field_dict["org"]
+        is_admin = org.administrators.filter(id=field_dict["created_by"].id).exists()
+        row = cls.parse_import_row(field_dict, is_admin)
+
+        # if this is an anonymous org, don't allow updating
+        if org.is_anon and not is_admin:
+            for urn in row["urns"]:
+                if Contact.from_urn(org, urn, org.get_country_code()):
+                    raise SmartImportRowError("Other existing contact on anonymous organization")
+
+        return cls.import_row(row)
+
+    @classmethod
+    def parse_import_row(cls, field_dict, is_admin):
+        """
+        Validates the given import field values and parses them into a row of normalized URNs, attributes and fields
+        """
         org = field_dict.pop("org")
         user = field_dict.pop("created_by")
-        is_admin = org.administrators.filter(id=user.id).exists()
         uuid = field_dict.pop("contact uuid", None)
 
         # for backward compatibility
@@ -1494,12 +1586,6 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
             if not URN.validate(urn):
                 raise SmartImportRowError(f"Invalid URN: {value}")
 
-            search_contact = Contact.from_urn(org, urn, country)
-
-            # if this is an anonymous org, don't allow updating
-            if org.is_anon and search_contact and not is_admin:
-                raise SmartImportRowError("Other existing contact on anonymous organization")
-
             urns.append(urn)
 
         if not urns and not (org.is_anon or uuid):
@@ -1519,22 +1605,6 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
         if language is not None and _get_language_name_iso6393(language) is None:
             raise SmartImportRowError(f"Language: '{language}' is not a valid ISO639-3 code")
 
-        # if this is just a UUID import, look up the contact directly
-        if uuid and not urns and not language and not name:
-            contact = Contact.objects.filter(uuid=uuid).first()
-            if not contact:
-                raise SmartImportRowError(f"No contact found with uuid: {uuid}")
-
-        else:
-            # create new contact or fetch existing one
-            contact = Contact.get_or_create_by_urns(
-                org, user, name, uuid=uuid, urns=urns, language=language, force_urn_update=True
-            )
-
-        # if they exist and are blocked, unblock them
-        if contact.is_blocked:
-            contact.unblock(user)
-
         # ignore any reserved fields or URN schemes
         valid_keys = (
             key
@@ -1556,10 +1626,212 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
 
             valid_field_dict.update({key: value})
 
-        contact.set_fields(user, valid_field_dict)
+        return dict(org=org, user=user, uuid=uuid, urns=urns, name=name, language=language, fields=valid_field_dict)
+
+    @classmethod
+    def import_row(cls, row):
+        """
+        Creates or updates the contact for a single parsed import row
+        """
+        org, user, uuid, urns, name, language = (
+            row["org"],
+            row["user"],
+            row["uuid"],
+            row["urns"],
+            row["name"],
+            row["language"],
+        )
+
+        # if this is just a UUID import, look up the contact directly
+        if uuid and not urns and not language and not name:
+            contact = Contact.objects.filter(uuid=uuid).first()
+            if not contact:
+                raise SmartImportRowError(f"No contact found with uuid: {uuid}")
+
+        else:
+            # create new contact or fetch existing one
+            contact = Contact.get_or_create_by_urns(
+                org, user, name, uuid=uuid, urns=urns, language=language, force_urn_update=True, update_campaigns=False
+            )
+
+        # if they exist and are blocked, unblock them
+        if contact.is_blocked:
+            contact.unblock(user)
+
+        # campaigns are updated for all imported contacts at once
+        contact.set_fields(user, row["fields"], update_campaigns=False)
 
         return contact
 
+    @classmethod
+    def import_batch(cls, org, user, is_admin, rows, log=None):
+        """
+        Imports a batch of parsed rows, given as tuples of (line number, row, raw values). URNs for the whole batch are
+        resolved with a single query, contacts which don't exist yet are created in bulk with their URNs and fields,
+        and rows whose URNs all belong to a single existing contact are updated in place. Anything else, e.g. rows with
+        URNs that belong to different contacts or to no contact, or rows which overlap with an earlier row in the
+        batch, are imported one by one.
+        Returns the imported contacts in row order and a list of row errors.
+        """
+        identities = {URN.identity(urn) for _, row, _ in rows for urn in row["urns"]}
+        existing_urns = {}
+        for urn in ContactURN.objects.filter(org=org, identity__in=identities).select_related("contact"):
+            existing_urns[urn.identity] = urn
+
+        contacts = [None] * len(rows)
+        errors = []
+        new_rows, existing_rows, single_rows = [], [], []
+        seen = set()
+
+        for index, (line, row, values) in enumerate(rows):
+            row_identities = [URN.identity(urn) for urn in row["urns"]]
+            row_urns = [existing_urns.get(identity) for identity in row_identities]
+            owners = {urn.contact for urn in row_urns if urn and urn.contact}
+
+            # if this is an anonymous org, don't allow updating
+            if org.is_anon and not is_admin and any(c.is_active for c in owners):
+                errors.append(dict(line=line, error="Other existing contact on anonymous organization"))
+                continue
+
+            # rows which overlap with an earlier row must be imported after it, and twitter URNs need special lookups
+            keys = set(row_identities) | {f"contact:{c.id}" for c in owners}
+            if row["uuid"]:
+                keys.add(f"uuid:{row['uuid']}")
+
+            is_simple = not seen.intersection(keys) and not any(
+                u.startswith(f"{TWITTER_SCHEME}:") for u in row["urns"]
+            )
+            seen.update(keys)
+
+            if is_simple and not row["uuid"] and row["urns"] and not any(row_urns):
+                new_rows.append((index, line, row, values))
+            elif is_simple and row["urns"] and all(u and u.contact for u in row_urns) and len(owners) == 1:
+                owner = next(iter(owners))
+                if owner.is_active and (not row["uuid"] or row["uuid"] == owner.uuid):
+                    existing_rows.append((index, owner, row))
+                else:
+                    single_rows.append((index, line, row, values))
+            else:
+                single_rows.append((index, line, row, values))
+
+        has_dynamic_groups = ContactGroup.get_user_groups(org, dynamic=True).exists()
+
+        if new_rows:
+            try:
+                with transaction.atomic():
+                    created = cls._create_for_import(org, user, [r[2] for r in new_rows])
+            except IntegrityError:
+                # one of the URNs was created by someone else since we looked, so fall back to one by one
+                single_rows = sorted(single_rows + new_rows, key=lambda r: r[0])
+                created = []
+
+            for (index, line, row, values), contact in zip(new_rows, created):
+                analytics.gauge("temba.contact_created")
+
+                fields = [Contact.NAME, Contact.LANGUAGE, Contact.CREATED_ON]
+                fields.extend(key for key, value in row["fields"].items() if value is not None and value != "")
+
+                if has_dynamic_groups:
+                    contact.handle_update(fields=fields, urns=row["urns"], is_new=True, update_campaigns=False)
+                else:
+                    contact.campaign_fields = set(fields)
+
+                contacts[index] = contact
+
+        if existing_rows:
+            modified_on = timezone.now()
+            to_update = []
+
+            for index, contact, row in existing_rows:
+                contact.org = org
+                contact.is_new = False
+                if row["name"] or row["language"]:
+                    contact.name = row["name"][:128] if row["name"] else contact.name
+                    contact.language = row["language"] or contact.language
+                    contact.modified_on = modified_on
+                    to_update.append(contact)
+
+            Contact.objects.bulk_update(to_update, ("name", "language", "modified_on"))
+
+            for index, contact, row in existing_rows:
+                updated_attrs = [a for a in (Contact.NAME, Contact.LANGUAGE) if row[a]]
+
+                if has_dynamic_groups:
+                    contact.handle_update(fields=updated_attrs, urns=row["urns"], update_campaigns=False)
+                else:
+                    contact.campaign_fields = set(updated_attrs)
+
+                if contact.is_blocked:
+                    contact.unblock(user)
+
+                contact.set_fields(user, row["fields"], update_campaigns=False)
+                contacts[index] = contact
+
+        for index, line, row, values in single_rows:
+            try:
+                contacts[index] = cls.import_row(row)
+
+            except SmartImportRowError as e:
+                errors.append(dict(line=line, error=str(e)))
+
+            except Exception as e:  # pragma: needs cover
+                if log:
+                    import traceback
+
+                    traceback.print_exc(limit=100, file=log)
+                raise Exception("Line %d: %s\n\n%s" % (line, str(e), str(values)))
+
+        return [c for c in contacts if c is not None], errors
+
+    @classmethod
+    def _create_for_import(cls, org, user, rows):
+        """
+        Bulk creates new contacts with their URNs and field values for the given import rows
+        """
+        fields_by_key = {}
+        contacts = []
+
+        for row in rows:
+            contact = Contact(
+                org=org, name=row["name"][:128] if row["name"] else None, language=row["language"], created_by=user
+            )
+            contact.fields = {}
+            contact.is_new = True
+
+            values = {}
+            for key, value in row["fields"].items():
+                if key not in fields_by_key:
+                    fields_by_key[key] = ContactField.get_or_create(org, user, key)
+
+                if value is not None and value != "":
+                    field = fields_by_key[key]
+                    values[str(field.uuid)] = contact.serialize_field(field, value)
+
+            contact.fields = values or None
+            contacts.append(contact)
+
+        Contact.objects.bulk_create(contacts)
+
+        urns = []
+        for contact, row in zip(contacts, rows):
+            for urn in row["urns"]:
+                scheme, path, query, display = URN.to_parts(urn)
+                urns.append(
+                    ContactURN(
+                        org=org,
+                        contact=contact,
+                        priority=ContactURN.PRIORITY_DEFAULTS.get(scheme, ContactURN.PRIORITY_STANDARD),
+                        scheme=scheme,
+                        path=path,
+                        identity=URN.from_parts(scheme, path),
+                        display=display,
+                    )
+                )
+
+        ContactURN.objects.bulk_create(urns)
+
+        return contacts
+
     @classmethod
     def prepare_fields(cls, field_dict, import_params=None, user=None):
         if not import_params or "org_id" not in import_params or "extra_fields" not in import_params:
@@ -1620,10 +1892,14 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
         out_file.write(csv_file.read())
         out_file.close()
 
+        # uploaded files don't necessarily have an extension so give it the one matching its contents
+        typed_tmp_file = f"{tmp_file}.{get_file_type(tmp_file)}"
+        os.rename(tmp_file, typed_tmp_file)
+
         try:
-            headers = SmartModel.get_import_file_headers(open(tmp_file))
+            headers = [cls.normalize_value(str(h)).lower() for h in read_header(typed_tmp_file)]
         finally:
-            os.remove(tmp_file)
+            os.remove(typed_tmp_file)
 
         Contact.validate_org_import_header(headers, org)
 
@@ -1694,17 +1970,14 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
 
     @classmethod
     def import_excel(cls, filename, user, import_params, log=None, import_results=None):
-
-        import pyexcel
-
-        sheet_data = pyexcel.get_array(file_name=filename.name)
+        rows = iter_rows(filename.name)
 
         line_number = 0
 
-        header = sheet_data[line_number]
+        header = next(rows, ())
         line_number += 1
-        while header is not None and len(header[0]) > 1 and header[0][0] == "#":  # pragma: needs cover
-            header = sheet_data[line_number]
+        while header and len(header[0]) > 1 and header[0][0] == "#":  # pragma: needs cover
+            header = next(rows, ())
             line_number += 1
 
         # do some sanity checking to make sure they uploaded the right kind of file
@@ -1717,12 +1990,18 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
         cls.validate_import_header(header)
 
         records = []
-        num_errors = 0
         error_messages = []
+        batch = []
+        org, is_admin = None, False
+
+        def flush_batch():
+            contacts, errors = cls.import_batch(org, user, is_admin, batch, log)
+            records.extend(contacts)
+            error_messages.extend(errors)
 
-        sheet_data_records = sheet_data[line_number:]
+            logger.info(f"imported {len(records)} contacts with {len(error_messages)} errors for org #{org.id}")
 
-        for row in sheet_data_records:
+        for row in rows:
             # trim all our values
             row_data = []
             for cell in row:
@@ -1746,11 +2025,12 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
             try:
 
                 field_values = cls.prepare_fields(field_values, import_params, user)
-                record = cls.create_instance(field_values)
-                if record:
-                    records.append(record)
-                else:  # pragma: needs cover
-                    num_errors += 1
+
+                if not org:
+                    org = field_values["org"]
+                    is_admin = org.administrators.filter(id=user.id).exists()
+
+                batch.append((line_number, cls.parse_import_row(field_values, is_admin), log_field_values))
 
             except SmartImportRowError as e:
                 error_messages.append(dict(line=line_number, error=str(e)))
@@ -1762,13 +2042,41 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
                     traceback.print_exc(limit=100, file=log)
                 raise Exception("Line %d: %s\n\n%s" % (line_number, str(e), str(log_field_values)))
 
+            if len(batch) == cls.IMPORT_BATCH_SIZE:
+                flush_batch()
+                batch = []
+
+        if batch:
+            flush_batch()
+
+        # errors from rows imported one by one in a batch are found after those from other rows
+        error_messages.sort(key=lambda e: e["line"])
+
         if import_results is not None:
             import_results["records"] = len(records)
-            import_results["errors"] = num_errors + len(error_messages)
+            import_results["errors"] = len(error_messages)
             import_results["error_messages"] = error_messages
 
         return records
 
+    @classmethod
+    def update_campaigns_for_import(cls, contacts):
+        """
+        Updates campaign events for imported contacts in batches of contacts which had the same fields and groups
+        changed, so that a contact's events are only rescheduled for its own changes
+        """
+        from temba.campaigns.models import EventFire
+
+        contacts_by_changes = defaultdict(list)
+        for contact in contacts:
+            fields = frozenset(getattr(contact, "campaign_fields", ()))
+            groups = frozenset(getattr(contact, "campaign_groups", ()))
+            contacts_by_changes[(fields, groups)].append(contact)
+
+        for (fields, groups), changed in contacts_by_changes.items():
+            for batch in chunk_list(changed, 1000):
+                EventFire.update_events_for_contacts(batch[0].org, batch, fields=fields, groups=groups)
+
     @classmethod
     def finalize_import(cls, task, records):
         for chunk in chunk_list(records, 1000):
@@ -1776,8 +2084,6 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
 
     @classmethod
     def import_csv(cls, task, log=None):
-        import pyexcel
-
         filename = task.csv_file.file
         user = task.created_by
 
@@ -1808,18 +2114,12 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
         out_file.write(filename.read())
         out_file.close()
 
-        # convert the file to CSV
-        csv_tmp_file = os.path.join(settings.MEDIA_ROOT, "tmp/%s.csv" % str(uuid4()))
-
-        pyexcel.save_as(file_name=out_file.name, dest_file_name=csv_tmp_file)
-
         import_results = dict()
 
         try:
             contacts = cls.import_excel(open(tmp_file), user, import_params, log, import_results)
         finally:
             os.remove(tmp_file)
-            os.remove(csv_tmp_file)
 
         # save the import results even if no record was created
         task.import_results = json.dumps(import_results)
@@ -1828,6 +2128,8 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
         if not contacts:
             return contacts
 
+        cls.update_campaigns_for_import(contacts)
+
         # we always create a group after a successful import (strip off 8 character uniquifier by django)
         group_name = os.path.splitext(os.path.split(import_params.get("original_filename"))[-1])[0]
         group_name = group_name.replace("_", " ").replace("-", " ").title()
@@ -1841,15 +2143,13 @@ class Contact(RequireUpdateFieldsMixin, TembaModel):
             group_org, user, group_name, status=ContactGroup.STATUS_INITIALIZING, task=task
         )
 
-        num_creates = 0
-        for contact in contacts:
-            # if contact has is_new attribute, then we have created a new contact rather than updated an existing one
-            if getattr(contact, "is_new", False):
-                num_creates += 1
+        # if contact has is_new attribute, then we have created a new contact rather than updated an existing one
+        num_creates = len([c for c in contacts if getattr(c, "is_new", False)])
 
-            # do not add blocked or stopped contacts
-            if not contact.is_stopped and not contact.is_blocked:
-                group.contacts.add(contact)
+        # do not add blocked or stopped contacts
+        members = [c for c in contacts if not c.is_stopped and not c.is_blocked]
+        for batch in chunk_list(members, 1000):
+            group.contacts.add(*batch)
 
         # group is now ready to be used in a flow starts etc
         group.status = ContactGroup.STATUS_READY
@@ -2500,6 +2800,12 @@ class ContactGroup(TembaModel):
     STATUS_CHOICES = [(s[0], s[1]) for s in STATUS_CONFIG]
 
     REEVALUATE_LOCK_KEY = "contactgroup_reevaluating_%d"
+    REEVALUATE_TIMEOUT = 3600
+    REEVALUATE_BATCH_SIZE = 1000
+
+    # how far back from the previous evaluation we look for modified contacts when re-evaluating incrementally, to
+    # catch contacts modified in transactions which hadn't committed when that evaluation ran
+    REEVALUATE_OVERLAP = datetime.timedelta(minutes=5)
 
     EXPORT_UUID = "uuid"
     EXPORT_NAME = "name"
@@ -2534,6 +2840,10 @@ class ContactGroup(TembaModel):
 
     query_fields = models.ManyToManyField(ContactField, verbose_name=_("Query Fields"))
 
+    evaluated_on = models.DateTimeField(
+        null=True, help_text=_("When this dynamic group was last evaluated against modified contacts")
+    )
+
     # define some custom managers to do the filtering of user / system groups for us
     all_groups = models.Manager()
     system_groups = SystemContactGroupManager()
@@ -2666,6 +2976,7 @@ class ContactGroup(TembaModel):
         Adds or removes contacts from this group - used for both non-dynamic and dynamic groups
         """
         changed = set()
+        changed_contacts = []
         group_contacts = self.contacts.all()
 
         for contact in contacts:
@@ -2686,9 +2997,15 @@ class ContactGroup(TembaModel):
 
             if contact_changed:
                 changed.add(contact.pk)
-                contact.handle_update(group=self)
+                changed_contacts.append(contact)
 
         if changed:
+            # ensure our campaigns are up to date
+            from temba.campaigns.models import EventFire
+
+            for batch in chunk_list(changed_contacts, 1000):
+                EventFire.update_events_for_contacts(self.org, batch, groups=[self])
+
             # update modified on in small batches to avoid long table lock, and having too many non-unique values for
             # modified_on which is the primary ordering for the API
             for batch in chunk_list(changed, 100):
@@ -2733,13 +3050,14 @@ class ContactGroup(TembaModel):
         if reevaluate:
             on_transaction_commit(lambda: reevaluate_dynamic_group.delay(self.id))
 
-    def reevaluate(self):
+    def reevaluate(self, incremental=False):
         """
-        Re-evaluates the contacts in a dynamic group
+        Re-evaluates the contacts in a dynamic group. If incremental is set and this group has already been evaluated
+        then only contacts modified since that evaluation are considered.
         """
 
         lock_key = ContactGroup.REEVALUATE_LOCK_KEY % self.id
-        lock_timeout = 3600
+        lock_timeout = ContactGroup.REEVALUATE_TIMEOUT
 
         with NonBlockingLock(redis=get_redis_connection(), name=lock_key, timeout=lock_timeout) as lock:
             lock.exit_if_not_locked()
@@ -2747,6 +3065,12 @@ class ContactGroup(TembaModel):
             if self.status == ContactGroup.STATUS_EVALUATING:
                 raise ValueError("Cannot re-evaluate a group which is currently re-evaluating")
 
+            if incremental and self.status == ContactGroup.STATUS_READY and self.evaluated_on:
+                ContactGroup._reevaluate_incremental(self.org, [self], [lock])
+                return
+
+            evaluated_on = timezone.now()
+
             self.status = ContactGroup.STATUS_EVALUATING
             self.save(update_fields=("status",))
 
@@ -2756,7 +3080,7 @@ class ContactGroup(TembaModel):
             to_add_ids = new_group_members.difference(existing_member_ids)
             to_remove_ids = existing_member_ids.difference(new_group_members)
 
-            from temba.campaigns.models import Campaign
+            from temba.campaigns.models import Campaign, EventFire
 
             has_campaigns = Campaign.objects.filter(org=self.org, group=self).exists()
 
@@ -2768,8 +3092,7 @@ class ContactGroup(TembaModel):
 
                 # if our group is used in a campaign, our contacts need updating
                 if has_campaigns:
-                    for changed_contact in to_add:
-                        changed_contact.handle_update(group=self)
+                    EventFire.update_events_for_contacts(self.org, to_add, groups=[self])
 
                 # update group updated_at
                 self.modified_on = datetime.datetime.now()
@@ -2784,8 +3107,8 @@ class ContactGroup(TembaModel):
 
                 self.contacts.remove(*to_remove)
 
-                for changed_contact in to_remove:
-                    changed_contact.handle_update(group=self)
+                if has_campaigns:
+                    EventFire.update_events_for_contacts(self.org, to_remove, groups=[self])
 
                 # update group updated_at
                 self.modified_on = datetime.datetime.now()
@@ -2795,7 +3118,176 @@ class ContactGroup(TembaModel):
                 lock.extend(additional_time=lock_timeout)
 
             self.status = ContactGroup.STATUS_READY
-            self.save(update_fields=("status", "modified_on"))
+            self.evaluated_on = evaluated_on
+            self.save(update_fields=("status", "evaluated_on", "modified_on"))
+
+    @classmethod
+    def reevaluate_incremental(cls, org, groups):
+        """
+        Incrementally re-evaluates the given dynamic groups of an org together, skipping any which are being
+        re-evaluated elsewhere or which aren't ready and evaluated
+        """
+        r = get_redis_connection()
+        locks = {}
+
+        try:
+            for group in groups:
+                lock = NonBlockingLock(
+                    redis=r, name=cls.REEVALUATE_LOCK_KEY % group.id, timeout=cls.REEVALUATE_TIMEOUT
+                )
+                if lock.acquire(blocking=False):
+                    locks[group.id] = lock
+
+            # now that we hold their locks, re-fetch our groups to check that they're still ready
+            groups = cls.user_groups.filter(id__in=list(locks), status=cls.STATUS_READY).exclude(evaluated_on=None)
+
+            cls._reevaluate_incremental(org, list(groups), list(locks.values()))
+        finally:
+            for lock in locks.values():
+                lock.release()
+
+    @classmethod
+    def _reevaluate_incremental(cls, org, groups, locks):
+        """
+        Re-evaluates the given groups against the contacts modified since their last evaluations, loading each batch of
+        contacts once for all the groups, and applying membership changes in bulk. A group which errors is left to be
+        re-evaluated by the next run without stopping the others.
+        """
+        from .search import compile_query
+        from temba.campaigns.models import Campaign, EventFire
+
+        evaluated_on = timezone.now()
+
+        matchers = {}
+        for group in groups:
+            try:
+                matchers[group] = compile_query(org, group.query)
+            except Exception as e:
+                logger.error(f"Error compiling query for group #{group.id}: {str(e)}", exc_info=True)
+
+        if not matchers:
+            return
+
+        groups = list(matchers.keys())
+        campaign_group_ids = set(Campaign.objects.filter(org=org, group__in=groups).values_list("group_id", flat=True))
+
+        # each group only needs contacts modified since its own last evaluation
+        since = {g: g.evaluated_on - ContactGroup.REEVALUATE_OVERLAP for g in groups}
+        modified_ids = Contact.objects.filter(org=org, modified_on__gt=min(since.values())).values_list(
+            "id", flat=True
+        )
+
+        num_added, num_removed = defaultdict(int), defaultdict(int)
+        failed = set()
+
+        for id_batch in iter_keyset_batches(modified_ids, "id", cls.REEVALUATE_BATCH_SIZE):
+            contacts = list(Contact.objects.filter(id__in=id_batch).prefetch_related("urns"))
+            search_json = {}
+            for contact in contacts:
+                contact.org = org
+
+                # blocked, stopped or deleted contacts can't be in dynamic groups
+                if contact.is_active and not contact.is_blocked and not contact.is_stopped:
+                    search_json[contact.id] = contact.as_search_json()
+
+            member_ids = defaultdict(set)
+            memberships = cls.contacts.through.objects.filter(
+                contactgroup_id__in=[g.id for g in groups], contact_id__in=id_batch
+            ).values_list("contactgroup_id", "contact_id")
+            for group_id, contact_id in memberships:
+                member_ids[group_id].add(contact_id)
+
+            changed_ids = set()
+
+            for group in groups:
+                if group in failed:
+                    continue
+
+                try:
+                    matcher = matchers[group]
+                    candidates = [c for c in contacts if c.modified_on > since[group]]
+                    should_be_member_ids = {
+                        c.id for c in candidates if c.id in search_json and cls._matches(matcher, search_json[c.id])
+                    }
+                    is_member_ids = member_ids[group.id] & {c.id for c in candidates}
+
+                    added_ids = group._bulk_add_contacts(should_be_member_ids - is_member_ids)
+                    removed_ids = group._bulk_remove_contacts(is_member_ids - should_be_member_ids)
+                    group_changed_ids = added_ids | removed_ids
+
+                    # if this group is used in a campaign, its changed contacts need updating
+                    if group_changed_ids and group.id in campaign_group_ids:
+                        EventFire.update_events_for_contacts(
+                            org, Contact.objects.filter(id__in=group_changed_ids), groups=[group]
+                        )
+                except Exception as e:
+                    logger.error(f"Error re-evaluating group #{group.id}: {str(e)}", exc_info=True)
+                    failed.add(group)
+                    continue
+
+                changed_ids.update(group_changed_ids)
+                num_added[group] += len(added_ids)
+                num_removed[group] += len(removed_ids)
+
+            # the next run will see these contacts again, but only once for all of the org's groups, and as their
+            # memberships are now up to date they won't be changed and bumped again
+            if changed_ids:
+                Contact.objects.filter(id__in=changed_ids).update(modified_on=timezone.now())
+
+            for lock in locks:
+                lock.extend(additional_time=cls.REEVALUATE_TIMEOUT)
+
+        for group in groups:
+            if group in failed:
+                continue
+
+            if num_added[group] or num_removed[group]:
+                group.modified_on = timezone.now()
+
+            group.evaluated_on = evaluated_on
+            group.save(update_fields=("evaluated_on", "modified_on"))
+
+            logger.info(
+                f"Incrementally re-evaluated group #{group.id}: added {num_added[group]}, removed {num_removed[group]}"
+            )
+
+    @staticmethod
+    def _matches(matcher, search_json):
+        try:
+            return matcher(search_json)
+        except Exception as e:  # pragma: no cover
+            logger.error(f"Error evaluating query: {str(e)}", exc_info=True)
+            return False
+
+    def _bulk_add_contacts(self, contact_ids):
+        """
+        Adds the given contacts to this group in a single statement, returning the ids of those actually added
+        """
+        if not contact_ids:
+            return set()
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {self.contacts.through._meta.db_table}(contactgroup_id, contact_id) "
+                f"SELECT %s, unnest(%s::int[]) ON CONFLICT DO NOTHING RETURNING contact_id",
+                [self.id, list(contact_ids)],
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def _bulk_remove_contacts(self, contact_ids):
+        """
+        Removes the given contacts from this group in a single statement, returning the ids of those actually removed
+        """
+        if not contact_ids:
+            return set()
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {self.contacts.through._meta.db_table} "
+                f"WHERE contactgroup_id = %s AND contact_id = ANY(%s::int[]) RETURNING contact_id",
+                [self.id, list(contact_ids)],
+            )
+            return {row[0] for row in cursor.fetchall()}
 
     def _get_dynamic_members(self):
         """
@@ -2804,7 +3296,7 @@ class ContactGroup(TembaModel):
         if not self.is_dynamic:  # pragma: no cover
             raise ValueError("Can only be called on dynamic groups")
 
-        from .search import evaluate_query
+        from .search import compile_query
         from temba.utils.es import ES, ModelESSearch
 
         # get the modified_on of the last synced contact
@@ -2832,10 +3324,10 @@ class ContactGroup(TembaModel):
         )
 
         # check if contacts are members of the new group
-        for contact in db_contacts:
-            should_add = evaluate_query(self.org, self.query, contact_json=contact.as_search_json())
+        matcher = compile_query(self.org, self.query)
 
-            if should_add is True:
+        for contact in db_contacts:
+            if matcher(contact.as_search_json()):
                 contact_ids.add(contact.id)
 
         db_contacts_count = db_contacts.count()
@@ -2956,20 +3448,6 @@ class ContactGroupCount(SquashableModel):
     group = models.ForeignKey(ContactGroup, on_delete=models.PROTECT, related_name="counts", db_index=True)
     count = models.IntegerField(default=0)
 
-    @classmethod
-    def get_squash_query(cls, distinct_set):
-        sql = """
-        WITH deleted as (
-            DELETE FROM %(table)s WHERE "group_id" = %%s RETURNING "count"
-        )
-        INSERT INTO %(table)s("group_id", "count", "is_squashed")
-        VALUES (%%s, GREATEST(0, (SELECT SUM("count") FROM deleted)), TRUE);
-        """ % {
-            "table": cls._meta.db_table
-        }
-
-        return sql, (distinct_set.group_id,) * 2
-
     @classmethod
     def get_totals(cls, groups):
         """
@@ -3081,65 +3559,33 @@ class ExportContactsTask(BaseExportTask):
 
         group = self.group or ContactGroup.all_groups.get(org=self.org, group_type=ContactGroup.TYPE_ALL)
 
-        include_group_memberships = bool(self.group_memberships.exists())
-
         if self.search:
-            # cache contact ids
-            contact_ids = list(Contact.query_elasticsearch_for_ids(self.org, self.search, group))
+            contact_ids = Contact.query_elasticsearch_for_ids(self.org, self.search, group)
+            num_contacts = len(contact_ids)
+            id_batches = chunk_list(contact_ids, self.BATCH_SIZE)
         else:
-            contact_ids = group.contacts.order_by("name", "id").values_list("id", flat=True)
+            num_contacts = group.contacts.count()
+            id_batches = self._get_id_batches(group)
 
         # create our exporter
         exporter = TableExporter(self, "Contact", [f["label"] for f in fields] + [g["label"] for g in group_fields])
 
+        # build a function for each column which extracts its value from a row of raw contact data
+        formatters = [self._get_column_formatter(f) for f in fields]
+        include_urns = any(f["urn_scheme"] is not None for f in fields)
+        group_ids = [g["group_id"] for g in group_fields]
+
         total_exported_contacts = 0
         start = time.time()
 
         # write out contacts in batches to limit memory usage
-        for batch_ids in chunk_list(contact_ids, 1000):
-            # fetch all the contacts for our batch
-            batch_contacts = (
-                Contact.objects.filter(id__in=batch_ids).prefetch_related("all_groups").select_related("org")
-            )
-
-            # to maintain our sort, we need to lookup by id, create a map of our id->contact to aid in that
-            contact_by_id = {c.id: c for c in batch_contacts}
-
-            # bulk initialize them
-            Contact.bulk_cache_initialize(self.org, batch_contacts)
-
-            for contact_id in batch_ids:
-                contact = contact_by_id[contact_id]
+        for batch_ids in id_batches:
+            batch = self._get_export_batch(batch_ids, include_urns, group_ids)
 
+            for contact, urns_by_scheme, contact_group_ids in batch:
                 values = []
-                group_values = []
-                for col in range(len(fields)):
-                    field = fields[col]
-
-                    if field["key"] == Contact.NAME:
-                        field_value = contact.name
-                    elif field["key"] == Contact.UUID:
-                        field_value = contact.uuid
-                    elif field["key"] == Contact.LANGUAGE:
-                        field_value = contact.language
-                    elif field["key"] == Contact.CREATED_ON:
-                        field_value = contact.created_on
-                    elif field["key"] == Contact.ID:
-                        field_value = str(contact.id)
-                    elif field["urn_scheme"] is not None:
-                        contact_urns = contact.get_urns()
-                        scheme_urns = []
-                        for urn in contact_urns:
-                            if urn.scheme == field["urn_scheme"]:
-                                scheme_urns.append(urn)
-                        position = field["position"]
-                        if len(scheme_urns) > position:
-                            urn_obj = scheme_urns[position]
-                            field_value = urn_obj.get_display(org=self.org, formatted=False) if urn_obj else ""
-                        else:
-                            field_value = ""
-                    else:
-                        field_value = contact.get_field_display(field["field"])
+                for formatter in formatters:
+                    field_value = formatter(contact, urns_by_scheme)
 
                     if field_value is None:
                         field_value = ""
@@ -3149,11 +3595,7 @@ class ExportContactsTask(BaseExportTask):
 
                     values.append(field_value)
 
-                if include_group_memberships:
-                    contact_groups_ids = [g.id for g in contact.all_groups.all()]
-                    for col in range(len(group_fields)):
-                        field = group_fields[col]
-                        group_values.append(field["group_id"] in contact_groups_ids)
+                group_values = [group_id in contact_group_ids for group_id in group_ids]
 
                 # write this contact's values
                 exporter.write_row(values + group_values)
@@ -3162,15 +3604,15 @@ class ExportContactsTask(BaseExportTask):
                 # output some status information every 10,000 contacts
                 if total_exported_contacts % ExportContactsTask.LOG_PROGRESS_PER_ROWS == 0:
                     elapsed = time.time() - start
-                    predicted = elapsed // (total_exported_contacts / len(contact_ids))
+                    predicted = elapsed // (total_exported_contacts / num_contacts)
 
                     logger.info(
                         "Export of %s contacts - %d%% (%s/%s) complete in %0.2fs (predicted %0.0fs)"
                         % (
                             self.org.name,
-                            total_exported_contacts * 100 // len(contact_ids),
+                            total_exported_contacts * 100 // num_contacts,
                             "{:,}".format(total_exported_contacts),
-                            "{:,}".format(len(contact_ids)),
+                            "{:,}".format(num_contacts),
                             time.time() - start,
                             predicted,
                         )
@@ -3178,6 +3620,80 @@ class ExportContactsTask(BaseExportTask):
 
         return exporter.save_file()
 
+    def _get_id_batches(self, group):
+        """
+        Fetches the ids of the contacts in the given group in batches ordered by name and id, using keysets so that the
+        ids are never all loaded at once. Names can be NULL, so contacts without names are fetched last by id alone.
+        """
+        contacts = group.contacts.all()
+        named = contacts.exclude(name=None).values_list("name", "id")
+
+        for batch in iter_keyset_batches(named, "name", self.BATCH_SIZE):
+            yield [contact_id for name, contact_id in batch]
+
+        yield from iter_keyset_batches(contacts.filter(name=None).values_list("id", flat=True), "id", self.BATCH_SIZE)
+
+    def _get_export_batch(self, batch_ids, include_urns, group_ids):
+        """
+        Fetches a batch of contacts with only the exported columns, yielding for each contact (in the order of the
+        given ids), the contact, its URNs by scheme and the ids of its groups
+        """
+        contacts = Contact.objects.filter(id__in=batch_ids).only(
+            "id", "org_id", "uuid", "name", "language", "created_on", "fields"
+        )
+        contacts_by_id = {c.id: c for c in contacts}
+
+        urns_by_contact = defaultdict(lambda: defaultdict(list))
+        if include_urns:
+            urns = ContactURN.objects.filter(contact_id__in=batch_ids).order_by("contact_id", "-priority", "id")
+            for urn in urns.only("id", "contact_id", "scheme", "path", "display"):
+                urns_by_contact[urn.contact_id][urn.scheme].append(urn)
+
+        groups_by_contact = defaultdict(set)
+        if group_ids:
+            memberships = ContactGroup.contacts.through.objects.filter(
+                contact_id__in=batch_ids, contactgroup_id__in=group_ids
+            ).values_list("contact_id", "contactgroup_id")
+            for contact_id, group_id in memberships:
+                groups_by_contact[contact_id].add(group_id)
+
+        for contact_id in batch_ids:
+            contact = contacts_by_id[contact_id]
+            contact.org = self.org
+
+            yield contact, urns_by_contact[contact_id], groups_by_contact[contact_id]
+
+    def _get_column_formatter(self, field):
+        """
+        Gets a function which extracts the value of the given export column from a contact and its URNs
+        """
+        key = field["key"]
+
+        if key == Contact.NAME:
+            return lambda c, urns: c.name
+        elif key == Contact.UUID:
+            return lambda c, urns: c.uuid
+        elif key == Contact.LANGUAGE:
+            return lambda c, urns: c.language
+        elif key == Contact.CREATED_ON:
+            return lambda c, urns: c.created_on
+        elif key == Contact.ID:
+            return lambda c, urns: str(c.id)
+        elif field["urn_scheme"] is not None:
+            scheme, position = field["urn_scheme"], field["position"]
+
+            def format_urn(c, urns):
+                scheme_urns = urns.get(scheme, ())
+                return (
+                    scheme_urns[position].get_display(org=self.org, formatted=False)
+                    if len(scheme_urns) > position
+                    else ""
+                )
+
+            return format_urn
+        else:
+            return lambda c, urns: c.get_field_display(field["field"])
+
 
 @register_asset_store
 class ContactExportAssetStore(BaseExportAssetStore):
@@ -14,10 +14,29 @@ from django.utils.encoding import force_text
 from django.utils.translation import gettext as _
 
 from temba.contacts.models import URN_SCHEME_CONFIG, Contact, ContactField
+from temba.utils.cache import LRUCache
 from temba.utils.dates import date_to_day_range_utc, str_to_date, str_to_datetime
 from temba.utils.es import ModelESSearch
 from temba.values.constants import Value
 
+# python operators for comparators, used when compiling conditions
+COMPARATOR_OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "~": lambda contact_value, query_value: query_value in contact_value,
+}
+
+# process-local caches of parsed queries and of resolved property maps
+PARSE_CACHE_SIZE = 1000
+PROP_MAP_CACHE_SIZE = 1000
+
+parse_cache = LRUCache(PARSE_CACHE_SIZE)
+prop_map_cache = LRUCache(PROP_MAP_CACHE_SIZE)
+
 TEL_VALUE_REGEX = regex.compile(r"^[+ \d\-\(\)]+$", flags=regex.V0)
 CLEAN_SPECIAL_CHARS_REGEX = regex.compile(r"[+ \-\(\)]+", flags=regex.V0)
 
@@ -59,6 +78,16 @@ class ContactQuery(object):
 
         return self.root.evaluate(org, contact_json, prop_map)
 
+    def compile(self, org):
+        """
+        Compiles this query into a function which takes a contact's search JSON and returns whether that contact
+        matches. Properties are resolved and query values parsed once, so the function is cheap to call for many
+        contacts. Invalid comparisons raise a SearchException here rather than when the function is called.
+        """
+        prop_map = self.get_prop_map(org)
+
+        return self.root.compile(org, prop_map)
+
     def as_elasticsearch(self, org):
         prop_map = self.get_prop_map(org)
 
@@ -70,8 +99,28 @@ class ContactQuery(object):
         and URN schemes.
         """
 
-        all_props = set(self.root.get_prop_names())
+        all_props = frozenset(self.root.get_prop_names())
+
+        # maps where every property resolved are cached until the org's fields change
+        cache_key = (org.id, ContactField.get_cache_version(org), all_props)
+
+        prop_map = prop_map_cache.get(cache_key)
+        if prop_map is None:
+            prop_map = self._resolve_props(org, all_props)
 
+            if all(prop_map.values()):
+                prop_map_cache.set(cache_key, prop_map)
+
+        prop_map = dict(prop_map)
+
+        if validate:
+            for prop, prop_obj in prop_map.items():
+                if not prop_obj:
+                    raise SearchException(_(f"Unrecognized field: '{prop}'"))
+
+        return prop_map
+
+    def _resolve_props(self, org, all_props):
         prop_map = {p: None for p in all_props}
 
         all_contact_fields = ContactField.all_fields.filter(org=org, key__in=all_props, is_active=True)
@@ -90,11 +139,6 @@ class ContactQuery(object):
             if scheme in prop_map.keys():
                 prop_map[scheme] = (self.PROP_SCHEME, scheme)
 
-        if validate:
-            for prop, prop_obj in prop_map.items():
-                if not prop_obj:
-                    raise SearchException(_(f"Unrecognized field: '{prop}'"))
-
         return prop_map
 
     def can_be_dynamic_group(self):
@@ -133,6 +177,9 @@ class QueryNode(object):
     def evaluate(self, org, contact_json, prop_map):  # pragma: no cover
         pass
 
+    def compile(self, org, prop_map):  # pragma: no cover
+        pass
+
 
 class Condition(QueryNode):
     COMPARATOR_ALIASES = {"is": "=", "has": "~"}
@@ -206,7 +253,7 @@ class Condition(QueryNode):
                     raise SearchException(_(f"Unknown number comparator: '{self.comparator}'"))
 
             elif field.value_type == Value.TYPE_DATETIME:
-                query_value = str_to_date(self.value, field.org.get_dayfirst())
+                query_value = str_to_date(self.value, org.get_dayfirst())
                 if not query_value:
                     raise SearchException(_(f"Unable to parse the date '{self.value}'"))
 
@@ -217,7 +264,7 @@ class Condition(QueryNode):
                     return False
 
                 # datetime contact values are serialized as ISO8601 timestamps in local time
-                contact_value = str_to_datetime(contact_datetime_value, pytz.UTC, field.org.get_dayfirst())
+                contact_value = str_to_datetime(contact_datetime_value, pytz.UTC, org.get_dayfirst())
                 contact_value_utc = contact_value.astimezone(pytz.UTC)
 
                 if self.comparator == "=":
@@ -297,14 +344,14 @@ class Condition(QueryNode):
                     raise SearchException(_(f"Unknown language comparator: '{self.comparator}'"))
 
             elif field_key == "created_on":
-                query_value = str_to_date(self.value, field.org.get_dayfirst())
+                query_value = str_to_date(self.value, org.get_dayfirst())
                 if not query_value:
                     raise SearchException(_(f"Unable to parse the date '{self.value}'"))
 
                 lower_bound, upper_bound = date_to_day_range_utc(query_value, org)
 
                 # contact created_on is serialized as ISO8601 timestamp in utc time
-                contact_value = str_to_datetime(contact_json.get("created_on"), pytz.UTC, field.org.get_dayfirst())
+                contact_value = str_to_datetime(contact_json.get("created_on"), pytz.UTC, org.get_dayfirst())
                 contact_value_utc = contact_value.astimezone(pytz.UTC)
 
                 if self.comparator == "=":
@@ -341,6 +388,145 @@ class Condition(QueryNode):
         else:  # pragma: no cover
             raise SearchException(_(f"Unrecognized contact field type '{prop_type}'"))
 
+    def _get_operator(self, allowed, error):
+        if self.comparator not in allowed:
+            raise SearchException(error)
+
+        return COMPARATOR_OPERATORS[self.comparator]
+
+    def _get_date_range_test(self, lower_bound, upper_bound, error):
+        """
+        Gets a function which tests a UTC datetime against the day range given by the query date
+        """
+        if self.comparator == "=":
+            return lambda v: lower_bound <= v < upper_bound
+        elif self.comparator == ">":
+            return lambda v: v >= upper_bound
+        elif self.comparator == ">=":
+            return lambda v: v >= lower_bound
+        elif self.comparator == "<":
+            return lambda v: v < lower_bound
+        elif self.comparator == "<=":
+            return lambda v: v < upper_bound
+        else:
+            raise SearchException(error)
+
+    def compile(self, org, prop_map):
+        prop_type, field = prop_map[self.prop]
+
+        if prop_type == ContactQuery.PROP_FIELD:
+            field_uuid = str(field.uuid)
+
+            if field.value_type == Value.TYPE_TEXT:
+                query_value = self.value.upper()
+                op = self._get_operator(("=", "!="), _(f"Unknown text comparator: '{self.comparator}'"))
+
+                def matcher(contact_json):
+                    contact_value = contact_json.get("fields", {}).get(field_uuid, {"text": ""}).get("text").upper()
+                    return op(contact_value, query_value)
+
+            elif field.value_type == Value.TYPE_NUMBER:
+                query_value = self._parse_number(self.value)
+                op = self._get_operator(
+                    ("=", ">", ">=", "<", "<="), _(f"Unknown number comparator: '{self.comparator}'")
+                )
+                parse_number = self._parse_number
+
+                def matcher(contact_json):
+                    contact_field = contact_json.get("fields", {}).get(field_uuid)
+                    if contact_field is None:
+                        return False
+
+                    number_value = contact_field.get("number", contact_field.get("decimal"))
+                    if number_value is None:
+                        return False
+
+                    return op(parse_number(number_value), query_value)
+
+            elif field.value_type == Value.TYPE_DATETIME:
+                dayfirst = org.get_dayfirst()
+                query_value = str_to_date(self.value, dayfirst)
+                if not query_value:
+                    raise SearchException(_(f"Unable to parse the date '{self.value}'"))
+
+                lower_bound, upper_bound = date_to_day_range_utc(query_value, org)
+                test = self._get_date_range_test(
+                    lower_bound, upper_bound, _(f"Unknown datetime comparator: '{self.comparator}'")
+                )
+
+                def matcher(contact_json):
+                    contact_field = contact_json.get("fields", {}).get(field_uuid)
+                    if contact_field is None or contact_field.get("datetime") is None:
+                        return False
+
+                    # datetime contact values are serialized as ISO8601 timestamps in local time
+                    contact_value = str_to_datetime(contact_field["datetime"], pytz.UTC, dayfirst)
+                    return test(contact_value.astimezone(pytz.UTC))
+
+            elif field.value_type in (Value.TYPE_STATE, Value.TYPE_DISTRICT, Value.TYPE_WARD):
+                query_value = self.value.upper()
+                op = self._get_operator(
+                    ("=", "!="), _(f"Unsupported comparator '{self.comparator}' for location field")
+                )
+                key = {Value.TYPE_STATE: "state", Value.TYPE_DISTRICT: "district", Value.TYPE_WARD: "ward"}[
+                    field.value_type
+                ]
+
+                def matcher(contact_json):
+                    location_value = contact_json.get("fields", {}).get(field_uuid, {key: ""}).get(key, "")
+                    return op(location_value.upper().split(" > ")[-1], query_value)
+
+            else:  # pragma: no cover
+                raise SearchException(_(f"Unrecognized contact field type '{field.value_type}'"))
+
+        elif prop_type == ContactQuery.PROP_SCHEME:
+            query_value = self.value.upper()
+            op = self._get_operator(("=", "~"), _(f"Unknown urn scheme comparator: '{self.comparator}'"))
+
+            def matcher(contact_json):
+                for urn in contact_json.get("urns"):
+                    if urn.get("scheme") == field and op(urn.get("path").upper(), query_value):
+                        return True
+                return False
+
+        elif prop_type == ContactQuery.PROP_ATTRIBUTE:
+            field_key = field.key
+
+            if field_key in ("language", "name"):
+                query_value = self.value.upper()
+                if field_key == "language":
+                    op = self._get_operator(("=", "!="), _(f"Unknown language comparator: '{self.comparator}'"))
+                else:
+                    op = self._get_operator(("=", "~", "!="), _(f"Unknown name comparator: '{self.comparator}'"))
+
+                def matcher(contact_json):
+                    raw_contact_value = contact_json.get(field_key)
+                    contact_value = "" if raw_contact_value is None else raw_contact_value.upper()
+                    return op(contact_value, query_value)
+
+            elif field_key == "created_on":
+                dayfirst = org.get_dayfirst()
+                query_value = str_to_date(self.value, dayfirst)
+                if not query_value:
+                    raise SearchException(_(f"Unable to parse the date '{self.value}'"))
+
+                lower_bound, upper_bound = date_to_day_range_utc(query_value, org)
+                test = self._get_date_range_test(
+                    lower_bound, upper_bound, _(f"Unknown created_on comparator: '{self.comparator}'")
+                )
+
+                def matcher(contact_json):
+                    # contact created_on is serialized as ISO8601 timestamp in utc time
+                    contact_value = str_to_datetime(contact_json.get("created_on"), pytz.UTC, dayfirst)
+                    return test(contact_value.astimezone(pytz.UTC))
+
+            else:
+                raise SearchException(_(f"No support for attribute field: '{field}'"))
+        else:  # pragma: no cover
+            raise SearchException(_(f"Unrecognized contact field type '{prop_type}'"))
+
+        return matcher
+
     def as_elasticsearch(self, org, prop_map):
         prop_type, field = prop_map[self.prop]
 
@@ -380,7 +566,7 @@ class Condition(QueryNode):
                     raise SearchException(_(f"Unknown number comparator: '{self.comparator}'"))
 
             elif field.value_type == Value.TYPE_DATETIME:
-                query_value = str_to_date(self.value, field.org.get_dayfirst())
+                query_value = str_to_date(self.value, org.get_dayfirst())
 
                 if not query_value:
                     raise SearchException(_(f"Unable to parse the date '{self.value}'"))
@@ -462,7 +648,7 @@ class Condition(QueryNode):
                 else:
                     raise SearchException(_(f"Unknown attribute comparator: '{self.comparator}'"))
             elif field_key == "created_on":
-                query_value = str_to_date(self.value, field.org.get_dayfirst())
+                query_value = str_to_date(self.value, org.get_dayfirst())
 
                 if not query_value:
                     raise SearchException(_(f"Unable to parse the date '{self.value}'"))
@@ -584,7 +770,7 @@ class IsSetCondition(Condition):
                             return True
 
                 elif field.value_type == Value.TYPE_DATETIME:
-                    contact_value = str_to_date(contact_field.get("datetime"), field.org.get_dayfirst())
+                    contact_value = str_to_date(contact_field.get("datetime"), org.get_dayfirst())
                     if is_set:
                         if contact_value is not None:
                             return True
@@ -685,6 +871,72 @@ class IsSetCondition(Condition):
         else:  # pragma: no cover
             raise SearchException(_(f"Unrecognized contact field type '{prop_type}'"))
 
+    def compile(self, org, prop_map):
+        prop_type, field = prop_map[self.prop]
+
+        if self.comparator.lower() in self.IS_SET_LOOKUPS:
+            is_set = True
+        elif self.comparator.lower() in self.IS_NOT_SET_LOOKUPS:
+            is_set = False
+        else:  # pragma: no cover
+            raise SearchException(_("Invalid operator for empty string comparison"))
+
+        if prop_type == ContactQuery.PROP_FIELD:
+            field_uuid = str(field.uuid)
+
+            if field.value_type == Value.TYPE_NUMBER:
+                parse_number = self._parse_number
+
+                def has_value(contact_field):
+                    try:
+                        parse_number(contact_field.get("decimal", contact_field.get("number")))
+                        return True
+                    except SearchException:
+                        return False
+
+            elif field.value_type == Value.TYPE_DATETIME:
+                dayfirst = org.get_dayfirst()
+
+                def has_value(contact_field):
+                    return str_to_date(contact_field.get("datetime"), dayfirst) is not None
+
+            elif field.value_type in (Value.TYPE_TEXT, Value.TYPE_WARD, Value.TYPE_DISTRICT, Value.TYPE_STATE):
+                key = {
+                    Value.TYPE_TEXT: "text",
+                    Value.TYPE_WARD: "ward",
+                    Value.TYPE_DISTRICT: "district",
+                    Value.TYPE_STATE: "state",
+                }[field.value_type]
+
+                def has_value(contact_field):
+                    return contact_field.get(key) is not None
+
+            else:  # pragma: no cover
+                raise SearchException(_(f"Unrecognized contact field type '{field.value_type}'"))
+
+            def matcher(contact_json):
+                contact_field = contact_json.get("fields").get(field_uuid)
+                return (contact_field is not None and has_value(contact_field)) == is_set
+
+        elif prop_type == ContactQuery.PROP_SCHEME:
+
+            def matcher(contact_json):
+                return any(urn.get("scheme") == field for urn in contact_json.get("urns")) == is_set
+
+        elif prop_type == ContactQuery.PROP_ATTRIBUTE:
+            field_key = field.key
+
+            if field_key not in ("language", "name"):  # pragma: no cover
+                raise SearchException(_(f"No support for attribute field: '{field}'"))
+
+            def matcher(contact_json):
+                return (contact_json.get(field_key) is not None) == is_set
+
+        else:  # pragma: no cover
+            raise SearchException(_(f"Unrecognized contact field type '{prop_type}'"))
+
+        return matcher
+
     def as_elasticsearch(self, org, prop_map):
         prop_type, field = prop_map[self.prop]
 
@@ -823,6 +1075,27 @@ class BoolCombination(QueryNode):
     def evaluate(self, org, contact_json, prop_map):
         return reduce(self.op, [child.evaluate(org, contact_json, prop_map) for child in self.children])
 
+    def compile(self, org, prop_map):
+        matchers = [child.compile(org, prop_map) for child in self.children]
+
+        if self.op == self.AND:
+
+            def matcher(contact_json):
+                for m in matchers:
+                    if not m(contact_json):
+                        return False
+                return True
+
+        else:
+
+            def matcher(contact_json):
+                for m in matchers:
+                    if m(contact_json):
+                        return True
+                return False
+
+        return matcher
+
     def as_elasticsearch(self, org, prop_map):
         return reduce(self.op, [child.as_elasticsearch(org, prop_map) for child in self.children])
 
@@ -945,8 +1218,35 @@ class ContactQLVisitor(ParseTreeVisitor):
 
 def parse_query(text, optimize=True, as_anon=False):
     """
-    Parses the given contact query and optionally optimizes it
+    Parses the given contact query and optionally optimizes it. Optimized queries are cached and shared so callers
+    must not modify them.
+    """
+    if not optimize:
+        return _parse_query(text, optimize, as_anon)
+
+    cache_key = (text, as_anon)
+
+    query = parse_cache.get(cache_key)
+    if query is None:
+        query = _parse_query(text, optimize, as_anon)
+        parse_cache.set(cache_key, query)
+
+    return query
+
+
+def get_query_cache_info():
+    """
+    Gets the size and hit/miss counts of the parsed query and property map caches
     """
+    return {"parse": parse_cache.info(), "prop_map": prop_map_cache.info()}
+
+
+def clear_query_caches():
+    parse_cache.clear()
+    prop_map_cache.clear()
+
+
+def _parse_query(text, optimize, as_anon):
     from .gen.ContactQLLexer import ContactQLLexer
     from .gen.ContactQLParser import ContactQLParser
 
@@ -988,6 +1288,15 @@ def evaluate_query(org, text, contact_json=dict):
     return parsed.evaluate(org, contact_json)
 
 
+def compile_query(org, text):
+    """
+    Parses and compiles the given query into a function which can be called with contact search JSON
+    """
+    parsed = parse_query(text, optimize=True, as_anon=org.is_anon)
+
+    return parsed.compile(org)
+
+
 def contact_es_search(org, text, base_group=None, sort_struct=None):
     """
     Returns ES query
@@ -1,3 +1,4 @@
+import itertools
 import logging
 from datetime import timedelta
 
@@ -41,11 +42,27 @@ def squash_contactgroupcounts():
 
 
 @task(track_started=True, name="reevaluate_dynamic_group")
-def reevaluate_dynamic_group(group_id):
+def reevaluate_dynamic_group(group_id, incremental=False):
     """
     (Re)evaluate a dynamic group
     """
-    ContactGroup.user_groups.get(id=group_id).reevaluate()
+    ContactGroup.user_groups.get(id=group_id).reevaluate(incremental=incremental)
+
+
+@nonoverlapping_task(track_started=True, name="reevaluate_dynamic_groups", lock_timeout=3600)
+def reevaluate_dynamic_groups():
+    """
+    Incrementally re-evaluates all ready dynamic groups against contacts modified since their last evaluation, one
+    org at a time so that each org's modified contacts are only loaded once
+    """
+    groups = ContactGroup.user_groups.filter(is_active=True, status=ContactGroup.STATUS_READY).exclude(query=None)
+    groups = groups.exclude(evaluated_on=None).select_related("org").order_by("org_id", "id")
+
+    for org, org_groups in itertools.groupby(groups, key=lambda g: g.org):
+        try:
+            ContactGroup.reevaluate_incremental(org, list(org_groups))
+        except Exception as e:  # pragma: no cover
+            logger.error(f"Error re-evaluating dynamic groups for org #{org.id}: {str(e)}", exc_info=True)
 
 
 @task(track_started=True, name="full_release_contact")
@@ -2,11 +2,13 @@ import copy
 import subprocess
 import time
 import uuid
+from array import array
 from datetime import date, datetime, timedelta
 from decimal import Decimal
 from unittest.mock import PropertyMock, patch
 
 import pytz
+from django_redis import get_redis_connection
 from openpyxl import load_workbook
 from smartmin.csv_imports.models import ImportTask
 from smartmin.models import SmartImportRowError
@@ -27,7 +29,7 @@ from temba.api.models import WebHookResult
 from temba.campaigns.models import Campaign, CampaignEvent, EventFire
 from temba.channels.models import Channel, ChannelEvent, ChannelLog
 from temba.contacts.models import DELETED_SCHEME
-from temba.contacts.search import contact_es_search, evaluate_query, is_phonenumber
+from temba.contacts.search import compile_query, contact_es_search, evaluate_query, is_phonenumber
 from temba.contacts.views import ContactListView
 from temba.flows.models import Flow, FlowRun
 from temba.ivr.models import IVRCall
@@ -40,7 +42,8 @@ from temba.tests.engine import MockSessionWriter
 from temba.triggers.models import Trigger
 from temba.utils import json
 from temba.utils.dates import datetime_to_ms, datetime_to_str
-from temba.utils.es import ES
+from temba.utils.es import ES, encode_search_cursor
+from temba.utils.locks import NonBlockingLock
 from temba.values.constants import Value
 
 from .models import (
@@ -62,9 +65,11 @@ from .search import (
     IsSetCondition,
     SearchException,
     SinglePropCombination,
+    clear_query_caches,
+    get_query_cache_info,
     parse_query,
 )
-from .tasks import check_elasticsearch_lag, squash_contactgroupcounts
+from .tasks import check_elasticsearch_lag, reevaluate_dynamic_groups, squash_contactgroupcounts
 from .templatetags.contacts import contact_field, history_class, history_icon
 
 
@@ -179,6 +184,30 @@ class ContactCRUDLTest(TembaTestMixin, _CRUDLTest):
 
             self.assertEqual(response.status_code, 404)
 
+        with patch("temba.utils.es.ES") as mock_ES:
+            from elasticsearch_dsl.utils import AttrList
+
+            mock_ES.search.return_value = {"_hits": AttrList([{"id": self.joe.id, "meta": {"sort": [self.joe.id]}}])}
+            mock_ES.count.return_value = {"count": 10020}
+
+            # results beyond those we can page to are browsed with a cursor after the last hit
+            cursor = encode_search_cursor([self.frank.id])
+            response = self.client.get(f'{reverse("contacts.contact_list")}?search=age+%3D+18&after={cursor}')
+
+            self.assertEqual(list(response.context["object_list"]), [self.joe])
+            self.assertTrue(response.context["is_cursor_page"])
+            self.assertEqual(response.context["cursor_url_params"], "?search=age+%3D+18&")
+            self.assertIsNone(response.context["next_cursor"])
+
+            # which searches after its sort values, with id as a tie-breaker
+            body = mock_ES.search.call_args[1]["body"]
+            self.assertEqual([self.frank.id], body["search_after"])
+            self.assertEqual({"id": {"order": "desc"}}, body["sort"][-1])
+            self.assertEqual(50, body["size"])
+
+            response = self.client.get(f'{reverse("contacts.contact_list")}?search=age+%3D+18&after=xyz')
+            self.assertEqual(response.status_code, 404)
+
         with patch("temba.utils.es.ES") as mock_ES:
             mock_ES.search.return_value = {"_hits": [{"id": self.joe.id}]}
             mock_ES.count.return_value = {"count": 1}
@@ -391,10 +420,154 @@ class ContactGroupTest(TembaTest):
         with self.assertRaises(ValueError):
             group.reevaluate()
 
+    def test_reevaluate_incremental(self):
+        gender = ContactField.get_or_create(self.org, self.admin, "gender")
+        self.joe.set_field(self.admin, "gender", "male")
+
+        mock_es_data = [
+            {
+                "_type": "_doc",
+                "_index": "dummy_index",
+                "_source": {"id": self.joe.id, "modified_on": self.joe.modified_on.isoformat()},
+            }
+        ]
+        with ESMockWithScroll(data=mock_es_data):
+            group = ContactGroup.create_dynamic(self.org, self.admin, "Males", "gender = male")
+
+        group.refresh_from_db()
+        self.assertEqual(set(group.contacts.all()), {self.joe})
+        self.assertIsNotNone(group.evaluated_on)
+
+        # simulate contacts being modified outside of handle_update since our last evaluation
+        group.evaluated_on = timezone.now() - timedelta(hours=1)
+        group.save(update_fields=("evaluated_on",))
+
+        Contact.objects.filter(id=self.frank.id).update(
+            fields={str(gender.uuid): {"text": "male"}}, modified_on=timezone.now()
+        )
+        Contact.objects.filter(id=self.joe.id).update(
+            fields={str(gender.uuid): {"text": "female"}}, modified_on=timezone.now()
+        )
+        Contact.objects.filter(id=self.mary.id).update(modified_on=timezone.now() - timedelta(days=1))
+
+        group.reevaluate(incremental=True)
+
+        group.refresh_from_db()
+        self.assertEqual(set(group.contacts.all()), {self.frank})
+        self.assertEqual(group.status, ContactGroup.STATUS_READY)
+        self.assertGreater(group.evaluated_on, timezone.now() - timedelta(minutes=1))
+
+        # blocked contacts are removed
+        Contact.objects.filter(id=self.frank.id).update(is_blocked=True, modified_on=timezone.now())
+
+        group.reevaluate(incremental=True)
+        self.assertEqual(set(group.contacts.all()), set())
+
+        # groups which have never been evaluated fall back to a full evaluation
+        group.evaluated_on = None
+        group.save(update_fields=("evaluated_on",))
+
+        with ESMockWithScroll(data=mock_es_data):
+            group.reevaluate(incremental=True)
+
+        group.refresh_from_db()
+        self.assertEqual(set(group.contacts.all()), {self.joe})
+        self.assertIsNotNone(group.evaluated_on)
+
+    def test_reevaluate_dynamic_groups_task(self):
+        gender = ContactField.get_or_create(self.org, self.admin, "gender")
+        self.joe.set_field(self.admin, "gender", "male")
+
+        mock_es_data = [
+            {
+                "_type": "_doc",
+                "_index": "dummy_index",
+                "_source": {"id": self.joe.id, "modified_on": self.joe.modified_on.isoformat()},
+            }
+        ]
+        with ESMockWithScroll(data=mock_es_data):
+            males = ContactGroup.create_dynamic(self.org, self.admin, "Males", "gender = male")
+        with ESMockWithScroll(data=[]):
+            females = ContactGroup.create_dynamic(self.org, self.admin, "Females", "gender = female")
+
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        ContactGroup.user_groups.filter(id__in=[males.id, females.id]).update(evaluated_on=an_hour_ago)
+
+        Contact.objects.filter(id=self.frank.id).update(
+            fields={str(gender.uuid): {"text": "male"}}, modified_on=timezone.now()
+        )
+        Contact.objects.filter(id=self.joe.id).update(
+            fields={str(gender.uuid): {"text": "female"}}, modified_on=timezone.now()
+        )
+        Contact.objects.exclude(id__in=[self.frank.id, self.joe.id]).update(
+            modified_on=timezone.now() - timedelta(days=1)
+        )
+
+        def mock_compile_query(org, text):
+            if text == females.query:
+                raise ValueError("boom")
+            return compile_query(org, text)
+
+        # modified contacts are only loaded once for both groups, and one group failing doesn't stop the other
+        with patch("temba.contacts.search.compile_query", side_effect=mock_compile_query):
+            with patch.object(Contact, "as_search_json", autospec=True, side_effect=Contact.as_search_json) as mock:
+                reevaluate_dynamic_groups()
+
+        self.assertEqual(2, mock.call_count)
+
+        males.refresh_from_db()
+        females.refresh_from_db()
+        self.assertEqual({self.frank}, set(males.contacts.all()))
+        self.assertGreater(males.evaluated_on, an_hour_ago)
+        self.assertEqual(set(), set(females.contacts.all()))
+        self.assertEqual(an_hour_ago, females.evaluated_on)
+
+        # the failed group is caught up by the next run
+        reevaluate_dynamic_groups()
+
+        females.refresh_from_db()
+        self.assertEqual({self.joe}, set(females.contacts.all()))
+        self.assertGreater(females.evaluated_on, an_hour_ago)
+
+        # groups being re-evaluated elsewhere are skipped
+        Contact.objects.filter(id=self.frank.id).update(
+            fields={str(gender.uuid): {"text": "female"}}, modified_on=timezone.now()
+        )
+        with NonBlockingLock(redis=get_redis_connection(), name=ContactGroup.REEVALUATE_LOCK_KEY % females.id):
+            reevaluate_dynamic_groups()
+
+        self.assertEqual(set(), set(males.contacts.all()))
+        self.assertEqual({self.joe}, set(females.contacts.all()))
+
     def test_query_elasticsearch_for_ids_bad_query(self):
         with self.assertRaises(SearchException):
             Contact.query_elasticsearch_for_ids(self.org, "bad_field <> error")
 
+    def test_query_elasticsearch_for_ids(self):
+        def mock_response(hits):
+            return {"_scroll_id": "1", "_shards": {"successful": 1, "total": 1}, "hits": {"hits": hits}}
+
+        hits = [{"_id": str(c.id), "fields": {"id": [c.id]}} for c in (self.frank, self.joe)]
+
+        with patch("temba.utils.es.ES") as mock_ES:
+            mock_ES.search.return_value = mock_response(hits)
+            mock_ES.scroll.return_value = mock_response([])
+
+            contact_ids = Contact.query_elasticsearch_for_ids(self.org, "name has joe or name has frank")
+
+        # every slice returned the same hits so they are merged into a single sorted array
+        self.assertEqual(array("l", sorted([self.joe.id, self.frank.id])), contact_ids)
+
+        # only ids are fetched, by 4 concurrent slices of the scroll
+        slices = set()
+        for call in mock_ES.search.call_args_list:
+            body = call[1]["body"]
+            self.assertEqual(False, body["_source"])
+            self.assertEqual(["id"], body["docvalue_fields"])
+            slices.add((body["slice"]["id"], body["slice"]["max"]))
+
+        self.assertEqual({(0, 4), (1, 4), (2, 4), (3, 4)}, slices)
+
     def test_get_or_create(self):
         group = ContactGroup.get_or_create(self.org, self.user, " first ")
         self.assertEqual(group.name, "first")
@@ -1918,6 +2091,125 @@ class ContactTest(TembaTest):
                 SearchException, evaluate_query, self.org, str(self.joe.pk), contact_json=self.joe.as_search_json()
             )
 
+    def test_contact_search_compiled(self):
+        self.setUpLocations()
+
+        ContactField.get_or_create(self.org, self.admin, "gender", "Gender", value_type=Value.TYPE_TEXT)
+        ContactField.get_or_create(self.org, self.admin, "age", "Age", value_type=Value.TYPE_NUMBER)
+        ContactField.get_or_create(self.org, self.admin, "joined", "Joined On", value_type=Value.TYPE_DATETIME)
+        ContactField.get_or_create(self.org, self.admin, "ward", "Ward", value_type=Value.TYPE_WARD)
+        ContactField.get_or_create(self.org, self.admin, "district", "District", value_type=Value.TYPE_DISTRICT)
+        ContactField.get_or_create(self.org, self.admin, "state", "State", value_type=Value.TYPE_STATE)
+
+        self.joe.language = "eng"
+        self.joe.save(update_fields=("language",), handle_update=False)
+        self.joe.set_field(self.admin, "gender", "Male")
+        self.joe.set_field(self.admin, "age", "18")
+        self.joe.set_field(self.admin, "joined", "01-03-2018")
+        self.joe.set_field(self.admin, "ward", "Rwanda > Eastern Province > Rwamagana > Bukure")
+        self.joe.set_field(self.admin, "district", "Rwanda > Eastern Province > Rwamagana")
+        self.joe.set_field(self.admin, "state", "Rwanda > Eastern Province")
+        self.frank.set_field(self.admin, "gender", "Female")
+        self.frank.set_field(self.admin, "age", "cedevita is not a number")
+        self.frank.set_field(self.admin, "joined", "cedevita is not a datetime object")
+
+        contact_jsons = [c.as_search_json() for c in (self.joe, self.frank, self.billy, self.voldemort)]
+        created_on = self.joe.created_on.astimezone(self.org.timezone).date().isoformat()
+
+        queries = [
+            'name = "Joe Blow"',
+            "name ~ blow",
+            'name = ""',
+            'name != "Bob"',
+            'language = "eng"',
+            'language != ""',
+            f'created_on = "{created_on}"',
+            f'created_on > "{created_on}"',
+            f'created_on <= "{created_on}"',
+            "gender = male",
+            "gender != female",
+            'gender = ""',
+            "age = 18",
+            "age > 20",
+            "age >= 15 AND age < 20",
+            'age != ""',
+            "joined = 01-03-2018",
+            "joined < 01-04-2018",
+            'joined = ""',
+            'ward = "bUKuRE"',
+            'ward != ""',
+            'district != "Rwamagana"',
+            'state = "Eastern Province"',
+            'state = ""',
+            "tel = +250781111111",
+            "tel ~ 078222",
+            'twitter != ""',
+            "gender = male OR age > 20 OR name ~ Billy",
+            "(gender = male AND age < 20) OR (gender = female AND tel ~ 0782)",
+        ]
+
+        # compiled queries should always agree with the tree walking evaluation
+        for query in queries:
+            matcher = compile_query(self.org, query)
+            for contact_json in contact_jsons:
+                self.assertEqual(
+                    evaluate_query(self.org, query, contact_json=contact_json),
+                    matcher(contact_json),
+                    f"mismatch for query '{query}' and contact {contact_json['id']}",
+                )
+
+        # invalid comparisons are caught at compile time
+        self.assertRaises(SearchException, compile_query, self.org, 'language ~ "eng"')
+        self.assertRaises(SearchException, compile_query, self.org, "age ~ 13")
+        self.assertRaises(SearchException, compile_query, self.org, "joined ~ 01-03-2018")
+        self.assertRaises(SearchException, compile_query, self.org, 'tel > "cedevita"')
+        self.assertRaises(SearchException, compile_query, self.org, 'joined < "cedevita is not a datetime object"')
+
+        # fields are only resolved once
+        with self.assertNumQueries(1):
+            matcher = compile_query(self.org, "gender = male AND age > 10")
+        with self.assertNumQueries(0):
+            self.assertEqual([True, False, False, False], [matcher(j) for j in contact_jsons])
+
+    def test_query_caches(self):
+        clear_query_caches()
+
+        # optimized queries are cached by text and anonymity
+        query = parse_query("gender = M")
+        self.assertIs(query, parse_query("gender = M"))
+        self.assertIsNot(query, parse_query("gender = M", as_anon=True))
+        self.assertIsNot(parse_query("gender = M", optimize=False), parse_query("gender = M", optimize=False))
+
+        # but errors aren't
+        self.assertRaises(SearchException, parse_query, "gender = ")
+        self.assertRaises(SearchException, parse_query, "gender = ")
+
+        self.assertEqual({"size": 2, "max_size": 1000, "hits": 1, "misses": 4}, get_query_cache_info()["parse"])
+
+        # props which can't be resolved aren't cached
+        self.assertRaises(SearchException, query.get_prop_map, self.org)
+
+        gender = ContactField.get_or_create(self.org, self.admin, "gender", "Gender", value_type=Value.TYPE_TEXT)
+
+        with self.assertNumQueries(1):
+            self.assertEqual({"gender": (ContactQuery.PROP_FIELD, gender)}, query.get_prop_map(self.org))
+        with self.assertNumQueries(0):
+            self.assertEqual({"gender": (ContactQuery.PROP_FIELD, gender)}, query.get_prop_map(self.org))
+
+        self.assertEqual({"size": 1, "max_size": 1000, "hits": 1, "misses": 2}, get_query_cache_info()["prop_map"])
+
+        # changing a field invalidates the cached maps for that org
+        ContactField.get_or_create(self.org, self.admin, "gender", value_type=Value.TYPE_NUMBER)
+
+        prop_map = query.get_prop_map(self.org)
+        self.assertEqual(Value.TYPE_NUMBER, prop_map["gender"][1].value_type)
+
+        # as does deleting one
+        gender.refresh_from_db()
+        gender.release(self.admin)
+
+        self.assertRaises(SearchException, query.get_prop_map, self.org)
+
     def test_contact_search_parsing(self):
         # implicit condition on name
         self.assertEqual(parse_query("will"), ContactQuery(Condition("name", "~", "will")))
@@ -4275,6 +4567,9 @@ class ContactTest(TembaTest):
             # our query should get expanded into a proper query
             self.assertEqual('name ~ "Frank"', results["query"])
 
+            # no more results after this sample
+            self.assertIsNone(results["next"])
+
             # check no primary urn
             self.frank.urns.all().delete()
             response = self.client.get(search_url + "?search=Frank")
@@ -4287,6 +4582,10 @@ class ContactTest(TembaTest):
             results = response.json()
             self.assertEqual(0, results["total"])
 
+            # bogus cursor
+            response = self.client.get(search_url + "?search=Frank&after=xyz")
+            self.assertEqual("Invalid search cursor", response.json()["error"])
+
             # bogus query
             response = self.client.get(search_url + '?search=name="notclosed')
             results = response.json()
@@ -4977,6 +5276,69 @@ class ContactTest(TembaTest):
             {"org": self.org, "created_by": self.admin, "name": "Mob", "urn:tel": "+250788111112", "language": "123"},
         )
 
+    def test_update_campaigns_for_import(self):
+        farmers = self.create_group("Farmers", [])
+
+        self.joe.campaign_fields, self.joe.campaign_groups = {"planting_date"}, {farmers}
+        self.frank.campaign_fields, self.frank.campaign_groups = {"planting_date"}, {farmers}
+        self.billy.campaign_fields = {"harvest_date"}
+
+        # contacts are only updated for their own changes, batched with other contacts which had the same changes
+        with patch("temba.campaigns.models.EventFire.update_events_for_contacts") as mock_update:
+            Contact.update_campaigns_for_import([self.joe, self.billy, self.frank, self.voldemort])
+
+        self.assertEqual(
+            [
+                ([self.joe, self.frank], {"planting_date"}, {farmers}),
+                ([self.billy], {"harvest_date"}, set()),
+                ([self.voldemort], set(), set()),
+            ],
+            [(c[0][1], c[1]["fields"], c[1]["groups"]) for c in mock_update.call_args_list],
+        )
+
+    def test_import_batch(self):
+        def parse(**values):
+            return Contact.parse_import_row(dict(org=self.org, created_by=self.admin, **values), True)
+
+        rows = [
+            (2, parse(**{"name": "ann smith", "urn:tel": "+250783333333", "age": "30"}), {}),
+            (3, parse(**{"name": "frank jones", "urn:tel": "+250782222222"}), {}),
+            (4, parse(**{"name": "ann jones", "urn:tel": "+250783333333"}), {}),
+            (5, parse(**{"urn:tel": "+250781111111", "urn:twitter": "blow80"}), {}),
+        ]
+        num_contacts = Contact.objects.count()
+
+        contacts, errors = Contact.import_batch(self.org, self.admin, True, rows)
+
+        self.assertEqual([], errors)
+        self.assertEqual(num_contacts + 1, Contact.objects.count())
+
+        # new contact is created in bulk and then updated by the later row with the same URN
+        ann = Contact.objects.get(urns__path="+250783333333")
+        self.assertEqual([ann, self.frank, ann, self.joe], contacts)
+        self.assertTrue(contacts[0].is_new)
+        self.assertEqual("Ann Jones", ann.name)
+        self.assertEqual("30", ann.get_field_serialized(ContactField.get_by_key(self.org, "age")))
+        self.assertEqual(["tel:+250783333333"], [u.identity for u in ann.urns.all()])
+        self.assertIn(ann, ContactGroup.all_groups.get(org=self.org, group_type=ContactGroup.TYPE_ALL).contacts.all())
+
+        # existing contact is updated
+        self.frank.refresh_from_db()
+        self.assertEqual("Frank Jones", self.frank.name)
+        self.assertFalse(contacts[1].is_new)
+
+        # a detached URN on a row for an existing contact is attached to that contact
+        detached = ContactURN.create(self.org, None, "mailto:frank@example.com")
+        rows = [(2, parse(**{"name": "frank", "urn:tel": "+250782222222", "urn:mailto": "frank@example.com"}), {})]
+
+        contacts, errors = Contact.import_batch(self.org, self.admin, True, rows)
+
+        self.assertEqual([], errors)
+        self.assertEqual([self.frank], contacts)
+
+        detached.refresh_from_db()
+        self.assertEqual(self.frank, detached.contact)
+
     def do_import(self, user, filename):
 
         import_params = dict(
@@ -7192,7 +7554,7 @@ class ContactFieldTest(TembaTest):
                 log_info_threshold.return_value = 1
 
                 with ESMockWithScroll(data=mock_es_data):
-                    with self.assertNumQueries(47):
+                    with self.assertNumQueries(46):
                         self.assertExcelSheet(
                             request_export("?s=name+has+adam+or+name+has+deng")[0],
                             [
@@ -7251,7 +7613,7 @@ class ContactFieldTest(TembaTest):
         # export a search within a specified group of contacts
         mock_es_data = [{"_type": "_doc", "_index": "dummy_index", "_source": {"id": contact.id}}]
         with ESMockWithScroll(data=mock_es_data):
-            with self.assertNumQueries(48):
+            with self.assertNumQueries(47):
                 self.assertExcelSheet(
                     request_export("?g=%s&s=Hagg" % group.uuid)[0],
                     [
@@ -42,6 +42,7 @@ from temba.msgs.views import SendMessageForm
 from temba.orgs.views import ModalMixin, OrgObjPermsMixin, OrgPermsMixin
 from temba.utils import analytics, json, languages, on_transaction_commit
 from temba.utils.dates import datetime_to_ms, ms_to_datetime
+from temba.utils.es import decode_search_cursor, encode_search_cursor
 from temba.utils.fields import Select2Field
 from temba.utils.text import slugify_with
 from temba.utils.views import BaseActionForm, ContactListPaginationMixin
@@ -247,7 +248,7 @@ class ContactListView(ContactListPaginationMixin, OrgPermsMixin, SmartListView):
 
             try:
                 search_object, self.parsed_search = contact_es_search(org, search_query, group, sort_struct)
-                es_search = search_object.source(fields=("id",)).using(ES)
+                es_search = search_object.source(fields=("id",)).using(ES).sort_with_id()
 
                 return es_search
 
@@ -1220,15 +1221,24 @@ class ContactCRUDL(SmartCRUDL):
             org = self.request.user.get_org()
             query = self.request.GET.get("search", None)
             samples = int(self.request.GET.get("samples", 10))
+            cursor = self.request.GET.get("after")
 
             if not query:
                 return JsonResponse({"total": 0, "sample": [], "fields": {}})
 
             try:
-                summary = Contact.query_summary(org, query, samples)
+                after = decode_search_cursor(cursor) if cursor else None
+            except ValueError as e:
+                return JsonResponse({"total": 0, "sample": [], "query": "", "error": str(e)})
+
+            try:
+                summary = Contact.query_summary(org, query, samples, after=after)
             except SearchException as e:
                 return JsonResponse({"total": 0, "sample": [], "query": "", "error": str(e)})
 
+            # the cursor to fetch the next page of the sample with, if there are more results
+            summary["next"] = encode_search_cursor(summary["next"]) if summary["next"] else None
+
             # serialize our contact sample
             json_contacts = []
             for contact in summary["sample"]:
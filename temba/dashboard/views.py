@@ -1,15 +1,35 @@
+import hashlib
 import time
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 from smartmin.views import SmartTemplateView
 
-from django.db.models import Q, Sum
+from django.db.models import Q
 from django.http import JsonResponse
 from django.utils import timezone
 
-from temba.channels.models import Channel, ChannelCount
+from temba.channels.models import Channel, ChannelCount, ChannelCountRollup
 from temba.orgs.models import Org
 from temba.orgs.views import OrgPermsMixin
+from temba.utils.cache import get_cacheable
+
+# the first day of message history shown on the dashboard
+HISTORY_START = date(2013, 2, 2)
+
+# how long aggregated dashboard data is cached for
+CACHE_TTL = 60 * 5
+
+
+def get_cache_key(prefix, org_ids, *args):
+    """
+    Gets the cache key for dashboard data for the given org ids (None meaning all orgs) and other arguments
+    """
+    if org_ids is None:
+        orgs_key = "all"
+    else:
+        orgs_key = hashlib.md5(",".join(str(i) for i in sorted(org_ids)).encode()).hexdigest()
+
+    return ":".join([prefix, orgs_key] + [str(a) for a in args])
 
 
 class Home(OrgPermsMixin, SmartTemplateView):
@@ -21,7 +41,21 @@ class Home(OrgPermsMixin, SmartTemplateView):
     template_name = "dashboard/home.haml"
 
 
-class MessageHistory(OrgPermsMixin, SmartTemplateView):
+class DashboardMixin:
+    def get_org_ids(self):
+        """
+        Gets the ids of the current org and its children, or None for all orgs if the user is customer support and
+        isn't viewing a specific org
+        """
+        org = self.derive_org()
+        if org:
+            return list(Org.objects.filter(Q(id=org.id) | Q(parent=org)).values_list("id", flat=True))
+
+        is_support = self.request.user.groups.filter(name="Customer Support").first()
+        return None if is_support else []
+
+
+class MessageHistory(DashboardMixin, OrgPermsMixin, SmartTemplateView):
     """
     Endpoint to expose message history since the dawn of time by day as JSON blob
     """
@@ -29,42 +63,31 @@ class MessageHistory(OrgPermsMixin, SmartTemplateView):
     permission = "orgs.org_dashboard"
 
     def render_to_response(self, context, **response_kwargs):
+        org_ids = self.get_org_ids()
+        cache_key = get_cache_key("dashboard_history", org_ids)
 
-        is_support = self.request.user.groups.filter(name="Customer Support").first()
-
-        orgs = []
-        org = self.derive_org()
-        if org:
-            orgs = Org.objects.filter(Q(id=org.id) | Q(parent=org))
+        return JsonResponse(get_cacheable(cache_key, lambda: (self.get_series(org_ids), CACHE_TTL)), safe=False)
 
+    def get_series(self, org_ids):
         # get all our counts for that period
-        daily_counts = ChannelCount.objects.filter(
-            count_type__in=[
-                ChannelCount.INCOMING_MSG_TYPE,
-                ChannelCount.OUTGOING_MSG_TYPE,
-                ChannelCount.INCOMING_IVR_TYPE,
-                ChannelCount.OUTGOING_IVR_TYPE,
-            ]
-        )
-
-        daily_counts = daily_counts.filter(day__gt="2013-02-01").filter(day__lte=timezone.now())
-
-        if orgs or not is_support:
-            daily_counts = daily_counts.filter(channel__org__in=orgs)
-
-        daily_counts = list(
-            daily_counts.values("day", "count_type").order_by("day", "count_type").annotate(count_sum=Sum("count"))
+        daily_counts = ChannelCountRollup.get_counts(
+            ChannelCountRollup.PERIOD_DAILY,
+            ChannelCount.ROLLUP_TYPES,
+            HISTORY_START,
+            timezone.now().date(),
+            orgs=org_ids,
+            by=("day", "count_type"),
         )
 
         msgs_in = []
         msgs_out = []
         epoch = datetime(1970, 1, 1)
 
-        def get_timestamp(count_dict):
+        def get_timestamp(day):
             """
             Gets a unix time that is highcharts friendly for a given day
             """
-            count_date = datetime.fromtimestamp(time.mktime(count_dict["day"].timetuple()))
+            count_date = datetime.fromtimestamp(time.mktime(day.timetuple()))
             return int((count_date - epoch).total_seconds() * 1000)
 
         def record_count(counts, day, count):
@@ -77,17 +100,17 @@ class MessageHistory(OrgPermsMixin, SmartTemplateView):
             if len(counts):
                 last = counts[-1]
                 if last and last[0] == day:
-                    last[1] += count["count_sum"]
+                    last[1] += count
                     is_new = False
 
             # otherwise add it as a new count
             if is_new:
-                counts.append([day, count["count_sum"]])
+                counts.append([day, count])
 
         msgs_total = []
-        for count in daily_counts:
-            direction = count["count_type"][0]
-            day = get_timestamp(count)
+        for (day, count_type), count in sorted(daily_counts.items()):
+            direction = count_type[0]
+            day = get_timestamp(day)
 
             if direction == "I":
                 record_count(msgs_in, day, count)
@@ -98,24 +121,16 @@ class MessageHistory(OrgPermsMixin, SmartTemplateView):
             # so we can use that inside our navigator
             record_count(msgs_total, day, count)
 
-        return JsonResponse(
-            [
-                dict(name="Incoming", type="column", data=msgs_in, showInNavigator=False),
-                dict(name="Outgoing", type="column", data=msgs_out, showInNavigator=False),
-                dict(
-                    name="Total",
-                    type="column",
-                    data=msgs_total,
-                    showInNavigator=True,
-                    showInLegend=False,
-                    visible=False,
-                ),
-            ],
-            safe=False,
-        )
+        return [
+            dict(name="Incoming", type="column", data=msgs_in, showInNavigator=False),
+            dict(name="Outgoing", type="column", data=msgs_out, showInNavigator=False),
+            dict(
+                name="Total", type="column", data=msgs_total, showInNavigator=True, showInLegend=False, visible=False
+            ),
+        ]
 
 
-class RangeDetails(OrgPermsMixin, SmartTemplateView):
+class RangeDetails(DashboardMixin, OrgPermsMixin, SmartTemplateView):
     """
     Intercooler snippet to show detailed information for a specific range
     """
@@ -126,8 +141,6 @@ class RangeDetails(OrgPermsMixin, SmartTemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        is_support = self.request.user.groups.filter(name="Customer Support").first()
-
         end = timezone.now()
         begin = end - timedelta(days=30)
         begin = self.request.GET.get("begin", datetime.strftime(begin, "%Y-%m-%d"))
@@ -136,65 +149,54 @@ class RangeDetails(OrgPermsMixin, SmartTemplateView):
         direction = self.request.GET.get("direction", "IO")
 
         if begin and end:
-            orgs = []
-            org = self.derive_org()
-            if org:
-                orgs = Org.objects.filter(Q(id=org.id) | Q(parent=org))
-
-            count_types = []
-            if "O" in direction:
-                count_types = [ChannelCount.OUTGOING_MSG_TYPE, ChannelCount.OUTGOING_IVR_TYPE]
-
-            if "I" in direction:
-                count_types += [ChannelCount.INCOMING_MSG_TYPE, ChannelCount.INCOMING_IVR_TYPE]
-
-            # get all our counts for that period
-            daily_counts = (
-                ChannelCount.objects.filter(count_type__in=count_types)
-                .filter(day__gte=begin)
-                .filter(day__lte=end)
-                .exclude(channel__org=None)
-            )
-            if orgs:
-                daily_counts = daily_counts.filter(channel__org__in=orgs)
+            begin = datetime.strptime(begin, "%Y-%m-%d").date()
+            end = datetime.strptime(end, "%Y-%m-%d").date()
 
-            context["orgs"] = list(
-                daily_counts.values("channel__org", "channel__org__name")
-                .order_by("-count_sum")
-                .annotate(count_sum=Sum("count"))[:12]
-            )
+            org_ids = self.get_org_ids()
+            cache_key = get_cache_key("dashboard_range", org_ids, begin, end, direction)
 
-            channel_types = (
-                ChannelCount.objects.filter(count_type__in=count_types)
-                .filter(day__gte=begin)
-                .filter(day__lte=end)
-                .exclude(channel__org=None)
+            context.update(
+                get_cacheable(cache_key, lambda: (self.get_range_details(org_ids, begin, end, direction), CACHE_TTL))
             )
 
-            if orgs or not is_support:
-                channel_types = channel_types.filter(channel__org__in=orgs)
+            context["begin"] = begin
+            context["end"] = end
+            context["direction"] = direction
 
-            channel_types = list(
-                channel_types.values("channel__channel_type").order_by("-count_sum").annotate(count_sum=Sum("count"))
-            )
+        return context
 
-            # populate the channel names
-            pie = []
-            for channel_type in channel_types[0:6]:
-                channel_type["channel__name"] = Channel.get_type_from_code(channel_type["channel__channel_type"]).name
-                pie.append(channel_type)
+    def get_range_details(self, org_ids, begin, end, direction):
+        count_types = []
+        if "O" in direction:
+            count_types = [ChannelCount.OUTGOING_MSG_TYPE, ChannelCount.OUTGOING_IVR_TYPE]
 
-            other_count = 0
-            for channel_type in channel_types[6:]:
-                other_count += channel_type["count_sum"]
+        if "I" in direction:
+            count_types += [ChannelCount.INCOMING_MSG_TYPE, ChannelCount.INCOMING_IVR_TYPE]
 
-            if other_count:
-                pie.append(dict(channel__name="Other", count_sum=other_count))
+        # top orgs are only limited when we're viewing a specific org
+        org_counts = ChannelCountRollup.get_range_counts(count_types, begin, end, orgs=org_ids or None, by=("org",))
+        top_orgs = sorted(org_counts.items(), key=lambda c: -c[1])[:12]
+        org_names = dict(Org.objects.filter(id__in=[o[0][0] for o in top_orgs]).values_list("id", "name"))
 
-            context["channel_types"] = pie
+        orgs = [
+            dict(channel__org=org_id, channel__org__name=org_names[org_id], count_sum=count)
+            for (org_id,), count in top_orgs
+        ]
 
-            context["begin"] = datetime.strptime(begin, "%Y-%m-%d").date()
-            context["end"] = datetime.strptime(end, "%Y-%m-%d").date()
-            context["direction"] = direction
+        type_counts = ChannelCountRollup.get_range_counts(count_types, begin, end, orgs=org_ids, by=("channel_type",))
+        channel_types = sorted(type_counts.items(), key=lambda c: -c[1])
 
-        return context
+        # populate the channel names
+        pie = []
+        for (channel_type,), count in channel_types[0:6]:
+            name = str(Channel.get_type_from_code(channel_type).name)
+            pie.append(dict(channel__channel_type=channel_type, channel__name=name, count_sum=count))
+
+        other_count = 0
+        for channel_type, count in channel_types[6:]:
+            other_count += count
+
+        if other_count:
+            pie.append(dict(channel__name="Other", count_sum=other_count))
+
+        return {"orgs": orgs, "channel_types": pie}
@@ -0,0 +1,43 @@
+# Generated by Django 2.2.4 on 2019-11-29 10:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+INDEX_SQL = """
+CREATE INDEX flows_flowactivitycount_unsquashed
+ON flows_flowactivitycount(flow_id, from_uuid, scope, bucket, day) WHERE NOT is_squashed;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("flows", "0219_flow_classifier_dependencies")]
+
+    operations = [
+        migrations.CreateModel(
+            name="FlowActivityCount",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "is_squashed",
+                    models.BooleanField(default=False, help_text="Whether this row was created by squashing"),
+                ),
+                ("from_uuid", models.UUIDField()),
+                (
+                    "scope",
+                    models.CharField(choices=[("H", "Hour of day"), ("W", "Day of week"), ("D", "Day")], max_length=1),
+                ),
+                ("bucket", models.SmallIntegerField()),
+                ("day", models.DateField(null=True)),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "flow",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT, related_name="activity_counts", to="flows.Flow"
+                    ),
+                ),
+            ],
+            options={"index_together": {("flow", "from_uuid")}},
+        ),
+        migrations.RunSQL(INDEX_SQL, "DROP INDEX flows_flowactivitycount_unsquashed"),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.4 on 2019-11-29 10:24
+
+from django.db import migrations
+
+# only squashed counts are rolled up here, unsquashed counts are rolled up as they are squashed
+POPULATE_SQL = """
+WITH counts AS (
+    SELECT "flow_id", "from_uuid", "period"::timestamp AS "period", "count" FROM flows_flowpathcount
+    WHERE "is_squashed"
+)
+INSERT INTO flows_flowactivitycount ("flow_id", "from_uuid", "scope", "bucket", "day", "count", "is_squashed")
+SELECT "flow_id", "from_uuid", 'H', extract(hour from "period")::int, NULL::date, SUM("count"), TRUE
+FROM counts GROUP BY 1, 2, 4
+UNION ALL
+SELECT "flow_id", "from_uuid", 'W', extract(dow from "period")::int, NULL::date, SUM("count"), TRUE
+FROM counts GROUP BY 1, 2, 4
+UNION ALL
+SELECT "flow_id", "from_uuid", 'D', 0, "period"::date, SUM("count"), TRUE
+FROM counts GROUP BY 1, 2, 5
+"""
+
+
+def populate_activity_counts(apps, schema_editor):  # pragma: no cover
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(POPULATE_SQL)
+        print(f" > Created {cursor.rowcount} flow activity counts")
+
+
+def reverse(apps, schema_editor):  # pragma: no cover
+    pass
+
+
+def apply_manual():  # pragma: no cover
+    from django.db import connection
+
+    with connection.schema_editor() as schema_editor:
+        populate_activity_counts(None, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("flows", "0220_flowactivitycount")]
+
+    operations = [migrations.RunPython(populate_activity_counts, reverse)]
@@ -1,13 +1,14 @@
+import hashlib
 import logging
 import time
-from array import array
-from collections import OrderedDict, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 from datetime import date, timedelta
 from enum import Enum
 from urllib.request import urlopen
 from uuid import uuid4
 
 import iso8601
+import pytz
 import regex
 from django_redis import get_redis_connection
 from packaging.version import Version
@@ -31,6 +32,7 @@ from temba.contacts.models import URN, Contact, ContactField, ContactGroup
 from temba.msgs.models import Label, Msg
 from temba.orgs.models import Org
 from temba.utils import analytics, chunk_list, json, on_transaction_commit
+from temba.utils.cache import get_cacheable
 from temba.utils.dates import str_to_datetime
 from temba.utils.export import BaseExportAssetStore, BaseExportTask
 from temba.utils.models import (
@@ -40,6 +42,7 @@ from temba.utils.models import (
     SquashableModel,
     TembaModel,
     generate_uuid,
+    iter_keyset_batches,
 )
 from temba.utils.s3 import public_file_storage
 from temba.values.constants import Value
@@ -513,9 +516,7 @@ class Flow(TembaModel):
             dependency_mapping[flow_uuid] = str(flow.uuid)
             created_flows.append((flow, flow_def))
 
-        # import each definition (includes re-mapping dependency references)
-        for flow, definition in created_flows:
-            flow.import_definition(user, definition, dependency_mapping)
+        cls._import_definitions(org, user, created_flows, dependency_mapping)
 
         # remap flow UUIDs in any campaign events
         for campaign in export_json.get(Org.EXPORT_CAMPAIGNS, []):
@@ -535,6 +536,68 @@ class Flow(TembaModel):
         # return the created flows
         return [f[0] for f in created_flows]
 
+    @classmethod
+    def _import_definitions(cls, org, user, flows_and_definitions, dependency_mapping):
+        """
+        Imports the definitions of the given flows (includes re-mapping dependency references). Rather than making
+        each flow's mailroom calls in turn, the definitions are inspected, cloned and re-inspected in concurrent
+        batches, with database lookups and writes done in between.
+        """
+        client = mailroom.get_client()
+        timings = OrderedDict()
+        last = time.perf_counter()
+
+        def record(stage):
+            nonlocal last
+            now = time.perf_counter()
+            timings[stage] = now - last
+            last = now
+
+        # legacy definitions are remapped locally
+        flows, definitions = [], []
+        for flow, definition in flows_and_definitions:
+            if FlowRevision.is_legacy_definition(definition):
+                flow.import_legacy_definition(definition, dependency_mapping)
+            else:
+                flows.append(flow)
+                definitions.append(definition)
+
+        record("legacy")
+
+        flow_infos = client.flows_inspect(definitions)
+        record("inspect")
+
+        for flow, flow_info in zip(flows, flow_infos):
+            flow.resolve_import_dependencies(user, flow_info["dependencies"], dependency_mapping)
+        record("dependencies")
+
+        # clone definitions so that all flow elements get new random UUIDs
+        cloned_definitions = client.flows_clone(dependency_mapping, definitions)
+        record("clone")
+
+        # if an export has more than one definition for the same flow, the last one is the one which is saved
+        to_save = OrderedDict(zip(flows, cloned_definitions))
+
+        # inspect the cloned definitions to save as new revisions, which we can't validate just yet because we're in
+        # a transaction and mailroom won't see any new database objects
+        for flow, definition in to_save.items():
+            flow.prepare_revision(definition)
+
+        flow_infos = client.flows_inspect(to_save.values())
+        record("reinspect")
+
+        for (flow, definition), flow_info in zip(to_save.items(), flow_infos):
+            flow.save_revision(user, definition, validate=False, flow_info=flow_info)
+        record("save")
+
+        for stage, elapsed in timings.items():
+            analytics.gauge(f"temba.flow_import_{stage}", elapsed)
+
+        logger.info(
+            f"Imported {len(flows_and_definitions)} flow definitions for org #{org.id}: "
+            + ", ".join(f"{stage}={elapsed:.3f}s" for stage, elapsed in timings.items())
+        )
+
     @classmethod
     def copy(cls, flow, user):
         copy = Flow.create(flow.org, user, "Copy of %s" % flow.name[:55], flow_type=flow.flow_type)
@@ -719,7 +782,19 @@ class Flow(TembaModel):
             return
 
         flow_info = mailroom.get_client().flow_inspect(definition)
-        dependencies = flow_info["dependencies"]
+        self.resolve_import_dependencies(user, flow_info["dependencies"], dependency_mapping)
+
+        # clone definition so that all flow elements get new random UUIDs
+        cloned_definition = mailroom.get_client().flow_clone(dependency_mapping, definition)
+
+        # save a new revision but we can't validate it just yet because we're in a transaction and mailroom
+        # won't see any new database objects
+        self.save_revision(user, cloned_definition, validate=False)
+
+    def resolve_import_dependencies(self, user, dependencies, dependency_mapping):
+        """
+        Maps the dependencies of an imported definition to objects in this flow's org, creating them where needed
+        """
 
         # ensure any channel dependencies exist
         for ref in dependencies.get("channels", []):
@@ -762,13 +837,6 @@ class Flow(TembaModel):
 
             dependency_mapping[ref["uuid"]] = str(template.uuid) if template else ref["uuid"]
 
-        # clone definition so that all flow elements get new random UUIDs
-        cloned_definition = mailroom.get_client().flow_clone(dependency_mapping, definition)
-
-        # save a new revision but we can't validate it just yet because we're in a transaction and mailroom
-        # won't see any new database objects
-        self.save_revision(user, cloned_definition, validate=False)
-
     def import_legacy_definition(self, flow_json, uuid_map):
         """
         Imports a legacy definition
@@ -1284,9 +1352,10 @@ class Flow(TembaModel):
         """
         return self.revisions.order_by("revision").last()
 
-    def save_revision(self, user, definition, validate=True):
+    def prepare_revision(self, definition):
         """
-        Saves a new revision for this flow, validation will be done on the definition first
+        Checks that a definition can be saved as the next revision of this flow, and updates its metadata to match.
+        Returns the number of the new revision.
         """
         if Version(definition.get(Flow.DEFINITION_SPEC_VERSION)) < Version(Flow.GOFLOW_VERSION):
             raise FlowVersionConflictException(definition.get(Flow.DEFINITION_SPEC_VERSION))
@@ -1309,8 +1378,22 @@ class Flow(TembaModel):
         definition[Flow.DEFINITION_REVISION] = revision
         definition[Flow.DEFINITION_EXPIRE_AFTER_MINUTES] = self.expires_after_minutes
 
-        # inspect the flow (with optional validation)
-        flow_info = mailroom.get_client().flow_inspect(definition, validate_with_org=self.org if validate else None)
+        return revision
+
+    def save_revision(self, user, definition, validate=True, flow_info=None):
+        """
+        Saves a new revision for this flow, validation will be done on the definition first unless it has already been
+        prepared and inspected, in which case its flow info should be passed in
+        """
+        if flow_info:
+            revision = definition[Flow.DEFINITION_REVISION]
+        else:
+            revision = self.prepare_revision(definition)
+
+            # inspect the flow (with optional validation)
+            flow_info = mailroom.get_client().flow_inspect(
+                definition, validate_with_org=self.org if validate else None
+            )
 
         with transaction.atomic():
             dependencies = flow_info[Flow.INSPECT_DEPENDENCIES]
@@ -2459,6 +2542,7 @@ class FlowCategoryCount(SquashableModel):
     """
 
     SQUASH_OVER = ("flow_id", "node_uuid", "result_key", "result_name", "category_name")
+    SQUASH_SET_LIMIT = 10000
 
     flow = models.ForeignKey(Flow, on_delete=models.PROTECT, related_name="category_counts")
 
@@ -2475,31 +2559,6 @@ class FlowCategoryCount(SquashableModel):
     # the number of results with this category
     count = models.IntegerField(default=0)
 
-    @classmethod
-    def get_squash_query(cls, distinct_set):
-        sql = """
-        WITH removed as (
-          DELETE FROM %(table)s WHERE "id" IN (
-            SELECT "id" FROM %(table)s
-              WHERE "flow_id" = %%s AND "node_uuid" = %%s AND "result_key" = %%s AND "result_name" = %%s AND "category_name" = %%s
-              LIMIT 10000
-          ) RETURNING "count"
-        )
-        INSERT INTO %(table)s("flow_id", "node_uuid", "result_key", "result_name", "category_name", "count", "is_squashed")
-        VALUES (%%s, %%s, %%s, %%s, %%s, GREATEST(0, (SELECT SUM("count") FROM removed)), TRUE);
-        """ % {
-            "table": cls._meta.db_table
-        }
-
-        params = (
-            distinct_set.flow_id,
-            distinct_set.node_uuid,
-            distinct_set.result_key,
-            distinct_set.result_name,
-            distinct_set.category_name,
-        ) * 2
-        return sql, params
-
     def __str__(self):
         return "%s: %s" % (self.category_name, self.count)
 
@@ -2525,27 +2584,37 @@ class FlowPathCount(SquashableModel):
     # the number of runs that tooks this path segment in that period
     count = models.IntegerField(default=0)
 
-    @classmethod
-    def get_squash_query(cls, distinct_set):
-        sql = """
-        WITH removed as (
-            DELETE FROM %(table)s WHERE "flow_id" = %%s AND "from_uuid" = %%s AND "to_uuid" = %%s AND "period" = date_trunc('hour', %%s) RETURNING "count"
-        )
-        INSERT INTO %(table)s("flow_id", "from_uuid", "to_uuid", "period", "count", "is_squashed")
-        VALUES (%%s, %%s, %%s, date_trunc('hour', %%s), GREATEST(0, (SELECT SUM("count") FROM removed)), TRUE);
-        """ % {
-            "table": cls._meta.db_table
-        }
-
-        params = (distinct_set.flow_id, distinct_set.from_uuid, distinct_set.to_uuid, distinct_set.period) * 2
-        return sql, params
-
     @classmethod
     def get_totals(cls, flow):
         counts = cls.objects.filter(flow=flow)
         totals = list(counts.values_list("from_uuid", "to_uuid").annotate(replies=Sum("count")))
         return {"%s:%s" % (t[0], t[1]): t[2] for t in totals}
 
+    @classmethod
+    def get_squash_side_effects(cls):
+        """
+        Adds the deltas of the unsquashed rows being squashed to the activity rollups
+        """
+        rollup_cols = '"flow_id", "from_uuid", "scope", "bucket", "day", "count", "is_squashed"'
+
+        return f"""
+        , deltas AS (
+            SELECT "flow_id", "from_uuid", "period"::timestamp AS "period", "count" FROM removed
+            WHERE NOT "is_squashed"
+        ), rolled_up AS (
+            INSERT INTO {FlowActivityCount._meta.db_table}({rollup_cols})
+            SELECT "flow_id", "from_uuid", '{FlowActivityCount.SCOPE_HOUR_OF_DAY}', extract(hour from "period")::int,
+                NULL::date, SUM("count"), FALSE
+            FROM deltas GROUP BY 1, 2, 4
+            UNION ALL
+            SELECT "flow_id", "from_uuid", '{FlowActivityCount.SCOPE_DAY_OF_WEEK}', extract(dow from "period")::int,
+                NULL::date, SUM("count"), FALSE
+            FROM deltas GROUP BY 1, 2, 4
+            UNION ALL
+            SELECT "flow_id", "from_uuid", '{FlowActivityCount.SCOPE_DAY}', 0, "period"::date, SUM("count"), FALSE
+            FROM deltas GROUP BY 1, 2, 5
+        )"""
+
     def __str__(self):  # pragma: no cover
         return f"FlowPathCount({self.flow_id}) {self.from_uuid}:{self.to_uuid} {self.period} count: {self.count}"
 
@@ -2553,6 +2622,110 @@ class FlowPathCount(SquashableModel):
         index_together = ["flow", "from_uuid", "to_uuid", "period"]
 
 
+class FlowActivityCount(SquashableModel):
+    """
+    Totals of flow path counts by hour of day, day of week and day, per flow and exit. These are maintained from the
+    deltas of path counts as they are squashed, so that the activity chart doesn't have to aggregate every path count.
+    """
+
+    SQUASH_OVER = ("flow_id", "from_uuid", "scope", "bucket", "day")
+
+    SCOPE_HOUR_OF_DAY = "H"
+    SCOPE_DAY_OF_WEEK = "W"
+    SCOPE_DAY = "D"
+
+    SCOPE_CHOICES = (
+        (SCOPE_HOUR_OF_DAY, _("Hour of day")),
+        (SCOPE_DAY_OF_WEEK, _("Day of week")),
+        (SCOPE_DAY, _("Day")),
+    )
+
+    CACHE_KEY = "flow_activity:%d:%s:%s"
+    CACHE_VERSION_KEY = "flow_activity_version:%d"
+    CACHE_TTL = 60 * 60 * 24
+
+    flow = models.ForeignKey(Flow, on_delete=models.PROTECT, related_name="activity_counts")
+
+    # the exit UUID of the node the counted path segments start with
+    from_uuid = models.UUIDField()
+
+    scope = models.CharField(choices=SCOPE_CHOICES, max_length=1)
+
+    # the hour of the day or the day of the week (0 is Sunday), or zero for daily counts
+    bucket = models.SmallIntegerField()
+
+    # the day of daily counts
+    day = models.DateField(null=True)
+
+    count = models.IntegerField(default=0)
+
+    @classmethod
+    def get_activity(cls, flow, from_uuids):
+        """
+        Gets the totals of path segments starting with the given exits of a flow as counters by hour of day, day of
+        week and day. Rolled up totals are cached until the flow's path counts are next squashed, and path counts yet
+        to be squashed are added to them.
+        """
+        from_uuids = sorted(str(u) for u in from_uuids)
+        from_hash = hashlib.md5(",".join(from_uuids).encode("utf-8")).hexdigest()
+        cache_key = cls.CACHE_KEY % (flow.id, cls.get_cache_version(flow.id), from_hash)
+
+        def calculate():
+            rollups = cls.objects.filter(flow=flow, from_uuid__in=from_uuids).values_list("scope", "bucket", "day")
+            rollups = rollups.annotate(count_sum=Sum("count")).order_by()
+            return [[s, b, d.isoformat() if d else None, c] for s, b, d, c in rollups], cls.CACHE_TTL
+
+        activity = {cls.SCOPE_HOUR_OF_DAY: Counter(), cls.SCOPE_DAY_OF_WEEK: Counter(), cls.SCOPE_DAY: Counter()}
+
+        for scope, bucket, day, count in get_cacheable(cache_key, calculate):
+            activity[scope][iso8601.parse_date(day).date() if day else bucket] += count
+
+        pending = FlowPathCount.get_unsquashed().filter(flow=flow, from_uuid__in=from_uuids).values_list("period")
+        for period, count in pending.annotate(count_sum=Sum("count")).order_by():
+            period = period.astimezone(pytz.UTC)
+            activity[cls.SCOPE_HOUR_OF_DAY][period.hour] += count
+            activity[cls.SCOPE_DAY_OF_WEEK][period.isoweekday() % 7] += count
+            activity[cls.SCOPE_DAY][period.date()] += count
+
+        return activity
+
+    @classmethod
+    def get_cache_version(cls, flow_id):
+        """
+        Gets the current cache version token for the activity of the given flow
+        """
+        r = get_redis_connection()
+        key = cls.CACHE_VERSION_KEY % flow_id
+
+        version = r.get(key)
+        if version is None:
+            r.set(key, uuid4().hex, nx=True)
+            version = r.get(key)
+
+        return version.decode()
+
+    @classmethod
+    def squash(cls, max_sets=5000):
+        """
+        Invalidates the cached activity of flows with rollups that haven't been squashed before squashing them, as
+        those are the flows with path counts squashed since they were last cached
+        """
+        flow_ids = cls.get_unsquashed().values_list("flow_id", flat=True).distinct().order_by()
+
+        pipe = get_redis_connection().pipeline()
+        for flow_id in flow_ids:
+            pipe.set(cls.CACHE_VERSION_KEY % flow_id, uuid4().hex)
+        pipe.execute()
+
+        return super().squash(max_sets)
+
+    def __str__(self):  # pragma: no cover
+        return f"FlowActivityCount({self.flow_id}) {self.from_uuid} {self.scope}:{self.bucket}:{self.day} {self.count}"
+
+    class Meta:
+        index_together = ["flow", "from_uuid"]
+
+
 class FlowPathRecentRun(models.Model):
     """
     Maintains recent runs for a flow path segment
@@ -2661,6 +2834,7 @@ class FlowNodeCount(SquashableModel):
     """
 
     SQUASH_OVER = ("node_uuid",)
+    SQUASH_CARRY = ("flow_id",)
 
     flow = models.ForeignKey(Flow, on_delete=models.PROTECT, related_name="node_counts")
 
@@ -2670,20 +2844,6 @@ class FlowNodeCount(SquashableModel):
     # the number of contacts/runs currently at that node
     count = models.IntegerField(default=0)
 
-    @classmethod
-    def get_squash_query(cls, distinct_set):
-        sql = """
-        WITH removed as (
-            DELETE FROM %(table)s WHERE "node_uuid" = %%s RETURNING "count"
-        )
-        INSERT INTO %(table)s("flow_id", "node_uuid", "count", "is_squashed")
-        VALUES (%%s, %%s, GREATEST(0, (SELECT SUM("count") FROM removed)), TRUE);
-        """ % {
-            "table": cls._meta.db_table
-        }
-
-        return sql, (distinct_set.node_uuid, distinct_set.flow_id, distinct_set.node_uuid)
-
     @classmethod
     def get_totals(cls, flow):
         totals = list(cls.objects.filter(flow=flow).values_list("node_uuid").annotate(replies=Sum("count")))
@@ -2706,35 +2866,6 @@ class FlowRunCount(SquashableModel):
     # the number of runs that exited with that exit type
     count = models.IntegerField(default=0)
 
-    @classmethod
-    def get_squash_query(cls, distinct_set):
-        if distinct_set.exit_type:
-            sql = """
-            WITH removed as (
-                DELETE FROM %(table)s WHERE "flow_id" = %%s AND "exit_type" = %%s RETURNING "count"
-            )
-            INSERT INTO %(table)s("flow_id", "exit_type", "count", "is_squashed")
-            VALUES (%%s, %%s, GREATEST(0, (SELECT SUM("count") FROM removed)), TRUE);
-            """ % {
-                "table": cls._meta.db_table
-            }
-
-            params = (distinct_set.flow_id, distinct_set.exit_type) * 2
-        else:
-            sql = """
-            WITH removed as (
-                DELETE FROM %(table)s WHERE "flow_id" = %%s AND "exit_type" IS NULL RETURNING "count"
-            )
-            INSERT INTO %(table)s("flow_id", "exit_type", "count", "is_squashed")
-            VALUES (%%s, NULL, GREATEST(0, (SELECT SUM("count") FROM removed)), TRUE);
-            """ % {
-                "table": cls._meta.db_table
-            }
-
-            params = (distinct_set.flow_id,) * 2
-
-        return sql, params
-
     @classmethod
     def get_totals(cls, flow):
         totals = list(cls.objects.filter(flow=flow).values_list("exit_type").annotate(replies=Sum("count")))
@@ -2957,37 +3088,34 @@ class ExportFlowResultsTask(BaseExportTask):
         )
 
         flow_uuids = {str(flow.uuid) for flow in flows}
-        last_modified_on = None
-
-        for archive in archives:
-            for record_batch in chunk_list(archive.iter_records(), 1000):
-                matching = []
-                for record in record_batch:
-                    modified_on = iso8601.parse_date(record["modified_on"])
-                    if last_modified_on is None or last_modified_on < modified_on:
-                        last_modified_on = modified_on
-
-                    if record["flow"]["uuid"] in flow_uuids and (not responded_only or record["responded"]):
-                        matching.append(record)
-                yield matching
-
-        # secondly get runs from database
-        runs = FlowRun.objects.filter(flow__in=flows).order_by("modified_on")
-        if last_modified_on:
-            runs = runs.filter(modified_on__gt=last_modified_on)
-        if responded_only:
-            runs = runs.filter(responded=True)
-        run_ids = array(str("l"), runs.values_list("id", flat=True))
 
-        logger.info(
-            f"Results export #{self.id} for org #{self.org.id}: found {len(run_ids)} runs in database to export"
+        # only fetch indexed blocks which include one of our flows and only parse records which mention one
+        scan = Archive.scan_records(
+            archives,
+            prefilters=[flow_uuids],
+            timestamp_field="modified_on",
+            block_filter=lambda block: not block.flows.isdisjoint(flow_uuids),
         )
 
-        for id_batch in chunk_list(run_ids, 1000):
-            run_batch = (
-                FlowRun.objects.filter(id__in=id_batch).select_related("contact", "flow").order_by("modified_on", "pk")
-            )
+        for record_batch in chunk_list(scan, self.BATCH_SIZE):
+            matching = []
+            for record in record_batch:
+                if record["flow"]["uuid"] in flow_uuids and (not responded_only or record["responded"]):
+                    matching.append(record)
+            yield matching
+
+        # secondly get runs from database, up to when we started fetching them so that runs modified while we export
+        # don't move ahead of the keyset and get exported twice
+        runs = FlowRun.objects.filter(flow__in=flows, modified_on__lte=timezone.now())
+        runs = runs.select_related("contact", "flow")
+        if scan.latest_timestamp:
+            runs = runs.filter(modified_on__gt=scan.latest_timestamp)
+        if responded_only:
+            runs = runs.filter(responded=True)
 
+        logger.info(f"Results export #{self.id} for org #{self.org.id}: fetching runs from database to export...")
+
+        for run_batch in iter_keyset_batches(runs, "modified_on", self.BATCH_SIZE):
             # convert this batch of runs to same format as records in our archives
             yield [run.as_archive_json() for run in run_batch]
 
@@ -3244,20 +3372,6 @@ class FlowStartCount(SquashableModel):
     start = models.ForeignKey(FlowStart, on_delete=models.PROTECT, related_name="counts", db_index=True)
     count = models.IntegerField(default=0)
 
-    @classmethod
-    def get_squash_query(cls, distinct_set):
-        sql = """
-        WITH deleted as (
-            DELETE FROM %(table)s WHERE "start_id" = %%s RETURNING "count"
-        )
-        INSERT INTO %(table)s("start_id", "count", "is_squashed")
-        VALUES (%%s, GREATEST(0, (SELECT SUM("count") FROM deleted)), TRUE);
-        """ % {
-            "table": cls._meta.db_table
-        }
-
-        return sql, (distinct_set.start_id,) * 2
-
     @classmethod
     def get_count(cls, start):
         count = FlowStartCount.objects.filter(start=start).aggregate(count_sum=Sum("count"))["count_sum"]
@@ -13,6 +13,7 @@ from temba.utils.celery import nonoverlapping_task
 
 from .models import (
     ExportFlowResultsTask,
+    FlowActivityCount,
     FlowCategoryCount,
     FlowNodeCount,
     FlowPathCount,
@@ -51,6 +52,7 @@ def export_flow_results_task(export_id):
 )
 def squash_flowpathcounts():
     FlowPathCount.squash()
+    FlowActivityCount.squash()
 
 
 @nonoverlapping_task(
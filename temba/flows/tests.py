@@ -39,6 +39,7 @@ from .models import (
     ActionSet,
     ExportFlowResultsTask,
     Flow,
+    FlowActivityCount,
     FlowCategoryCount,
     FlowException,
     FlowInvalidCycleException,
@@ -1162,6 +1163,80 @@ class FlowTest(TembaTest):
         squash_flowruncounts()
         self.assertEqual(max_id, FlowRunCount.objects.all().order_by("-id").first().id)
 
+    @patch("temba.flows.models.FlowNodeCount.SQUASH_BATCH_SIZE", 2)
+    def test_squash_node_counts_batched(self):
+        flow = self.get_flow("favorites")
+        node_uuids = [str(uuid4()) for i in range(5)]
+
+        for node_uuid in node_uuids:
+            FlowNodeCount.objects.create(flow=flow, node_uuid=node_uuid, count=2)
+            FlowNodeCount.objects.create(flow=flow, node_uuid=node_uuid, count=-1)
+
+        # limited to 3 sets, which takes 2 batch statements
+        self.assertEqual({"sets": 3, "rows": 6}, FlowNodeCount.squash(max_sets=3))
+        self.assertEqual(4, FlowNodeCount.get_unsquashed().count())
+        self.assertEqual({"sets": 2, "rows": 4}, FlowNodeCount.squash())
+
+        self.assertEqual(5, FlowNodeCount.objects.filter(flow=flow, is_squashed=True).count())
+        self.assertEqual({u: 1 for u in node_uuids}, FlowNodeCount.get_totals(flow))
+
+        # no-op this time
+        self.assertEqual({"sets": 0, "rows": 0}, FlowNodeCount.squash())
+
+        # with a set limit, rows of a set beyond it are left for a later squash which includes the squashed row
+        node_uuid = str(uuid4())
+        for count in (3, -1, 1, -1, -1):
+            FlowNodeCount.objects.create(flow=flow, node_uuid=node_uuid, count=count)
+
+        with patch("temba.flows.models.FlowNodeCount.SQUASH_SET_LIMIT", 3):
+            self.assertEqual({"sets": 1, "rows": 3}, FlowNodeCount.squash())
+            self.assertEqual(2, FlowNodeCount.get_unsquashed().filter(node_uuid=node_uuid).count())
+            self.assertEqual({"sets": 1, "rows": 3}, FlowNodeCount.squash())
+
+        self.assertEqual(1, FlowNodeCount.get_totals(flow)[node_uuid])
+
+    def test_activity_counts(self):
+        flow = self.get_flow("favorites")
+        exit1, exit2 = uuid4(), uuid4()
+
+        def create_count(from_uuid, period, count):
+            FlowPathCount.objects.create(flow=flow, from_uuid=from_uuid, to_uuid=uuid4(), period=period, count=count)
+
+        create_count(exit1, datetime.datetime(2019, 11, 24, 10, 0, 0, 0, pytz.UTC), 2)
+        create_count(exit1, datetime.datetime(2019, 11, 24, 10, 0, 0, 0, pytz.UTC), 1)
+        create_count(exit1, datetime.datetime(2019, 11, 25, 15, 0, 0, 0, pytz.UTC), 4)
+        create_count(exit2, datetime.datetime(2019, 11, 25, 15, 0, 0, 0, pytz.UTC), 5)
+
+        def assert_activity(from_uuids, hod, dow, days):
+            activity = FlowActivityCount.get_activity(flow, from_uuids)
+            self.assertEqual(hod, activity[FlowActivityCount.SCOPE_HOUR_OF_DAY])
+            self.assertEqual(dow, activity[FlowActivityCount.SCOPE_DAY_OF_WEEK])
+            self.assertEqual(days, activity[FlowActivityCount.SCOPE_DAY])
+
+        # path counts which haven't been squashed are read directly
+        day1, day2 = datetime.date(2019, 11, 24), datetime.date(2019, 11, 25)
+        assert_activity([exit1], {10: 3, 15: 4}, {0: 3, 1: 4}, {day1: 3, day2: 4})
+
+        # squashing rolls them up, and invalidates what was cached for the flow
+        squash_flowpathcounts()
+
+        self.assertEqual(0, FlowPathCount.get_unsquashed().count())
+        self.assertEqual(0, FlowActivityCount.get_unsquashed().count())
+        self.assertEqual(7, FlowActivityCount.objects.filter(flow=flow, from_uuid=exit1).count())
+
+        assert_activity([exit1], {10: 3, 15: 4}, {0: 3, 1: 4}, {day1: 3, day2: 4})
+        assert_activity([exit1, exit2], {10: 3, 15: 9}, {0: 3, 1: 9}, {day1: 3, day2: 9})
+
+        # new path counts are added to the cached rollups
+        create_count(exit1, datetime.datetime(2019, 11, 25, 23, 0, 0, 0, pytz.UTC), 2)
+
+        with self.assertNumQueries(1):
+            assert_activity([exit1], {10: 3, 15: 4, 23: 2}, {0: 3, 1: 6}, {day1: 3, day2: 6})
+
+        squash_flowpathcounts()
+
+        assert_activity([exit1], {10: 3, 15: 4, 23: 2}, {0: 3, 1: 6}, {day1: 3, day2: 6})
+
     def test_category_counts(self):
         def assertCount(counts, result_key, category_name, truth):
             found = False
@@ -3942,6 +4017,22 @@ class ExportFlowResultsTest(TembaTest):
         filename = "%s/test_orgs/%d/results_exports/%s.xlsx" % (settings.MEDIA_ROOT, self.org.pk, task.uuid)
         return load_workbook(filename=os.path.join(settings.MEDIA_ROOT, filename))
 
+    @patch("temba.flows.models.ExportFlowResultsTask.BATCH_SIZE", 1)
+    def test_run_batches_bounded(self):
+        flow = self.get_flow("color_v13")
+        run1 = FlowRun.objects.create(org=self.org, flow=flow, contact=self.contact)
+        run2 = FlowRun.objects.create(org=self.org, flow=flow, contact=self.contact2)
+
+        task = ExportFlowResultsTask.create(self.org, self.admin, [flow], [], True, True, (), ())
+        batches = task._get_run_batches([flow], False)
+
+        self.assertEqual([run1.id], [r["id"] for r in next(batches)])
+
+        # runs modified after the export started aren't exported again
+        FlowRun.objects.filter(id=run1.id).update(modified_on=timezone.now() + timedelta(seconds=5))
+
+        self.assertEqual([[run2.id]], [[r["id"] for r in b] for b in batches])
+
     def test_export_results(self):
         flow = self.get_flow("color_v13")
         flow_nodes = flow.as_json()["nodes"]
@@ -4070,12 +4161,12 @@ class ExportFlowResultsTest(TembaTest):
                 # make sure that we trigger logger
                 log_info_threshold.return_value = 1
 
-                with self.assertNumQueries(42):
+                with self.assertNumQueries(41):
                     workbook = self._export(flow, group_memberships=[devs])
 
                 self.assertEqual(len(captured_logger.output), 3)
                 self.assertTrue("fetching runs from archives to export" in captured_logger.output[0])
-                self.assertTrue("found 5 runs in database to export" in captured_logger.output[1])
+                self.assertTrue("fetching runs from database to export" in captured_logger.output[1])
                 self.assertTrue("exported 5 in" in captured_logger.output[2])
 
         tz = self.org.timezone
@@ -4296,7 +4387,7 @@ class ExportFlowResultsTest(TembaTest):
         )
 
         # test without msgs or unresponded
-        with self.assertNumQueries(41):
+        with self.assertNumQueries(40):
             workbook = self._export(flow, include_msgs=False, responded_only=True, group_memberships=(devs,))
 
         tz = self.org.timezone
@@ -4362,7 +4453,7 @@ class ExportFlowResultsTest(TembaTest):
         age = ContactField.get_or_create(self.org, self.admin, "age", "Age")
         self.contact.set_field(self.admin, "age", "36")
 
-        with self.assertNumQueries(43):
+        with self.assertNumQueries(42):
             workbook = self._export(
                 flow,
                 include_msgs=False,
@@ -4541,7 +4632,7 @@ class ExportFlowResultsTest(TembaTest):
 
         contact1_run1, contact2_run1, contact3_run1, contact1_run2, contact2_run2 = FlowRun.objects.order_by("id")
 
-        with self.assertNumQueries(51):
+        with self.assertNumQueries(50):
             workbook = self._export(flow)
 
         tz = self.org.timezone
@@ -4792,7 +4883,7 @@ class ExportFlowResultsTest(TembaTest):
         )
 
         # test without msgs or unresponded
-        with self.assertNumQueries(34):
+        with self.assertNumQueries(33):
             workbook = self._export(flow, include_msgs=False, responded_only=True)
 
         tz = self.org.timezone
@@ -5617,7 +5708,7 @@ class SimulationTest(TembaTest):
         url = reverse("flows.flow_simulate", args=[flow.id])
 
         with override_settings(MAILROOM_AUTH_TOKEN="sesame", MAILROOM_URL="https://mailroom.temba.io"):
-            with patch("requests.post") as mock_post:
+            with patch("requests.Session.post") as mock_post:
                 mock_post.return_value = MockResponse(200, '{"session": {}}')
                 response = self.client.post(url, payload, content_type="application/json")
 
@@ -5654,13 +5745,13 @@ class SimulationTest(TembaTest):
         url = reverse("flows.flow_simulate", args=[flow.pk])
 
         with override_settings(MAILROOM_AUTH_TOKEN="sesame", MAILROOM_URL="https://mailroom.temba.io"):
-            with patch("requests.post") as mock_post:
+            with patch("requests.Session.post") as mock_post:
                 mock_post.return_value = MockResponse(400, '{"session": {}}')
                 response = self.client.post(url, json.dumps(payload), content_type="application/json")
                 self.assertEqual(500, response.status_code)
 
             # start a flow
-            with patch("requests.post") as mock_post:
+            with patch("requests.Session.post") as mock_post:
                 mock_post.return_value = MockResponse(200, '{"session": {}}')
                 response = self.client.post(url, json.dumps(payload), content_type="application/json")
                 self.assertEqual(200, response.status_code)
@@ -5680,12 +5771,12 @@ class SimulationTest(TembaTest):
             # try a resume
             payload = dict(version=2, session={}, resume={}, flow={})
 
-            with patch("requests.post") as mock_post:
+            with patch("requests.Session.post") as mock_post:
                 mock_post.return_value = MockResponse(400, '{"session": {}}')
                 response = self.client.post(url, json.dumps(payload), content_type="application/json")
                 self.assertEqual(500, response.status_code)
 
-            with patch("requests.post") as mock_post:
+            with patch("requests.Session.post") as mock_post:
                 mock_post.return_value = MockResponse(200, '{"session": {}}')
                 response = self.client.post(url, json.dumps(payload), content_type="application/json")
                 self.assertEqual(200, response.status_code)
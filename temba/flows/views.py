@@ -1,8 +1,10 @@
 import logging
+from collections import Counter
 from datetime import datetime, timedelta
 from uuid import uuid4
 
 import iso8601
+import pytz
 import regex
 import requests
 from packaging.version import Version
@@ -22,7 +24,7 @@ from django import forms
 from django.conf import settings
 from django.contrib import messages
 from django.core.exceptions import ValidationError
-from django.db.models import Count, Max, Min, Sum
+from django.db.models import Count, Sum
 from django.db.models.functions import Lower
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.urls import reverse
@@ -39,7 +41,7 @@ from temba.classifiers.models import Classifier
 from temba.contacts.models import TEL_SCHEME, WHATSAPP_SCHEME, Contact, ContactField, ContactGroup, ContactURN
 from temba.contacts.omnibox import omnibox_deserialize
 from temba.flows.legacy.expressions import get_function_listing
-from temba.flows.models import Flow, FlowRevision, FlowRun, FlowRunCount, FlowSession
+from temba.flows.models import Flow, FlowActivityCount, FlowRevision, FlowRun, FlowRunCount, FlowSession
 from temba.flows.tasks import export_flow_results_task
 from temba.ivr.models import IVRCall
 from temba.mailroom import FlowValidationException
@@ -1442,33 +1444,18 @@ class FlowCRUDL(SmartCRUDL):
             context = super().get_context_data(*args, **kwargs)
 
             flow = self.get_object()
-            from temba.flows.models import FlowPathCount
 
-            from_uuids = flow.metadata["waiting_exit_uuids"]
-            dates = FlowPathCount.objects.filter(flow=flow, from_uuid__in=from_uuids).aggregate(
-                Max("period"), Min("period")
-            )
-            start_date = dates.get("period__min")
-            end_date = dates.get("period__max")
+            activity = FlowActivityCount.get_activity(flow, flow.metadata["waiting_exit_uuids"])
+            hod_dict = activity[FlowActivityCount.SCOPE_HOUR_OF_DAY]
+            dow_dict = activity[FlowActivityCount.SCOPE_DAY_OF_WEEK]
+            day_dict = activity[FlowActivityCount.SCOPE_DAY]
 
             # by hour of the day
-            hod = FlowPathCount.objects.filter(flow=flow, from_uuid__in=from_uuids).extra(
-                {"hour": "extract(hour from period::timestamp)"}
-            )
-            hod = hod.values("hour").annotate(count=Sum("count")).order_by("hour")
-            hod_dict = {int(h.get("hour")): h.get("count") for h in hod}
-
             hours = []
             for x in range(0, 24):
                 hours.append({"bucket": datetime(1970, 1, 1, hour=x), "count": hod_dict.get(x, 0)})
 
             # by day of the week
-            dow = FlowPathCount.objects.filter(flow=flow, from_uuid__in=from_uuids).extra(
-                {"day": "extract(dow from period::timestamp)"}
-            )
-            dow = dow.values("day").annotate(count=Sum("count"))
-            dow_dict = {int(d.get("day")): d.get("count") for d in dow}
-
             dow = []
             for x in range(0, 7):
                 day_count = dow_dict.get(x, 0)
@@ -1497,25 +1484,32 @@ class FlowCRUDL(SmartCRUDL):
                 context["dow"] = dow
                 context["hod"] = hours
 
-            if total_responses > self.HISTOGRAM_MIN:
-                # our main histogram
+            if total_responses > self.HISTOGRAM_MIN and day_dict:
+                # our main histogram, by day or by week for longer ranges
+                start_date = min(day_dict)
+                end_date = max(day_dict)
                 date_range = end_date - start_date
-                histogram = FlowPathCount.objects.filter(flow=flow, from_uuid__in=from_uuids)
                 if date_range < timedelta(days=21):
-                    histogram = histogram.extra({"bucket": "date_trunc('hour', period)"})
-                    min_date = start_date - timedelta(hours=1)
+                    min_date = start_date - timedelta(days=1)
                 elif date_range < timedelta(days=500):
-                    histogram = histogram.extra({"bucket": "date_trunc('day', period)"})
                     min_date = end_date - timedelta(days=100)
                 else:
-                    histogram = histogram.extra({"bucket": "date_trunc('week', period)"})
                     min_date = end_date - timedelta(days=500)
 
-                histogram = histogram.values("bucket").annotate(count=Sum("count")).order_by("bucket")
+                buckets = Counter()
+                for day, count in day_dict.items():
+                    if date_range >= timedelta(days=500):
+                        day -= timedelta(days=day.weekday())
+                    buckets[day] += count
+
+                def as_datetime(d):
+                    return datetime(d.year, d.month, d.day, tzinfo=pytz.UTC)
+
+                histogram = [{"bucket": as_datetime(d), "count": buckets[d]} for d in sorted(buckets)]
                 context["histogram"] = histogram
 
                 # highcharts works in UTC, but we want to offset our chart according to the org timezone
-                context["min_date"] = min_date
+                context["min_date"] = as_datetime(min_date)
 
             counts = FlowRunCount.objects.filter(flow=flow).values("exit_type").annotate(Sum("count"))
 
@@ -1,13 +1,36 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from django.conf import settings
 
-from temba.utils import json
+from temba.utils import analytics, json
 
 logger = logging.getLogger(__name__)
 
+# the connect and read timeouts in seconds of requests to mailroom
+REQUEST_TIMEOUT = (5, 60)
+
+# the max number of keep-alive connections to mailroom, which is also the max concurrency of batch calls
+POOL_SIZE = 10
+
+# none of the endpoints we call change any state, so they can be retried on connection errors and when mailroom is
+# temporarily unavailable
+RETRY_POLICY = Retry(
+    total=3,
+    backoff_factor=0.2,
+    status_forcelist=(502, 503, 504),
+    method_whitelist=frozenset(["POST"]),
+    raise_on_status=False,
+)
+
+# the session shared by all clients in this process so that connections are reused
+_session = None
+
 
 class MailroomException(Exception):
     """
@@ -62,9 +85,25 @@ class MailroomClient:
             # if the expression is invalid.. just return original
             return expression
 
+    def expressions_migrate(self, expressions):
+        """
+        Migrates a list of expressions, returning them in the same order. Mailroom has no batch endpoint for this so
+        each unique expression is migrated by concurrent requests over the pooled connections.
+        """
+        unique = list({e for e in expressions if e})
+        migrated = dict(zip(unique, self._map(self.expression_migrate, unique)))
+
+        return [migrated[e] if e else "" for e in expressions]
+
     def flow_migrate(self, definition):
         return self._request("flow/migrate", {"flow": definition})
 
+    def flows_migrate(self, definitions):
+        """
+        Migrates a list of flow definitions, returning them in the same order
+        """
+        return self._map(self.flow_migrate, definitions)
+
     def flow_inspect(self, flow, validate_with_org=None):
         payload = {"flow": flow}
 
@@ -74,6 +113,12 @@ class MailroomClient:
 
         return self._request("flow/inspect", payload)
 
+    def flows_inspect(self, flows, validate_with_org=None):
+        """
+        Inspects a list of flow definitions, returning their info in the same order
+        """
+        return self._map(lambda f: self.flow_inspect(f, validate_with_org), flows)
+
     def flow_clone(self, dependency_mapping, flow, validate_with_org=None):
         payload = {"dependency_mapping": dependency_mapping, "flow": flow}
 
@@ -83,6 +128,12 @@ class MailroomClient:
 
         return self._request("flow/clone", payload)
 
+    def flows_clone(self, dependency_mapping, flows):
+        """
+        Clones a list of flow definitions with the same dependency mapping, returning them in the same order
+        """
+        return self._map(lambda f: self.flow_clone(dependency_mapping, f), flows)
+
     def flow_validate(self, org, definition):
         payload = {"flow": definition}
 
@@ -94,6 +145,12 @@ class MailroomClient:
         validated["_ui"] = definition.get("_ui", {})
         return validated
 
+    def flows_validate(self, org, definitions):
+        """
+        Validates a list of flow definitions, returning them in the same order
+        """
+        return self._map(lambda d: self.flow_validate(org, d), definitions)
+
     def sim_start(self, payload):
         return self._request("sim/start", payload)
 
@@ -106,9 +163,15 @@ class MailroomClient:
             logger.debug(json.dumps(payload, indent=2))
             logger.debug("=============== /%s request ===============" % endpoint)
 
-        response = requests.post("%s/mr/%s" % (self.base_url, endpoint), json=payload, headers=self.headers)
+        start = time.perf_counter()
+
+        response = get_session().post(
+            "%s/mr/%s" % (self.base_url, endpoint), json=payload, headers=self.headers, timeout=REQUEST_TIMEOUT
+        )
         resp_json = response.json()
 
+        analytics.gauge("temba.mailroom_%s" % endpoint.replace("/", "_"), time.perf_counter() - start)
+
         if logger.isEnabledFor(logging.DEBUG):  # pragma: no cover
             logger.debug("=============== %s response ===============" % endpoint)
             logger.debug(json.dumps(resp_json, indent=2))
@@ -123,6 +186,34 @@ class MailroomClient:
 
         return resp_json
 
+    def _map(self, func, items):
+        """
+        Calls func on each of the given items concurrently, returning the results in the same order
+        """
+        items = list(items)
+        if len(items) < 2:
+            return [func(i) for i in items]
+
+        with ThreadPoolExecutor(max_workers=min(POOL_SIZE, len(items))) as executor:
+            return list(executor.map(func, items))
+
+
+def get_session():
+    """
+    Gets the keep-alive session used for requests to mailroom
+    """
+    global _session
+
+    if _session is None:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=RETRY_POLICY)
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _session = session
+
+    return _session
+
 
 def get_client():
     return MailroomClient(settings.MAILROOM_URL, settings.MAILROOM_AUTH_TOKEN)
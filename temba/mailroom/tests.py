@@ -8,7 +8,14 @@ from django.utils import timezone
 
 from temba.channels.models import ChannelEvent
 from temba.flows.models import FlowStart
-from temba.mailroom.client import FlowValidationException, MailroomException, get_client
+from temba.mailroom.client import (
+    POOL_SIZE,
+    REQUEST_TIMEOUT,
+    FlowValidationException,
+    MailroomException,
+    get_client,
+    get_session,
+)
 from temba.msgs.models import Broadcast, Msg
 from temba.tests import MockResponse, TembaTest, matchers
 from temba.utils import json
@@ -19,7 +26,7 @@ from . import queue_interrupt
 class MailroomClientTest(TembaTest):
     @override_settings(TESTING=False)
     def test_validation_failure(self):
-        with patch("requests.post") as mock_post:
+        with patch("requests.Session.post") as mock_post:
             mock_post.return_value = MockResponse(422, '{"error":"flow don\'t look right"}')
 
             with self.assertRaises(FlowValidationException) as e:
@@ -38,7 +45,7 @@ class MailroomClientTest(TembaTest):
     def test_request_failure(self):
         flow = self.get_flow("color")
 
-        with patch("requests.post") as mock_post:
+        with patch("requests.Session.post") as mock_post:
             mock_post.return_value = MockResponse(400, '{"errors":["Bad request", "Doh!"]}')
 
             with self.assertRaises(MailroomException) as e:
@@ -53,6 +60,58 @@ class MailroomClientTest(TembaTest):
         # empty is as empty does
         self.assertEqual("", get_client().expression_migrate(""))
 
+    def test_session(self):
+        session = get_session()
+
+        # session is shared by all clients, and pools keep-alive connections which are retried when unavailable
+        self.assertEqual(session, get_session())
+        adapter = session.get_adapter("https://mailroom.temba.io/mr/flow/migrate")
+        self.assertEqual(POOL_SIZE, adapter._pool_maxsize)
+        self.assertEqual(3, adapter.max_retries.total)
+        self.assertIn(503, adapter.max_retries.status_forcelist)
+
+        with override_settings(MAILROOM_AUTH_TOKEN="sesame", MAILROOM_URL="https://mailroom.temba.io"):
+            with patch("requests.Session.post") as mock_post:
+                mock_post.return_value = MockResponse(200, '{"migrated": "@contact.name"}')
+
+                self.assertEqual("@contact.name", get_client().expression_migrate("@contact.name"))
+
+                mock_post.assert_called_once_with(
+                    "https://mailroom.temba.io/mr/expression/migrate",
+                    json={"expression": "@contact.name"},
+                    headers={"User-Agent": "Temba", "Authorization": "Token sesame"},
+                    timeout=REQUEST_TIMEOUT,
+                )
+
+    def test_batches(self):
+        def mock_request(endpoint, payload):
+            if endpoint == "expression/migrate":
+                if payload["expression"] == "@(":
+                    raise FlowValidationException(endpoint, payload, {"error": "invalid"})
+                return {"migrated": payload["expression"].upper()}
+            return {"migrated": payload["flow"]["name"]}
+
+        with patch("temba.mailroom.client.MailroomClient._request", side_effect=mock_request) as mock_req:
+            client = get_client()
+
+            # expressions are migrated once each, and returned in order
+            self.assertEqual(
+                ["@A", "", "@B", "@A", "@(", ""], client.expressions_migrate(["@a", "", "@b", "@a", "@(", None])
+            )
+            self.assertEqual(3, mock_req.call_count)
+
+            self.assertEqual([], client.expressions_migrate([]))
+
+            flows = [{"name": f"Flow {i}"} for i in range(15)]
+            self.assertEqual([{"migrated": f"Flow {i}"} for i in range(15)], client.flows_migrate(flows))
+
+        # errors are raised from batches
+        with patch("requests.Session.post") as mock_post:
+            mock_post.return_value = MockResponse(400, '{"errors":["Bad request"]}')
+
+            with self.assertRaises(MailroomException):
+                get_client().flows_migrate([{"name": "Flow 1"}, {"name": "Flow 2"}])
+
 
 class MailroomQueueTest(TembaTest):
     def setUp(self):
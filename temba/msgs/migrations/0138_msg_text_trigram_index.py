@@ -0,0 +1,20 @@
+# Generated by Django 2.2.4 on 2019-12-02 10:24
+
+from django.db import migrations
+
+# trigram index on the uppercased text since that's what icontains lookups compare, scoped by org
+INDEX_SQL = (
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS msgs_msg_text_trgm "
+    "ON msgs_msg USING GIN (org_id, UPPER(text) gin_trgm_ops)"
+)
+
+REVERSE_SQL = "DROP INDEX IF EXISTS msgs_msg_text_trgm"
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [("msgs", "0137_auto_20190926_1529"), ("contacts", "0106_search_trigram_indexes")]
+
+    operations = [migrations.RunSQL(INDEX_SQL, REVERSE_SQL)]
@@ -1,6 +1,5 @@
 import logging
 import time
-from array import array
 from datetime import date, datetime, timedelta
 from uuid import uuid4
 
@@ -28,7 +27,7 @@ from temba.orgs.models import Language, Org, TopUp
 from temba.schedules.models import Schedule
 from temba.utils import chunk_list, extract_constants, on_transaction_commit
 from temba.utils.export import BaseExportAssetStore, BaseExportTask
-from temba.utils.models import JSONAsTextField, SquashableModel, TembaModel, TranslatableField
+from temba.utils.models import JSONAsTextField, SquashableModel, TembaModel, TranslatableField, iter_keyset_batches
 from temba.utils.text import clean_string
 
 logger = logging.getLogger(__name__)
@@ -1081,20 +1080,6 @@ class BroadcastMsgCount(SquashableModel):
     broadcast = models.ForeignKey(Broadcast, on_delete=models.PROTECT, related_name="counts", db_index=True)
     count = models.IntegerField(default=0)
 
-    @classmethod
-    def get_squash_query(cls, distinct_set):
-        sql = """
-        WITH deleted as (
-            DELETE FROM %(table)s WHERE "broadcast_id" = %%s RETURNING "count"
-        )
-        INSERT INTO %(table)s("broadcast_id", "count", "is_squashed")
-        VALUES (%%s, GREATEST(0, (SELECT SUM("count") FROM deleted)), TRUE);
-        """ % {
-            "table": cls._meta.db_table
-        }
-
-        return sql, (distinct_set.broadcast_id,) * 2
-
     @classmethod
     def get_count(cls, broadcast):
         count = BroadcastMsgCount.objects.filter(broadcast=broadcast).aggregate(count_sum=Sum("count"))["count_sum"]
@@ -1212,20 +1197,6 @@ class SystemLabelCount(SquashableModel):
 
     count = models.IntegerField(default=0, help_text=_("Number of items with this system label"))
 
-    @classmethod
-    def get_squash_query(cls, distinct_set):
-        sql = """
-        WITH deleted as (
-            DELETE FROM %(table)s WHERE "org_id" = %%s AND "label_type" = %%s and "is_archived" = %%s RETURNING "count"
-        )
-        INSERT INTO %(table)s("org_id", "label_type", "is_archived", "count", "is_squashed")
-        VALUES (%%s, %%s, %%s, GREATEST(0, (SELECT SUM("count") FROM deleted)), TRUE);
-        """ % {
-            "table": cls._meta.db_table
-        }
-
-        return sql, (distinct_set.org_id, distinct_set.label_type, distinct_set.is_archived) * 2
-
     @classmethod
     def get_totals(cls, org, is_archived=False):
         """
@@ -1442,20 +1413,6 @@ class LabelCount(SquashableModel):
 
     count = models.IntegerField(default=0, help_text=_("Number of items with this system label"))
 
-    @classmethod
-    def get_squash_query(cls, distinct_set):
-        sql = """
-            WITH deleted as (
-                DELETE FROM %(table)s WHERE "label_id" = %%s AND "is_archived" = %%s RETURNING "count"
-            )
-            INSERT INTO %(table)s("label_id", "is_archived", "count", "is_squashed")
-            VALUES (%%s, %%s, GREATEST(0, (SELECT SUM("count") FROM deleted)), TRUE);
-            """ % {
-            "table": cls._meta.db_table
-        }
-
-        return sql, (distinct_set.label_id, distinct_set.is_archived) * 2
-
     @classmethod
     def get_totals(cls, labels, is_archived=False):
         """
@@ -1470,41 +1427,6 @@ class LabelCount(SquashableModel):
         return {l: counts_by_label_id.get(l.id, 0) for l in labels}
 
 
-class MsgIterator:
-    """
-    Queryset wrapper to chunk queries and reduce in-memory footprint
-    """
-
-    def __init__(self, ids, order_by=None, select_related=None, prefetch_related=None, max_obj_num=1000):
-        self._ids = ids
-        self._order_by = order_by
-        self._select_related = select_related
-        self._prefetch_related = prefetch_related
-        self._generator = self._setup()
-        self.max_obj_num = max_obj_num
-
-    def _setup(self):
-        for i in range(0, len(self._ids), self.max_obj_num):
-            chunk_queryset = Msg.objects.filter(id__in=self._ids[i : i + self.max_obj_num])
-
-            if self._order_by:
-                chunk_queryset = chunk_queryset.order_by(*self._order_by)
-
-            if self._select_related:
-                chunk_queryset = chunk_queryset.select_related(*self._select_related)
-
-            if self._prefetch_related:
-                chunk_queryset = chunk_queryset.prefetch_related(*self._prefetch_related)
-
-            yield chunk_queryset
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        return next(self._generator)
-
-
 class ExportMessagesTask(BaseExportTask):
     """
     Wrapper for handling exports of raw messages. This will export all selected messages in
@@ -1632,45 +1554,63 @@ class ExportMessagesTask(BaseExportTask):
             .order_by("start_date")
         )
 
-        last_created_on = None
+        # rule out as many records as we can before they're parsed
+        visibility = "visible"
+        prefilters = []
+        if system_label:
+            visibility, direction, msg_type, statuses = SystemLabel.get_archive_attributes(system_label)
+            prefilters.append([f'"{direction}"'])
+            if msg_type:
+                prefilters.append([f'"{msg_type}"'])
+            if statuses:
+                prefilters.append([f'"{s}"' for s in statuses])
+        elif label:
+            prefilters.append([str(label.uuid)])
 
-        for archive in archives:
-            for record_batch in chunk_list(archive.iter_records(), 1000):
-                matching = []
-                for record in record_batch:
-                    created_on = iso8601.parse_date(record["created_on"])
-                    if last_created_on is None or last_created_on < created_on:
-                        last_created_on = created_on
+        prefilters.append([f'"{visibility}"'])
 
-                    if created_on < start_date or created_on > end_date:  # pragma: can't cover
-                        continue
+        # and skip indexed blocks of archives which don't overlap our date range or include any of our contacts
+        def block_filter(block):
+            created_on = block.timestamps.get("created_on")
+            if created_on and (created_on[1] < start_date or created_on[0] > end_date):
+                return False
+            return not group_contacts or any(c in block.contacts for c in group_contacts)
 
-                    if group_contacts and record["contact"]["uuid"] not in group_contacts:
-                        continue
+        scan = Archive.scan_records(
+            archives, prefilters=prefilters, timestamp_field="created_on", block_filter=block_filter
+        )
 
-                    visibility = "visible"
-                    if system_label:
-                        visibility, direction, msg_type, statuses = SystemLabel.get_archive_attributes(system_label)
+        for record_batch in chunk_list(scan, self.BATCH_SIZE):
+            matching = []
+            for record in record_batch:
+                created_on = iso8601.parse_date(record["created_on"])
 
-                        if record["direction"] != direction:
-                            continue
+                if created_on < start_date or created_on > end_date:  # pragma: can't cover
+                    continue
 
-                        if msg_type and record["type"] != msg_type:
-                            continue
+                if group_contacts and record["contact"]["uuid"] not in group_contacts:
+                    continue
 
-                        if statuses and record["status"] not in statuses:
-                            continue
+                if system_label:
+                    if record["direction"] != direction:
+                        continue
+
+                    if msg_type and record["type"] != msg_type:
+                        continue
 
-                    elif label:
-                        record_labels = [l["uuid"] for l in record["labels"]]
-                        if label and label.uuid not in record_labels:
-                            continue
+                    if statuses and record["status"] not in statuses:
+                        continue
 
-                    if record["visibility"] != visibility:
+                elif label:
+                    record_labels = [l["uuid"] for l in record["labels"]]
+                    if label and label.uuid not in record_labels:
                         continue
 
-                    matching.append(record)
-                yield matching
+                if record["visibility"] != visibility:
+                    continue
+
+                matching.append(record)
+            yield matching
 
         if system_label:
             messages = SystemLabel.get_queryset(self.org, system_label)
@@ -1685,26 +1625,22 @@ class ExportMessagesTask(BaseExportTask):
         if self.end_date:
             messages = messages.filter(created_on__lte=end_date)
 
-        if self.groups.all():
-            messages = messages.filter(contact__all_groups__in=self.groups.all())
-
-        messages = messages.order_by("created_on")
-        if last_created_on:
-            messages = messages.filter(created_on__gt=last_created_on)
+        groups = self.groups.all()
+        if groups:
+            # semi-join on memberships so that msgs of contacts in several groups aren't repeated
+            members = ContactGroup.contacts.through.objects.filter(contactgroup__in=groups).values("contact_id")
+            messages = messages.filter(contact__in=members)
 
-        all_message_ids = array(str("l"), messages.values_list("id", flat=True))
+        if scan.latest_timestamp:
+            messages = messages.filter(created_on__gt=scan.latest_timestamp)
 
-        logger.info(
-            f"Msgs export #{self.id} for org #{self.org.id}: found {len(all_message_ids)} msgs in database to export"
+        messages = messages.select_related("contact", "contact_urn", "channel").prefetch_related(
+            Prefetch("labels", queryset=Label.label_objects.order_by("name"))
         )
 
-        prefetch = Prefetch("labels", queryset=Label.label_objects.order_by("name"))
-        for msg_batch in MsgIterator(
-            all_message_ids,
-            order_by=["" "created_on"],
-            select_related=["contact", "contact_urn", "channel"],
-            prefetch_related=[prefetch],
-        ):
+        logger.info(f"Msgs export #{self.id} for org #{self.org.id}: fetching msgs from database to export...")
+
+        for msg_batch in iter_keyset_batches(messages, "created_on", self.BATCH_SIZE):
             # convert this batch of msgs to same format as records in our archives
             yield [msg.as_archive_json() for msg in msg_batch]
 
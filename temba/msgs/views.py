@@ -1,4 +1,6 @@
+import operator
 from datetime import date, timedelta
+from functools import reduce
 
 from smartmin.views import (
     SmartCreateView,
@@ -14,6 +16,7 @@ from django import forms
 from django.conf import settings
 from django.contrib import messages
 from django.core.exceptions import ValidationError
+from django.db.models import Q
 from django.forms import Form
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedirect
 from django.urls import reverse
@@ -25,7 +28,7 @@ from django.views.decorators.csrf import csrf_exempt
 from temba.archives.models import Archive
 from temba.channels.models import Channel
 from temba.contacts.fields import OmniboxField
-from temba.contacts.models import TEL_SCHEME, ContactGroup, ContactURN
+from temba.contacts.models import TEL_SCHEME, Contact, ContactGroup, ContactURN
 from temba.flows.legacy.expressions import get_function_listing
 from temba.formax import FormaxMixin
 from temba.orgs.views import ModalMixin, OrgObjPermsMixin, OrgPermsMixin
@@ -116,12 +119,25 @@ class InboxView(OrgPermsMixin, SmartListView):
     add_button = True
     system_label = None
     fields = ("from", "message", "received")
-    search_fields = ("text__icontains", "contact__name__icontains", "contact__urns__path__icontains")
+    search_fields = ("text__icontains",)
     paginate_by = 100
     actions = ()
     allow_export = False
     show_channel_logs = False
 
+    # if set, searches also match rows whose contact has a matching name or URN. Rather than joining contacts and URNs,
+    # matching contacts are looked up first so that each part of the search can use its trigram index.
+    search_contact_field = "contact"
+
+    # search terms shorter than this can't use trigram indexes, so searches with them are limited to recent rows
+    search_min_indexed_length = 3
+
+    # the max number of matching contacts to search by as a list of ids, rather than by a subquery
+    search_max_contacts = 1000
+
+    # the max number of rows counted for such searches, and so the most that can be paged through
+    search_max_count = 10000
+
     def derive_label(self):
         return self.system_label
 
@@ -136,15 +152,67 @@ class InboxView(OrgPermsMixin, SmartListView):
             org = request.user.get_org()
             self.queryset = SystemLabel.get_queryset(org, self.system_label)
 
+    def derive_search_fields(self):
+        # if we're also searching by contact, we build the search ourselves
+        return None if self.search_contact_field else self.search_fields
+
+    def derive_queryset(self, **kwargs):
+        queryset = super().derive_queryset(**kwargs)
+
+        search = self.request.GET.get("search")
+        if search and self.search_contact_field:
+            queryset = self.search_queryset(queryset, search.split())
+
+        return queryset
+
+    def search_queryset(self, queryset, terms):
+        org = self.request.user.get_org()
+        term_queries = []
+
+        for term in terms:
+            field_queries = [Q(**{field: term}) for field in self.search_fields]
+            field_queries.append(Q(**{f"{self.search_contact_field}__in": self.get_search_contacts(org, term)}))
+            term_queries.append(reduce(operator.or_, field_queries))
+
+        # always filter by org, even if our queryset already is by label, so that the org scoped indexes can be used
+        return queryset.filter(reduce(operator.and_, term_queries), org=org) if term_queries else queryset
+
+    def get_search_contacts(self, org, term):
+        """
+        Gets the ids of contacts whose name or URN path contains the given term, as a list if there aren't too many so
+        that rows can be matched on their contact index, and as a subquery otherwise
+        """
+        by_name = Contact.objects.filter(org=org, name__icontains=term).values_list("id", flat=True)
+        by_urn = ContactURN.objects.filter(org=org, path__icontains=term).exclude(contact=None)
+        by_urn = by_urn.values_list("contact_id", flat=True)
+
+        contact_ids = set(by_name[: self.search_max_contacts + 1])
+        contact_ids.update(by_urn[: self.search_max_contacts + 1])
+
+        if len(contact_ids) > self.search_max_contacts:
+            return Contact.objects.filter(Q(id__in=by_name) | Q(id__in=by_urn)).values("id")
+
+        return list(contact_ids)
+
+    def is_search_indexed(self):
+        """
+        Whether the current search, if any, can be performed entirely with indexes
+        """
+        terms = self.request.GET.get("search", "").split()
+        return self.search_contact_field and all(len(t) >= self.search_min_indexed_length for t in terms)
+
     def get_queryset(self, **kwargs):
         queryset = super().get_queryset(**kwargs)
 
-        # if we are searching, limit to last 90
-        if "search" in self.request.GET:
+        # if we are searching without indexes, limit to last 90
+        if "search" in self.request.GET and not self.is_search_indexed():
             last_90 = timezone.now() - timedelta(days=90)
             queryset = queryset.filter(created_on__gte=last_90)
 
-        return queryset.order_by("-created_on", "-id").distinct("created_on", "id")
+        queryset = queryset.order_by("-created_on", "-id")
+
+        # searches which join contacts and URNs can match a row more than once
+        return queryset if self.search_contact_field else queryset.distinct("created_on", "id")
 
     def get_context_data(self, **kwargs):
         org = self.request.user.get_org()
@@ -159,6 +227,11 @@ class InboxView(OrgPermsMixin, SmartListView):
             elif isinstance(label, str):
                 patch_queryset_count(self.object_list, lambda: counts[label])
 
+        # otherwise bound how many rows we count so that large results don't make every page slow
+        elif self.search_contact_field:
+            matches = self.object_list.order_by()[: self.search_max_count]
+            patch_queryset_count(self.object_list, matches.count)
+
         context = super().get_context_data(**kwargs)
 
         folders = [
@@ -295,6 +368,7 @@ class BroadcastCRUDL(SmartCRUDL):
         title = _("Scheduled Messages")
         fields = ("contacts", "msgs", "sent", "status")
         search_fields = ("text__icontains", "contacts__urns__path__icontains")
+        search_contact_field = None
         template_name = "msgs/broadcast_schedule_list.haml"
         default_order = ("schedule__status", "schedule__next_fire", "-created_on")
         system_label = SystemLabel.TYPE_SCHEDULED
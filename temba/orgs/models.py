@@ -2,6 +2,8 @@ import calendar
 import itertools
 import logging
 import os
+import threading
+import time
 from collections import defaultdict
 from datetime import datetime, timedelta
 from decimal import Decimal
@@ -56,12 +58,45 @@ ORG_CREDITS_PURCHASED_CACHE_KEY = "org:%d:cache:credits_purchased"
 ORG_CREDITS_USED_CACHE_KEY = "org:%d:cache:credits_used"
 ORG_ACTIVE_TOPUP_KEY = "org:%d:cache:active_topup"
 ORG_ACTIVE_TOPUP_REMAINING = "org:%d:cache:credits_remaining:%d"
+ORG_ACTIVE_TOPUP_RESERVED = "org:%d:cache:credits_reserved:%d"
 ORG_CREDIT_EXPIRING_CACHE_KEY = "org:%d:cache:credits_expiring_soon"
 ORG_LOW_CREDIT_THRESHOLD_CACHE_KEY = "org:%d:cache:low_credits_threshold"
 
 ORG_LOCK_TTL = 60  # 1 minute
 ORG_CREDITS_CACHE_TTL = 7 * 24 * 60 * 60  # 1 week
 
+# credits are reserved from the active topup in blocks of this size, except for the last CREDIT_RESERVE_EDGE credits
+# of a topup which are reserved one at a time so that we don't overshoot it
+CREDIT_RESERVE_SIZE = 100
+CREDIT_RESERVE_EDGE = 100
+CREDIT_RESERVE_TTL = 30  # seconds before unused reserved credits are abandoned
+
+# reserves up to ARGV[1] credits from the cached remaining count of a topup, adding them to the count of reserved but
+# unused credits which expires after ARGV[3] seconds. Returns the number of credits reserved, or -1 if the remaining
+# count isn't cached.
+LUA_RESERVE_CREDITS = """
+local remaining = redis.call("get", KEYS[1])
+if remaining == false then
+  return -1
+end
+
+remaining = tonumber(remaining)
+local edge = tonumber(ARGV[2])
+if remaining <= 0 then
+  return 0
+end
+
+local size = 1
+if remaining > edge then
+  size = math.min(tonumber(ARGV[1]), remaining - edge)
+end
+
+redis.call("decrby", KEYS[1], size)
+redis.call("incrby", KEYS[2], size)
+redis.call("expire", KEYS[2], tonumber(ARGV[3]))
+return size
+"""
+
 
 class OrgLock(Enum):
     """
@@ -83,6 +118,41 @@ class OrgCache(Enum):
     credits = 2
 
 
+class CreditReservations(threading.local):
+    """
+    Blocks of credits reserved from the active topups of orgs which this thread can hand out without first having to
+    reserve them in Redis
+    """
+
+    def __init__(self):
+        self.blocks = {}  # org id -> (topup id, number of credits available, expires at)
+
+    def take(self, org_id, amount):
+        """
+        Takes credits from the block reserved for the given org, returning the topup id or None if there isn't one
+        """
+        block = self.blocks.get(org_id)
+        if block:
+            topup_id, available, expires_at = block
+            if available >= amount and expires_at > time.monotonic():
+                self.blocks[org_id] = (topup_id, available - amount, expires_at)
+                return topup_id
+        return None
+
+    def put(self, org_id, topup_id, available):
+        self.blocks[org_id] = (topup_id, available, time.monotonic() + CREDIT_RESERVE_TTL)
+
+    def pop(self, org_id):
+        """
+        Removes the block reserved for the given org, returning its topup id and the number of credits still available
+        """
+        topup_id, available, expires_at = self.blocks.pop(org_id, (None, 0, None))
+        return topup_id, available
+
+
+credit_reservations = CreditReservations()
+
+
 class Org(SmartModel):
     """
     An Org can have several users and is the main component that holds all Flows, Messages, Contacts, etc. Orgs
@@ -342,6 +412,10 @@ class Org(SmartModel):
         Clears the given cache types (currently just credits) for this org. Returns number of keys actually deleted
         """
         r = get_redis_connection()
+
+        # credits reserved by other threads stay reserved and are subtracted when the active topup is recalculated
+        self._release_credits(r)
+
         active_topup_keys = [ORG_ACTIVE_TOPUP_REMAINING % (self.pk, topup.pk) for topup in self.topups.all()]
         return r.delete(
             ORG_CREDITS_TOTAL_CACHE_KEY % self.pk,
@@ -420,8 +494,7 @@ class Org(SmartModel):
             Trigger.import_triggers(self, user, export_triggers, same_site)
 
         # with all the flows and dependencies committed, we can now have mailroom do full validation
-        for flow in new_flows:
-            mailroom.get_client().flow_validate(self, flow.as_json())
+        mailroom.get_client().flows_validate(self, [flow.as_json() for flow in new_flows])
 
     @classmethod
     def export_definitions(cls, site_link, components, include_fields=True, include_groups=True):
@@ -494,25 +567,9 @@ class Org(SmartModel):
         """
         Gets a channel for this org which supports the given scheme and role
         """
-        from temba.channels.models import Channel
-
-        channels = self.channels.filter(is_active=True, role__contains=role).order_by("-pk")
-
-        if scheme is not None:
-            channels = channels.filter(schemes__contains=[scheme])
+        from temba.channels.models import ChannelRoutes
 
-        channel = None
-        if country_code:
-            channel = channels.filter(country=country_code).first()
-
-        # no channel? try without country
-        if not channel:
-            channel = channels.first()
-
-        if channel and (role == Channel.ROLE_SEND or role == Channel.ROLE_CALL):
-            return channel.get_delegate(role)
-        else:
-            return channel
+        return ChannelRoutes.for_org(self).get_channel(scheme, country_code, role)
 
     @cached_property
     def cached_all_contacts_group(self):
@@ -522,74 +579,40 @@ class Org(SmartModel):
 
     def get_channel_for_role(self, role, scheme=None, contact_urn=None, country_code=None):
         from temba.contacts.models import TEL_SCHEME
-        from temba.channels.models import Channel
+        from temba.channels.models import Channel, ChannelRoutes
         from temba.contacts.models import ContactURN
 
+        routes = ChannelRoutes.for_org(self)
+
         if contact_urn:
             scheme = contact_urn.scheme
 
             # if URN has a previously used channel that is still active, use that
-            if contact_urn.channel and contact_urn.channel.is_active:  # pragma: no cover
-                previous_sender = contact_urn.channel.get_delegate(role)
+            previous = routes.get(contact_urn.channel_id) if contact_urn.channel_id else None
+            if previous:
+                previous_sender = routes.get_delegate(previous, role)
                 if previous_sender:
                     return previous_sender
 
             if scheme == TEL_SCHEME:
                 path = contact_urn.path
 
-                # we don't have a channel for this contact yet, let's try to pick one from the same carrier
-                # we need at least one digit to overlap to infer a channel
-                contact_number = path.strip("+")
-                prefix = 1
-                channel = None
-
                 # try to use only a channel in the same country
                 if not country_code:
                     country_code = ContactURN.derive_country_from_tel(path)
 
-                channels = []
-                if country_code:
-                    for c in self.channels.filter(is_active=True):
-                        if c.country == country_code and TEL_SCHEME in c.schemes:
-                            channels.append(c)
-
-                # no country specific channel, try to find any channel at all
-                if not channels:
-                    channels = [c for c in self.channels.filter(is_active=True) if TEL_SCHEME in c.schemes]
-
-                # filter based on role and activity (we do this in python as channels can be prefetched so it is quicker in those cases)
-                senders = []
-                for c in channels:
-                    if c.is_active and c.address and role in c.role and not c.parent_id:
-                        senders.append(c)
-                senders.sort(key=lambda chan: chan.id)
-
-                # if we have more than one match, find the one with the highest overlap
-                if len(senders) > 1:
-                    for sender in senders:
-                        config = sender.config
-                        channel_prefixes = config.get(Channel.CONFIG_SHORTCODE_MATCHING_PREFIXES, [])
-                        if not channel_prefixes or not isinstance(channel_prefixes, list):
-                            channel_prefixes = [sender.address.strip("+")]
-
-                        for chan_prefix in channel_prefixes:
-                            for idx in range(prefix, len(chan_prefix) + 1):
-                                if idx >= prefix and chan_prefix[0:idx] == contact_number[0:idx]:
-                                    prefix = idx
-                                    channel = sender
-                                else:
-                                    break
-                elif senders:
-                    channel = senders[0]
+                # we don't have a channel for this contact yet, let's try to pick one from the same carrier
+                # we need at least one digit to overlap to infer a channel
+                channel = routes.get_tel_sender(role, path.strip("+"), country_code)
 
                 if channel:
                     if role == Channel.ROLE_SEND:
-                        return channel.get_delegate(Channel.ROLE_SEND)
+                        return routes.get_delegate(channel, Channel.ROLE_SEND)
                     else:  # pragma: no cover
                         return channel
 
         # get any send channel without any country or URN hints
-        return self.get_channel(scheme, country_code, role)
+        return routes.get_channel(scheme, country_code, role)
 
     def get_send_channel(self, scheme=None, contact_urn=None):
         from temba.channels.models import Channel
@@ -1379,40 +1402,80 @@ class Org(SmartModel):
 
         Determines the active topup and returns that along with how many credits we were able
         to decrement it by. Amount decremented is not guaranteed to be the full amount requested.
+
+        Credits are taken from a block reserved from the active topup by this thread, and only when that is exhausted
+        do we reserve another block in a single atomic Redis operation.
         """
         # amount is hardcoded to `1` in database triggers that handle TopUpCredits relation when sending messages
         AMOUNT = 1
 
         r = get_redis_connection()
 
+        active_topup_id = credit_reservations.take(self.id, AMOUNT)
+        if not active_topup_id:
+            self._release_credits(r)
+
+            active_topup_id, reserved = self._reserve_credits()
+            if active_topup_id:
+                credit_reservations.put(self.id, active_topup_id, reserved - AMOUNT)
+
         # we always consider this a credit 'used' since un-applied msgs are pending
         # credit expenses for the next purchased topup
-        incrby_existing(ORG_CREDITS_USED_CACHE_KEY % self.id, AMOUNT)
-
-        # if we have an active topup cache, we need to decrement the amount remaining
-        active_topup_id = self.get_active_topup_id()
+        pipe = r.pipeline()
+        incrby_existing(ORG_CREDITS_USED_CACHE_KEY % self.id, AMOUNT, r=pipe)
         if active_topup_id:
+            incrby_existing(ORG_ACTIVE_TOPUP_RESERVED % (self.id, active_topup_id), -AMOUNT, r=pipe)
+        pipe.execute()
 
-            remaining = r.decr(ORG_ACTIVE_TOPUP_REMAINING % (self.id, active_topup_id), AMOUNT)
+        if active_topup_id:
+            return (active_topup_id, AMOUNT)
 
-            # near the edge, clear out our cache and calculate from the db
-            if not remaining or int(remaining) < 100:
-                active_topup_id = None
-                self.clear_credit_cache()
+        return None, 0
 
-        # calculate our active topup if we need to
-        if not active_topup_id:
-            active_topup = self.get_active_topup(force_dirty=True)
-            if active_topup:
-                active_topup_id = active_topup.id
+    def _reserve_credits(self):
+        """
+        Reserves a block of credits from the active topup in a single atomic Redis operation, returning the topup id
+        and the number of credits reserved. If the active topup is exhausted, we reconcile with the db to find the next
+        active topup.
+        """
+        r = get_redis_connection()
 
-                r.decr(ORG_ACTIVE_TOPUP_REMAINING % (self.id, active_topup.id), AMOUNT)
+        active_topup_id = self.get_active_topup_id()
+        reserved = 0
 
         if active_topup_id:
-            return (active_topup_id, AMOUNT)
+            reserved = self._reserve_credits_from(r, active_topup_id)
+
+            # topup is exhausted so clear out our cache so that it will be calculated from the db
+            if reserved == 0:
+                self.clear_credit_cache()
+
+        if reserved <= 0:
+            active_topup_id = self.get_active_topup_id(force_dirty=True)
+            if active_topup_id:
+                reserved = self._reserve_credits_from(r, active_topup_id)
+
+        if active_topup_id and reserved > 0:
+            return active_topup_id, reserved
 
         return None, 0
 
+    def _reserve_credits_from(self, r, topup_id):
+        script = r.register_script(LUA_RESERVE_CREDITS)
+        keys = (ORG_ACTIVE_TOPUP_REMAINING % (self.id, topup_id), ORG_ACTIVE_TOPUP_RESERVED % (self.id, topup_id))
+        return int(script(keys=keys, args=(CREDIT_RESERVE_SIZE, CREDIT_RESERVE_EDGE, CREDIT_RESERVE_TTL)))
+
+    def _release_credits(self, r):
+        """
+        Returns any unused credits in the block reserved by this thread to the cached remaining count of its topup
+        """
+        topup_id, available = credit_reservations.pop(self.id)
+        if topup_id and available:
+            pipe = r.pipeline()
+            incrby_existing(ORG_ACTIVE_TOPUP_REMAINING % (self.id, topup_id), available, r=pipe)
+            incrby_existing(ORG_ACTIVE_TOPUP_RESERVED % (self.id, topup_id), -available, r=pipe)
+            pipe.execute()
+
     def get_active_topup(self, force_dirty=False):
         topup_id = self.get_active_topup_id(force_dirty=force_dirty)
         if topup_id:
@@ -1443,7 +1506,7 @@ class Org(SmartModel):
 
     def _calculate_active_topup(self):
         """
-        Calculates the oldest non-expired topup that still has credits
+        Calculates the oldest non-expired topup that still has credits which haven't been reserved
         """
         non_expired_topups = self.topups.filter(is_active=True, expires_on__gte=timezone.now()).order_by(
             "expires_on", "id"
@@ -1454,13 +1517,17 @@ class Org(SmartModel):
             .filter(Q(used_credits__lt=F("credits")) | Q(used_credits=None))
         )
 
-        topup = active_topups.first()
-        if topup:
-            # initialize our active topup metrics
-            r = get_redis_connection()
-            ttl = self.get_topup_ttl(topup)
-            r.set(ORG_ACTIVE_TOPUP_REMAINING % (self.id, topup.id), topup.get_remaining(), ttl)
-            return topup.id, ttl
+        r = get_redis_connection()
+
+        for topup in active_topups:
+            # credits reserved by other threads will be used from this topup even though they're not in the db yet
+            reserved = int(r.get(ORG_ACTIVE_TOPUP_RESERVED % (self.id, topup.id)) or 0)
+            remaining = topup.get_remaining() - reserved
+            if remaining > 0:
+                # initialize our active topup metrics
+                ttl = self.get_topup_ttl(topup)
+                r.set(ORG_ACTIVE_TOPUP_REMAINING % (self.id, topup.id), remaining, ttl)
+                return topup.id, ttl
 
         return 0, 0
 
@@ -1991,6 +2058,7 @@ class Org(SmartModel):
 
             flow.category_counts.all().delete()
             flow.path_counts.all().delete()
+            flow.activity_counts.all().delete()
             flow.node_counts.all().delete()
             flow.exit_counts.all().delete()
 
@@ -2020,6 +2088,9 @@ class Org(SmartModel):
 
             channel.delete()
 
+        # delete the rollups of our channel counts
+        self.channel_count_rollups.all().delete()
+
         # release all archives objects and files for this org
         Archive.release_org_archives(self)
 
@@ -2575,6 +2646,7 @@ class TopUpCredits(SquashableModel):
     """
 
     SQUASH_OVER = ("topup_id",)
+    SQUASH_SUM = "used"
 
     topup = models.ForeignKey(
         TopUp, on_delete=models.PROTECT, help_text=_("The topup these credits are being used against")
@@ -2587,20 +2659,6 @@ class TopUpCredits(SquashableModel):
     def __str__(self):  # pragma: no cover
         return f"{self.topup} (Used: {self.used})"
 
-    @classmethod
-    def get_squash_query(cls, distinct_set):
-        sql = """
-        WITH deleted as (
-            DELETE FROM %(table)s WHERE "topup_id" = %%s RETURNING "used"
-        )
-        INSERT INTO %(table)s("topup_id", "used", "is_squashed")
-        VALUES (%%s, GREATEST(0, (SELECT SUM("used") FROM deleted)), TRUE);
-        """ % {
-            "table": cls._meta.db_table
-        }
-
-        return sql, (distinct_set.topup_id,) * 2
-
 
 class CreditAlert(SmartModel):
     """
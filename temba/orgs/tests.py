@@ -12,6 +12,7 @@ import stripe
 import stripe.error
 from bs4 import BeautifulSoup
 from dateutil.relativedelta import relativedelta
+from django_redis import get_redis_connection
 
 from django.conf import settings
 from django.contrib.auth.models import Group, User
@@ -27,7 +28,8 @@ from temba.airtime.models import AirtimeTransfer
 from temba.api.models import APIToken, Resthook, WebHookEvent, WebHookResult
 from temba.archives.models import Archive
 from temba.campaigns.models import Campaign, CampaignEvent
-from temba.channels.models import Channel
+from temba.channels.models import Channel, ChannelCountRollup
+from temba.channels.tasks import squash_channelcounts
 from temba.contacts.models import (
     TEL_SCHEME,
     TWITTER_SCHEME,
@@ -38,11 +40,12 @@ from temba.contacts.models import (
     ContactURN,
     ExportContactsTask,
 )
-from temba.flows.models import ActionSet, ExportFlowResultsTask, Flow, FlowLabel, FlowRun
+from temba.flows.models import ActionSet, ExportFlowResultsTask, Flow, FlowActivityCount, FlowLabel, FlowRun
+from temba.flows.tasks import squash_flowpathcounts
 from temba.locations.models import AdminBoundary
 from temba.middleware import BrandingMiddleware
 from temba.msgs.models import ExportMessagesTask, Label, Msg
-from temba.orgs.models import Debit, UserSettings
+from temba.orgs.models import Debit, UserSettings, credit_reservations
 from temba.tests import ESMockWithScroll, MockResponse, TembaTest, matchers
 from temba.tests.engine import MockSessionWriter
 from temba.tests.s3 import MockS3Client
@@ -378,6 +381,18 @@ class OrgDeleteTest(TembaTest):
     def test_release_parent_immediately(self):
         self.release_org(self.parent_org, self.child_org, immediately=True)
 
+    def test_release_parent_immediately_with_squashed_counts(self):
+        squash_channelcounts()
+        squash_flowpathcounts()
+
+        self.assertTrue(ChannelCountRollup.objects.filter(org=self.parent_org).exists())
+        self.assertTrue(FlowActivityCount.objects.filter(flow__org=self.parent_org).exists())
+
+        self.release_org(self.parent_org, self.child_org, immediately=True)
+
+        self.assertFalse(ChannelCountRollup.objects.filter(org=self.parent_org).exists())
+        self.assertFalse(FlowActivityCount.objects.filter(flow__org=self.parent_org).exists())
+
     def test_release_child_immediately(self):
 
         # 300 credits were given to our child org and each used one
@@ -442,6 +457,40 @@ class OrgTest(TembaTest):
         self.assertEqual(mtn, self.org.get_channel_for_role(Channel.ROLE_SEND, "tel", mtn_urn))
         self.assertEqual(tigo, self.org.get_channel_for_role(Channel.ROLE_SEND, "tel", tigo_urn))
 
+    def test_channel_routes(self):
+        self.releaseChannels()
+
+        mtn = Channel.create(self.org, self.admin, "RW", "KN", "MTN", "5050", {"matching_prefixes": ["25078"]})
+        tigo = Channel.create(self.org, self.admin, "RW", "KN", "Tigo", "5051", {"matching_prefixes": ["25072"]})
+        us = Channel.create(self.org, self.admin, "US", "EX", "US", "+12065551212")
+
+        joe = self.create_contact("Joe")
+        mtn_urn = ContactURN.get_or_create(self.org, joe, "tel:+250788383383")
+        tigo_urn = ContactURN.get_or_create(self.org, joe, "tel:+250722383383")
+        other_urn = ContactURN.get_or_create(self.org, joe, "tel:+250755383383")
+
+        self.assertEqual(mtn, self.org.get_channel_for_role(Channel.ROLE_SEND, "tel", mtn_urn))
+
+        # once the routing table is built, routing doesn't need any queries
+        with self.assertNumQueries(0):
+            self.assertEqual(tigo, self.org.get_channel_for_role(Channel.ROLE_SEND, "tel", tigo_urn))
+
+            # no prefix overlap beyond the country code so the last matching sender wins
+            self.assertEqual(tigo, self.org.get_channel_for_role(Channel.ROLE_SEND, "tel", other_urn))
+
+            # no URN so we get the newest channel, preferring ones in the given country
+            self.assertEqual(us, self.org.get_send_channel("tel"))
+            self.assertEqual(tigo, self.org.get_channel("tel", "RW", Channel.ROLE_SEND))
+
+        # adding a delegate sender invalidates the routing table
+        delegate = Channel.create(self.org, self.admin, "RW", "NX", "Bulk", None, role=Channel.ROLE_SEND, parent=mtn)
+        self.assertEqual(delegate, self.org.get_channel_for_role(Channel.ROLE_SEND, "tel", mtn_urn))
+        self.assertEqual(mtn, self.org.get_channel_for_role(Channel.ROLE_RECEIVE, "tel", mtn_urn))
+
+        # as does releasing a channel
+        tigo.release()
+        self.assertEqual(delegate, self.org.get_channel_for_role(Channel.ROLE_SEND, "tel", tigo_urn))
+
     def test_get_send_channel_for_tel_short_code(self):
         self.releaseChannels()
         short_code = Channel.create(self.org, self.admin, "RW", "KN", "MTN", "5050")
@@ -1618,6 +1667,65 @@ class OrgTest(TembaTest):
         self.assertTrue(self.org.is_multi_user_tier())
         self.assertTrue(self.org.is_multi_org_tier())
 
+    @patch("temba.orgs.models.CREDIT_RESERVE_SIZE", 10)
+    @patch("temba.orgs.models.CREDIT_RESERVE_EDGE", 5)
+    def test_credit_reservations(self):
+        r = get_redis_connection()
+        contact = self.create_contact("Usain Bolt", "+250788123123")
+        welcome_topup = TopUp.objects.get()
+        TopUp.objects.filter(id=welcome_topup.id).update(credits=30)
+        other_topup = TopUp.create(self.admin, price=0, credits=100)
+
+        welcome_remaining_key = f"org:{self.org.id}:cache:credits_remaining:{welcome_topup.id}"
+        other_remaining_key = f"org:{self.org.id}:cache:credits_remaining:{other_topup.id}"
+        other_reserved_key = f"org:{self.org.id}:cache:credits_reserved:{other_topup.id}"
+
+        # first credit reserves a block of 10 from the topup and the rest are handed out without going to redis
+        with patch("temba.orgs.models.Org._reserve_credits", autospec=True, side_effect=Org._reserve_credits) as mock:
+            self.create_incoming_msgs(contact, 10)
+            self.assertEqual(1, mock.call_count)
+
+        self.assertEqual(20, int(r.get(welcome_remaining_key)))
+        self.assertEqual(10, self.org.get_credits_used())
+        self.assertEqual(120, self.org.get_credits_remaining())
+
+        # credits used are added to the cached count as they're used
+        self.create_incoming_msgs(contact, 10)
+        self.assertEqual(10, int(r.get(welcome_remaining_key)))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(20, self.org.get_credits_used())
+            self.assertEqual(110, self.org.get_credits_remaining())
+
+        # near the end of the topup credits are reserved one at a time, and once it's exhausted we move to the next
+        self.create_incoming_msgs(contact, 11)
+        self.assertEqual(30, welcome_topup.msgs.count())
+        self.assertEqual(1, other_topup.msgs.count())
+        self.assertEqual(90, int(r.get(other_remaining_key)))
+        self.assertEqual(9, int(r.get(other_reserved_key)))
+        self.assertEqual(31, self.org.get_credits_used())
+        self.assertEqual(99, self.org.get_credits_remaining())
+
+        # clearing the credit cache releases our reserved block
+        self.org.clear_credit_cache()
+        self.assertEqual(0, int(r.get(other_reserved_key)))
+
+        msg = self.create_incoming_msg(contact, "Hi")
+        self.assertEqual(other_topup, msg.topup)
+        self.assertEqual(89, int(r.get(other_remaining_key)))
+        self.assertEqual(9, int(r.get(other_reserved_key)))
+
+        # credits still reserved by other threads aren't available when the active topup is recalculated
+        credit_reservations.blocks.clear()
+        self.org.clear_credit_cache()
+        self.assertEqual(other_topup.id, self.org.get_active_topup_id())
+        self.assertEqual(89, int(r.get(other_remaining_key)))
+
+        # and a topup whose remaining credits are all reserved is skipped
+        r.set(other_reserved_key, 98)
+        self.org.clear_credit_cache()
+        self.assertEqual(0, self.org.get_active_topup_id())
+
     @patch("temba.orgs.views.Client", MockTwilioClient)
     @patch("twilio.request_validator.RequestValidator", MockRequestValidator)
     def test_twilio_connect(self):
@@ -3695,6 +3803,16 @@ class BulkExportTest(TembaTest):
         self.assertEqual(dep_graph[child], {parent})
         self.assertEqual(dep_graph[parent], {child})
 
+    def test_import_stage_timings(self):
+        with self.assertLogs("temba.flows.models", level="INFO") as logs:
+            self.import_file("mixed_versions")
+
+        self.assertEqual(1, len(logs.output))
+        self.assertIn(f"Imported 2 flow definitions for org #{self.org.id}: legacy=", logs.output[0])
+
+        for stage in ("inspect", "dependencies", "clone", "reinspect", "save"):
+            self.assertIn(f" {stage}=", logs.output[0])
+
     def test_import_dependency_types(self):
         self.import_file("all_dependency_types")
 
@@ -62,6 +62,9 @@ AWS_BUCKET_DOMAIN = AWS_STORAGE_BUCKET_NAME + ".s3.amazonaws.com"
 # bucket where archives files are stored
 ARCHIVE_BUCKET = "dl-temba-archives"
 
+# whether reading archives can save indexes of them alongside them in the archive bucket
+ARCHIVE_INDEX_WRITES = False
+
 # -----------------------------------------------------------------------------------
 # On Unix systems, a value of None will cause Django to use the same
 # timezone as the operating system.
@@ -875,6 +878,7 @@ CELERYBEAT_SCHEDULE = {
     "squash-msgcounts": {"task": "squash_msgcounts", "schedule": timedelta(seconds=60)},
     "squash-topupcredits": {"task": "squash_topupcredits", "schedule": timedelta(seconds=60)},
     "squash-contactgroupcounts": {"task": "squash_contactgroupcounts", "schedule": timedelta(seconds=60)},
+    "reevaluate-dynamic-groups": {"task": "reevaluate_dynamic_groups", "schedule": timedelta(seconds=300)},
     "resolve-twitter-ids-task": {"task": "resolve_twitter_ids_task", "schedule": timedelta(seconds=900)},
     "refresh-jiochat-access-tokens": {"task": "refresh_jiochat_access_tokens", "schedule": timedelta(seconds=3600)},
     "refresh-wechat-access-tokens": {"task": "refresh_wechat_access_tokens", "schedule": timedelta(seconds=3600)},
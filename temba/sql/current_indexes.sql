@@ -12,6 +12,10 @@ ON channels_channel(last_seen ASC NULLS LAST) WHERE channel_type = 'A' and is_ac
 CREATE INDEX channels_channelcount_unsquashed
 ON channels_channelcount(channel_id, count_type, day) WHERE NOT is_squashed;
 
+-- index for fast fetching of unsquashed rollups
+CREATE INDEX channels_channelcountrollup_unsquashed
+ON channels_channelcountrollup(org_id, channel_type, count_type, period, day) WHERE NOT is_squashed;
+
 CREATE INDEX channels_channellog_channel_created_on
 ON channels_channellog(channel_id, created_on desc);
 
@@ -24,6 +28,9 @@ CREATE INDEX contacts_contact_modified_on ON contacts_contact(modified_on);
 
 CREATE INDEX contacts_contact_name ON contacts_contact (org_id, UPPER(name));
 
+-- trigram indexes for searching contacts and messages in an org by substring
+CREATE INDEX contacts_contact_name_trgm ON contacts_contact USING GIN (org_id, UPPER(name) gin_trgm_ops);
+
 CREATE INDEX contacts_contact_org_modified_id_active
 ON contacts_contact (org_id, modified_on DESC, id DESC)
 WHERE is_active = true;
@@ -40,7 +47,12 @@ CREATE INDEX contacts_contacturn_org_scheme_display ON contacts_contacturn (org_
 
 CREATE INDEX contacts_contacturn_path ON contacts_contacturn (org_id, UPPER(path), contact_id);
 
+CREATE INDEX contacts_contacturn_path_trgm ON contacts_contacturn USING GIN (org_id, UPPER(path) gin_trgm_ops);
+
 -- indexes for fast fetching of unsquashed rows
+CREATE INDEX flows_flowactivitycount_unsquashed
+ON flows_flowactivitycount(flow_id, from_uuid, scope, bucket, day) WHERE NOT is_squashed;
+
 CREATE INDEX flows_flowcategorycount_unsquashed
 ON flows_flowcategorycount(flow_id, node_uuid, result_key, result_name, category_name) WHERE NOT is_squashed;
 
@@ -128,6 +140,8 @@ CREATE INDEX msgs_msg_responded_to_not_null
 ON msgs_msg (response_to_id)
 WHERE response_to_id IS NOT NULL;
 
+CREATE INDEX msgs_msg_text_trgm ON msgs_msg USING GIN (org_id, UPPER(text) gin_trgm_ops);
+
 CREATE INDEX msgs_msg_uuid_not_null ON msgs_msg (uuid) WHERE uuid IS NOT NULL;
 
 CREATE INDEX msgs_msg_visibility_type_created_id_where_inbound
@@ -1,6 +1,8 @@
 import gzip
 import io
 
+from botocore.exceptions import ClientError
+
 from temba.utils import json
 
 
@@ -12,24 +14,40 @@ class MockS3Client:
     def __init__(self):
         self.objects = {}
 
-    def put_jsonl(self, bucket, key, records):
+    def put_jsonl(self, bucket, key, records, member_size=None):
+        """
+        Puts a gzipped JSONL object, optionally writing every member_size records as a separate gzip member
+        """
         stream = io.BytesIO()
-        gz = gzip.GzipFile(fileobj=stream, mode="wb")
+        member_size = member_size or max(len(records), 1)
 
-        for record in records:
-            gz.write(json.dumps(record).encode("utf-8"))
-            gz.write(b"\n")
-        gz.close()
+        for i in range(0, max(len(records), 1), member_size):
+            gz = gzip.GzipFile(fileobj=stream, mode="wb")
+            for record in records[i : i + member_size]:
+                gz.write(json.dumps(record).encode("utf-8"))
+                gz.write(b"\n")
+            gz.close()
 
         self.objects[(bucket, key)] = stream
 
-    def get_object(self, Bucket, Key, **kwargs):
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = io.BytesIO(Body)
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+
         stream = self.objects[(Bucket, Key)]
         stream.seek(0)
+
+        if Range:
+            start, end = Range[len("bytes=") :].split("-")
+            stream = io.BytesIO(stream.getvalue()[int(start) : int(end) + 1])
+
         return {"Bucket": Bucket, "Key": Key, "Body": stream}
 
     def delete_object(self, Bucket, Key, **kwargs):
-        del self.objects[(Bucket, Key)]
+        self.objects.pop((Bucket, Key), None)
         return {"DeleteMarker": False, "VersionId": "versionId", "RequestCharged": "requester"}
 
     def list_objects_v2(self, Bucket, Prefix, **kwargs):
@@ -1,3 +1,6 @@
+import threading
+from collections import OrderedDict
+
 from django_redis import get_redis_connection
 
 from django.utils.encoding import force_text
@@ -64,3 +67,47 @@ def incrby_existing(key, delta, r=None):
         "end"
     )
     r.eval(lua, 1, key, delta)
+
+
+class LRUCache:
+    """
+    A bounded process-local cache which evicts the least recently used items and counts hits and misses
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        Gets the current size and hit/miss counts of this cache
+        """
+        with self.lock:
+            return {"size": len(self.items), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
@@ -1,10 +1,28 @@
+import base64
+import heapq
+import json
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan
 from elasticsearch_dsl import Search as es_Search
+from elasticsearch_dsl.connections import get_connection
 
 from django.conf import settings
 
 ES = Elasticsearch(hosts=[settings.ELASTICSEARCH_URL])
 
+# the number of slices scrolled concurrently when scanning ids
+SCAN_SLICES = 4
+
+# the number of hits fetched by each scroll request
+SCAN_SIZE = 5000
+
+# the default number of hits fetched by each search_after request
+PAGE_SIZE = 50
+
 
 class ModelESSearch(es_Search):
     """
@@ -25,3 +43,98 @@ class ModelESSearch(es_Search):
         new_search.model = self.model
 
         return new_search
+
+    def scan_ids(self, slices=SCAN_SLICES, sort=False):
+        """
+        Scans the ids of all matching documents, fetching only the id doc value of each hit and splitting the scroll
+        into slices which are fetched concurrently. If sort is true, returns a compact sorted array of unique ints,
+        otherwise a list of ids in no particular order.
+        """
+        es = get_connection(self._using)
+
+        query = self.to_dict()
+        query["_source"] = False
+        query["docvalue_fields"] = ["id"]
+
+        if slices > 1:
+            queries = [dict(query, slice={"id": s, "max": slices}) for s in range(slices)]
+        else:
+            queries = [query]
+
+        def scan_slice(slice_query):
+            hits = scan(es, query=slice_query, index=self._index, size=SCAN_SIZE, **self._params)
+            ids = array("l", (_get_hit_id(hit) for hit in hits))
+            return array("l", sorted(ids)) if sort else ids
+
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            slice_ids = list(executor.map(scan_slice, queries))
+
+        if not sort:
+            return list(chain(*slice_ids))
+
+        merged = array("l")
+        for id in heapq.merge(*slice_ids):
+            if not merged or merged[-1] != id:
+                merged.append(id)
+        return merged
+
+    def sort_with_id(self):
+        """
+        Adds id as the final sort field, if it isn't already sorted on, so that hits have a total order and the sort
+        values of any hit can be used to continue after it
+        """
+        if "id" in [_get_sort_field(s) for s in self._sort]:
+            return self
+
+        return self.sort(*self._sort, {"id": {"order": "desc"}})
+
+    def search_after(self, after=None, size=PAGE_SIZE):
+        """
+        Fetches the page of hits which come after the given sort values. Unlike paging with from and size, this has the
+        same cost however deep it goes and isn't limited to the max result window. Returns the response and the sort
+        values of its last hit to continue from, or None if there are no more hits.
+        """
+        search = self.sort_with_id()[:size]
+        if after:
+            search = search.extra(search_after=after)
+
+        response = search.execute()
+        hits = response.hits
+
+        return response, (list(hits[-1].meta.sort) if len(hits) == size else None)
+
+
+def encode_search_cursor(sort_values):
+    """
+    Encodes the sort values of a hit as an opaque cursor for search_after pagination
+    """
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode("utf-8")).decode("utf-8")
+
+
+def decode_search_cursor(cursor):
+    """
+    Decodes a cursor from encode_search_cursor, raising a ValueError if it isn't valid
+    """
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8"))
+    except ValueError:
+        raise ValueError("Invalid search cursor")
+
+    if not isinstance(sort_values, list) or not sort_values:
+        raise ValueError("Invalid search cursor")
+
+    return sort_values
+
+
+def _get_sort_field(sort):
+    # sorts are either field names, possibly prefixed with - for descending, or dicts keyed by field name
+    if isinstance(sort, str):
+        return sort.lstrip("-")
+    return next(iter(sort))
+
+
+def _get_hit_id(hit):
+    # ids come from doc values when they've been requested, and from the source otherwise
+    if "fields" in hit:
+        return int(hit["fields"]["id"][0])
+    return int(hit["_source"]["id"])
@@ -56,6 +56,9 @@ class BaseExportTask(TembaModel):
     # log progress after this number of exported objects have been exported
     LOG_PROGRESS_PER_ROWS = 10000
 
+    # how many objects are fetched from the database at a time
+    BATCH_SIZE = 1000
+
     org = models.ForeignKey(
         "orgs.Org", on_delete=models.PROTECT, related_name="%(class)ss", help_text=_("The organization of the user.")
     )
@@ -0,0 +1,477 @@
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+from xlsxlite.writer import XLSXBook, XLSXSheet
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from temba.channels.models import Channel
+from temba.contacts.models import TEL_SCHEME, URN, Contact, ContactField, ContactGroup, ContactURN, ExportContactsTask
+from temba.flows.models import ExportFlowResultsTask, Flow, FlowRun
+from temba.msgs.models import INCOMING, OUTGOING, SENT, ExportMessagesTask, Msg
+from temba.orgs.models import Org
+from temba.utils import chunk_list, json
+from temba.values.constants import Value
+
+from .test_db import CONTACT_NAMES, DisableTriggersOn
+
+# default file to save results to
+DEFAULT_RESULTS_FILE = ".perf_exports"
+
+# default number of times to run each export
+DEFAULT_NUM_RUNS = 1
+
+# allow this much percentage change in total time from previous results
+ALLOWED_CHANGE_PERCENTAGE = 10
+
+# the fields, groups and flow created for generated orgs
+FIELDS = (
+    {"key": "gender", "label": "Gender", "value_type": Value.TYPE_TEXT},
+    {"key": "age", "label": "Age", "value_type": Value.TYPE_NUMBER},
+    {"key": "joined", "label": "Joined On", "value_type": Value.TYPE_DATETIME},
+)
+GROUPS = (("Reporters", 0.9), ("Farmers", 0.5), ("Doctors", 0.1))
+FLOW = "media/test_flows/favorites_timeout.json"
+
+GENERATE_BATCH_SIZE = 5000
+
+
+class StageTimer:
+    """
+    Accumulates the time spent in named stages by temporarily wrapping methods of the given classes. Methods which
+    return generators are timed only while the generator is producing items.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages  # (stage name, class, method name)
+        self.times = {name: 0.0 for name, cls, method in stages}
+        self.originals = []
+
+    def _wrap(self, name, func):
+        timer = self
+
+        def timed_generator(gen):
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    timer.times[name] += time.perf_counter() - start
+                yield item
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                timer.times[name] += time.perf_counter() - start
+
+            return timed_generator(result) if hasattr(result, "__next__") else result
+
+        return wrapper
+
+    def __enter__(self):
+        for name, cls, method in self.stages:
+            original = getattr(cls, method)
+            self.originals.append((cls, method, original))
+            setattr(cls, method, self._wrap(name, original))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for cls, method, original in reversed(self.originals):
+            setattr(cls, method, original)
+
+
+class PeakRSSMonitor:
+    """
+    Samples the resident set size of this process on a background thread to find its peak over a period. Falls back
+    to the lifetime peak from getrusage on platforms without /proc.
+    """
+
+    INTERVAL = 0.05
+
+    def __init__(self):
+        self.peak = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, current_rss())
+            if self.stop.wait(self.INTERVAL):
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop.set()
+        self.thread.join()
+
+
+def current_rss():
+    """
+    Gets the current resident set size of this process in MiB
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except IOError:
+        pass
+
+    rusage_denom = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rusage_denom
+
+
+class Command(BaseCommand):  # pragma: no cover
+    help = "Benchmarks contact, message and flow results exports, optionally generating a synthetic org to export"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--org", type=int, action="store", dest="org_id", default=None, help="ID of org to export")
+        parser.add_argument(
+            "--generate", action="store_true", dest="generate", help="Generate a new synthetic org to export"
+        )
+        parser.add_argument("--contacts", type=int, action="store", dest="num_contacts", default=10000)
+        parser.add_argument("--msgs", type=int, action="store", dest="num_msgs", default=50000)
+        parser.add_argument("--runs", type=int, action="store", dest="num_runs", default=20000)
+        parser.add_argument("--seed", type=int, action="store", dest="seed", default=None)
+        parser.add_argument(
+            "--exports",
+            type=str,
+            action="store",
+            dest="exports",
+            default="contacts,messages,results",
+            help="Comma separated exports to benchmark.",
+        )
+        parser.add_argument(
+            "--num-runs",
+            type=int,
+            action="store",
+            dest="num_runs_each",
+            default=DEFAULT_NUM_RUNS,
+            help="Number of times to run each export. Default is %d." % DEFAULT_NUM_RUNS,
+        )
+        parser.add_argument(
+            "--results-file",
+            type=str,
+            action="store",
+            dest="results_file",
+            default=DEFAULT_RESULTS_FILE,
+            help="Path of file to write results to. Default is '%s'." % DEFAULT_RESULTS_FILE,
+        )
+
+    def handle(
+        self,
+        org_id,
+        generate,
+        num_contacts,
+        num_msgs,
+        num_runs,
+        seed,
+        exports,
+        num_runs_each,
+        results_file,
+        *args,
+        **options,
+    ):
+        if generate:
+            org = self.generate_org(num_contacts, num_msgs, num_runs, seed)
+        elif org_id:
+            org = Org.objects.filter(id=org_id, is_active=True).first()
+            if not org:
+                raise CommandError(f"No active org with id {org_id}")
+        else:
+            raise CommandError("Specify an org to export with --org or generate one with --generate")
+
+        benchmarks = {"contacts": self.bench_contacts, "messages": self.bench_messages, "results": self.bench_results}
+        names = exports.split(",")
+        for name in names:
+            if name not in benchmarks:
+                raise CommandError(f"Unknown export '{name}', must be one of {', '.join(benchmarks.keys())}")
+
+        prev_results = self.load_previous_results(results_file)
+        started = datetime.utcnow()
+        user = org.administrators.first()
+
+        self.stdout.write(
+            self.style.MIGRATE_HEADING(
+                f"Org #{org.id} ({org.contacts.count()} contacts, {org.msgs.count()} msgs, {org.runs.count()} runs)"
+            )
+        )
+
+        results = []
+        for name in names:
+            for r in range(num_runs_each):
+                result = benchmarks[name](org, user)
+                result["export"] = name
+                results.append(result)
+
+                self.stdout.write(self.format_result(result, prev_results.get((org.id, name))))
+
+        self.save_results(results_file, started, org, results)
+
+    def bench_contacts(self, org, user):
+        export = ExportContactsTask.create(org, user, group_memberships=ContactGroup.user_groups.filter(org=org))
+        stages = [("fetch", ExportContactsTask, "_get_export_batch")]
+        return self.run_export(export, stages)
+
+    def bench_messages(self, org, user):
+        export = ExportMessagesTask.create(org, user)
+        stages = [("fetch", ExportMessagesTask, "_get_msg_batches")]
+        return self.run_export(export, stages)
+
+    def bench_results(self, org, user):
+        flows = list(org.flows.filter(is_active=True))
+        fields = list(ContactField.user_fields.active_for_org(org=org))
+        export = ExportFlowResultsTask.create(org, user, flows, fields, True, True, (), ())
+        stages = [("fetch", ExportFlowResultsTask, "_get_run_batches")]
+        return self.run_export(export, stages)
+
+    def run_export(self, export, fetch_stages):
+        """
+        Runs an export end to end, excluding uploading the file and notifying the user, and returns its timings
+        """
+        stages = fetch_stages + [("write", XLSXSheet, "append_row"), ("write", XLSXBook, "finalize")]
+
+        start = time.perf_counter()
+        rss_before = current_rss()
+
+        with PeakRSSMonitor() as monitor, StageTimer(stages) as timer:
+            temp_file, extension = export.write_export()
+
+        total = time.perf_counter() - start
+
+        file_size = os.path.getsize(temp_file.name)
+        temp_file.close()
+        if os.path.exists(temp_file.name):
+            os.unlink(temp_file.name)
+
+        export.update_status(export.STATUS_COMPLETE)
+
+        fetch, write = timer.times["fetch"], timer.times["write"]
+
+        return {
+            "total": round(total, 3),
+            "stages": {"fetch": round(fetch, 3), "format": round(total - fetch - write, 3), "write": round(write, 3)},
+            "peak_rss_mb": round(monitor.peak, 1),
+            "rss_growth_mb": round(monitor.peak - rss_before, 1),
+            "file_size": file_size,
+        }
+
+    def format_result(self, result, prev_total):
+        stages = result["stages"]
+        line = (
+            f" > {result['export']}: {result['total']:.2f}s "
+            f"(fetch {stages['fetch']:.2f}s, format {stages['format']:.2f}s, write {stages['write']:.2f}s), "
+            f"peak RSS {result['peak_rss_mb']:.0f} MiB (+{result['rss_growth_mb']:.0f} MiB)"
+        )
+
+        if prev_total:
+            change = 100 * (result["total"] - prev_total) / prev_total
+            style = self.style.ERROR if change > ALLOWED_CHANGE_PERCENTAGE else self.style.SUCCESS
+            line += " " + style(f"{change:+.0f}%")
+
+        return line
+
+    def load_previous_results(self, results_file):
+        """
+        Extracts the total time of each export from a previous results file so they can be compared
+        """
+        try:
+            with open(results_file, "r") as f:
+                data = json.load(f)
+                return {(data["org"], r["export"]): r["total"] for r in data["results"]}
+        except (IOError, ValueError, KeyError):
+            return {}
+
+    def save_results(self, path, started, org, results):
+        with open(path, "w") as f:
+            json.dump({"started": started.isoformat(), "org": org.id, "results": results}, f, indent=4)
+
+    def generate_org(self, num_contacts, num_msgs, num_runs, seed):
+        """
+        Generates a new org with the given number of contacts, messages and flow runs
+        """
+        seed = seed if seed is not None else random.randrange(0, 65536)
+        rand = random.Random(seed)
+        now = timezone.now()
+
+        self.stdout.write(
+            f"Generating org with {num_contacts} contacts, {num_msgs} msgs, {num_runs} runs (seed={seed})..."
+        )
+
+        superuser = User.objects.filter(is_superuser=True).first()
+        if not superuser:
+            raise CommandError("Create a superuser first")
+
+        org = Org.objects.create(
+            name=f"Export Benchmark {seed}",
+            timezone=pytz.timezone("Africa/Kigali"),
+            brand="rapidpro.io",
+            created_by=superuser,
+            modified_by=superuser,
+        )
+        org.initialize(topup_size=(num_msgs * 2) or 1000)
+
+        admin = User.objects.create_user(f"bench{org.id}@nyaruka.com", f"bench{org.id}@nyaruka.com")
+        org.administrators.add(admin)
+        admin.set_org(org)
+
+        channel = Channel.objects.create(
+            org=org,
+            name="Android",
+            channel_type=Channel.TYPE_ANDROID,
+            address="1234",
+            schemes=[TEL_SCHEME],
+            created_by=admin,
+            modified_by=admin,
+        )
+
+        fields = {
+            f["key"]: ContactField.user_fields.create(
+                org=org,
+                key=f["key"],
+                label=f["label"],
+                value_type=f["value_type"],
+                show_in_table=True,
+                created_by=admin,
+                modified_by=admin,
+            )
+            for f in FIELDS
+        }
+        groups = [(ContactGroup.create_static(org, admin, name), prob) for name, prob in GROUPS]
+        all_group = ContactGroup.system_groups.get(org=org, group_type=ContactGroup.TYPE_ALL)
+
+        with open(FLOW, "r") as flow_file:
+            org.import_app(json.load(flow_file), admin)
+        flow = Flow.objects.filter(org=org, is_active=True).order_by("id").first()
+
+        names = [f"{c1} {c2}" for c2 in CONTACT_NAMES[1] for c1 in CONTACT_NAMES[0]]
+
+        # contacts as tuples of (id, urn id) so we don't have to hold them all in memory
+        contacts = []
+
+        with DisableTriggersOn(Contact, ContactURN, ContactGroup.contacts.through, Msg):
+            for batch in chunk_list(range(num_contacts), GENERATE_BATCH_SIZE):
+                batch_contacts = []
+                for c in batch:
+                    joined = now - timedelta(days=rand.randint(1, 1000))
+                    age = rand.randint(16, 80)
+                    batch_contacts.append(
+                        Contact(
+                            org=org,
+                            name=rand.choice(names),
+                            language=rand.choice((None, "eng", "fra")),
+                            created_by=admin,
+                            modified_by=admin,
+                            fields={
+                                str(fields["gender"].uuid): {"text": rand.choice(("M", "F"))},
+                                str(fields["age"].uuid): {"text": str(age), "number": age},
+                                str(fields["joined"].uuid): {
+                                    "text": org.format_datetime(joined, show_time=False),
+                                    "datetime": joined.isoformat(),
+                                },
+                            },
+                        )
+                    )
+                Contact.objects.bulk_create(batch_contacts)
+
+                batch_urns = []
+                memberships = []
+                for c, contact in zip(batch, batch_contacts):
+                    tel = "+2507%08d" % c
+                    batch_urns.append(
+                        ContactURN(
+                            org=org,
+                            contact=contact,
+                            priority=50,
+                            scheme=TEL_SCHEME,
+                            path=tel,
+                            identity=URN.from_tel(tel),
+                        )
+                    )
+                    memberships.append(ContactGroup.contacts.through(contact=contact, contactgroup=all_group))
+                    for group, prob in groups:
+                        if rand.random() < prob:
+                            memberships.append(ContactGroup.contacts.through(contact=contact, contactgroup=group))
+
+                ContactURN.objects.bulk_create(batch_urns)
+                ContactGroup.contacts.through.objects.bulk_create(memberships)
+
+                contacts.extend((contact.id, urn.id) for contact, urn in zip(batch_contacts, batch_urns))
+
+            for batch in chunk_list(range(num_msgs), GENERATE_BATCH_SIZE):
+                batch_msgs = []
+                for m in batch:
+                    contact_id, urn_id = rand.choice(contacts)
+                    incoming = rand.random() < 0.5
+                    created_on = now - timedelta(minutes=rand.randint(1, 60 * 24 * 365))
+                    batch_msgs.append(
+                        Msg(
+                            org=org,
+                            channel=channel,
+                            contact_id=contact_id,
+                            contact_urn_id=urn_id,
+                            text=f"Synthetic message {m}",
+                            direction=INCOMING if incoming else OUTGOING,
+                            msg_type="I" if incoming else "F",
+                            status="H" if incoming else SENT,
+                            visibility=Msg.VISIBILITY_VISIBLE,
+                            created_on=created_on,
+                            modified_on=created_on,
+                            sent_on=None if incoming else created_on,
+                        )
+                    )
+                Msg.objects.bulk_create(batch_msgs)
+
+        results = flow.metadata["results"]
+
+        for batch in chunk_list(range(num_runs), GENERATE_BATCH_SIZE):
+            batch_runs = []
+            for r in batch:
+                contact_id, urn_id = rand.choice(contacts)
+                created_on = now - timedelta(minutes=rand.randint(1, 60 * 24 * 365))
+                run_results = {}
+                for result in results:
+                    value = rand.choice(("Red", "Green", "Blue", "Cyan"))
+                    run_results[result["key"]] = {
+                        "name": result["name"],
+                        "node_uuid": result["node_uuids"][0],
+                        "category": value,
+                        "value": value.lower(),
+                        "input": value.lower(),
+                        "created_on": created_on.isoformat(),
+                    }
+
+                batch_runs.append(
+                    FlowRun(
+                        org=org,
+                        flow=flow,
+                        contact_id=contact_id,
+                        status=FlowRun.STATUS_COMPLETED,
+                        responded=True,
+                        results=run_results,
+                        path=[],
+                        created_on=created_on,
+                        exited_on=created_on + timedelta(minutes=5),
+                        exit_type=FlowRun.EXIT_TYPE_COMPLETED,
+                        is_active=False,
+                    )
+                )
+            FlowRun.objects.bulk_create(batch_runs)
+
+        self.stdout.write(self.style.SUCCESS(f"Created org #{org.id}"))
+        return org
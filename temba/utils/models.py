@@ -1,3 +1,4 @@
+import itertools
 import time
 import types
 from collections import OrderedDict
@@ -75,6 +76,46 @@ def mapEStoDB(model, es_queryset, only_ids=False):
             return model.objects.none()
 
 
+def iter_keyset_batches(queryset, key_field, batch_size=1000):
+    """
+    Iterates over a queryset in batches ordered by (key_field, id), or just by id if key_field is the primary key. Each
+    batch is fetched by seeking past the last row of the previous batch rather than by offset or by materializing the
+    ids of all matching rows up front. The key field must not be nullable.
+
+    Querysets of values_list rows are also supported, with rows starting with the key field and then the primary key,
+    or being just the primary key if that's the key field.
+    """
+    meta = queryset.model._meta
+    by_pk = key_field in ("pk", meta.pk.name)
+    row_sql = f'("{meta.db_table}"."{meta.get_field(key_field).column}", "{meta.db_table}"."{meta.pk.column}")'
+
+    def get_keyset(row):
+        if isinstance(row, models.Model):
+            return [row.pk] if by_pk else [getattr(row, key_field), row.pk]
+        elif isinstance(row, tuple):
+            return list(row[:1] if by_pk else row[:2])
+        return [row]
+
+    queryset = queryset.order_by("pk") if by_pk else queryset.order_by(key_field, "pk")
+    last = None
+
+    while True:
+        batch_qs = queryset
+        if last and by_pk:
+            batch_qs = batch_qs.filter(pk__gt=last[0])
+        elif last:
+            batch_qs = batch_qs.extra(where=[f"{row_sql} > (%s, %s)"], params=last)
+
+        batch = list(batch_qs[:batch_size])
+        if batch:
+            yield batch
+
+        if len(batch) < batch_size:
+            break
+
+        last = get_keyset(batch[-1])
+
+
 class TranslatableField(HStoreField):
     """
     Model field which is a set of language code and translation pairs stored as HSTORE
@@ -232,6 +273,18 @@ class SquashableModel(models.Model):
 
     SQUASH_OVER = None
 
+    # the column which is summed when squashing
+    SQUASH_SUM = "count"
+
+    # other columns which are constant within each distinct set and are carried over to squashed rows
+    SQUASH_CARRY = ()
+
+    # the max number of distinct sets squashed by a single batch statement
+    SQUASH_BATCH_SIZE = 500
+
+    # if set, the max number of rows of a single set removed by a batch statement, with any others squashed later
+    SQUASH_SET_LIMIT = None
+
     id = models.BigAutoField(auto_created=True, primary_key=True, verbose_name="ID")
 
     is_squashed = models.BooleanField(default=False, help_text=_("Whether this row was created by squashing"))
@@ -241,21 +294,103 @@ class SquashableModel(models.Model):
         return cls.objects.filter(is_squashed=False)
 
     @classmethod
-    def squash(cls):
+    def squash(cls, max_sets=5000):
+        """
+        Squashes up to max_sets distinct sets of unsquashed rows, SQUASH_BATCH_SIZE sets per statement. Returns a dict of
+        the number of sets and rows squashed.
+        """
         start = time.time()
-        num_sets = 0
 
-        for distinct_set in cls.get_unsquashed().order_by(*cls.SQUASH_OVER).distinct(*cls.SQUASH_OVER)[:5000]:
+        num_sets, num_rows = cls._squash_batched(max_sets)
+
+        time_taken = time.time() - start
+
+        print("Squashed %d distinct sets (%d rows) of %s in %0.3fs" % (num_sets, num_rows, cls.__name__, time_taken))
+
+        return {"sets": num_sets, "rows": num_rows}
+
+    @classmethod
+    def _squash_batched(cls, max_sets):
+        num_sets, num_rows = 0, 0
+
+        while num_sets < max_sets:
+            batch_size = min(cls.SQUASH_BATCH_SIZE, max_sets - num_sets)
+
             with connection.cursor() as cursor:
-                sql, params = cls.get_squash_query(distinct_set)
+                cursor.execute(cls.get_batch_squash_query(), (batch_size,))
+                batch_sets, batch_rows = cursor.fetchone()
 
-                cursor.execute(sql, params)
+            num_sets += batch_sets
+            num_rows += batch_rows
 
-            num_sets += 1
+            # if we got fewer sets than we asked for, there's nothing left to squash
+            if batch_sets < batch_size:
+                break
 
-        time_taken = time.time() - start
+        return num_sets, num_rows
+
+    @classmethod
+    def get_batch_squash_query(cls):
+        """
+        Gets the SQL statement to squash a batch of distinct sets of unsquashed rows into a single row per set. It takes
+        the max number of sets as its only parameter and returns the number of sets and rows squashed.
+        """
+        table = cls._meta.db_table
+        nullable = [f.column for f in cls._meta.concrete_fields if f.null and f.column in cls.SQUASH_OVER]
+
+        # sets are matched to their rows with = so that the rows can be found by index, and sets where nullable columns
+        # are NULL are matched by separate branches of a union
+        branches = []
+        for nulls in itertools.product((False, True), repeat=len(nullable)):
+            null_cols = {c for c, is_null in zip(nullable, nulls) if is_null}
+            branches.append(
+                " AND ".join(
+                    f's."{c}" IS NULL AND t."{c}" IS NULL' if c in null_cols else f't."{c}" = s."{c}"'
+                    for c in cls.SQUASH_OVER
+                )
+            )
+
+        if cls.SQUASH_SET_LIMIT:
+            # the squashed row of a set is always removed first so that it's included in the new total
+            removed_ids = [
+                f"""SELECT r."id" FROM sets s CROSS JOIN LATERAL (
+                    SELECT t."id" FROM {table} t WHERE {b} ORDER BY t."is_squashed" DESC, t."id"
+                    LIMIT {cls.SQUASH_SET_LIMIT}
+                ) r"""
+                for b in branches
+            ]
+        else:
+            removed_ids = [f'SELECT t."id" FROM sets s INNER JOIN {table} t ON {b}' for b in branches]
+
+        over_cols = ", ".join(f'"{c}"' for c in cls.SQUASH_OVER)
+        carry_cols = "".join(f', "{c}"' for c in cls.SQUASH_CARRY)
+        carry_aggs = "".join(f', (array_agg("{c}"))[1]' for c in cls.SQUASH_CARRY)
+
+        return f"""
+        WITH sets AS (
+            SELECT DISTINCT {over_cols} FROM {table} WHERE NOT "is_squashed" LIMIT %s
+        ), removed AS (
+            DELETE FROM {table} WHERE "id" IN (
+                {" UNION ALL ".join(removed_ids)}
+            )
+            RETURNING {", ".join(f'"{c}"' for c in cls.SQUASH_OVER + cls.SQUASH_CARRY)}, "{cls.SQUASH_SUM}",
+                "is_squashed"
+        ), inserted AS (
+            INSERT INTO {table}({over_cols}{carry_cols}, "{cls.SQUASH_SUM}", "is_squashed")
+            SELECT {over_cols}{carry_aggs}, GREATEST(0, SUM("{cls.SQUASH_SUM}")), TRUE FROM removed
+            GROUP BY {over_cols}
+            RETURNING 1
+        ){cls.get_squash_side_effects()}
+        SELECT (SELECT COUNT(*) FROM inserted), (SELECT COUNT(*) FROM removed);
+        """
 
-        print("Squashed %d distinct sets of %s in %0.3fs" % (num_sets, cls.__name__, time_taken))
+    @classmethod
+    def get_squash_side_effects(cls):
+        """
+        Gets any extra CTEs to run in the same statement as each squash batch. These can read the removed rows, e.g. to
+        maintain rollups from the deltas of the unsquashed ones, and must start with a comma.
+        """
+        return ""
 
     class Meta:
         abstract = True
@@ -0,0 +1,45 @@
+import pyexcel
+
+# the leading bytes of spreadsheet files, used to identify uploads which don't have an extension
+XLS_SIGNATURE = b"\xd0\xcf\x11\xe0"
+XLSX_SIGNATURE = b"PK\x03\x04"
+
+
+def get_file_type(path):
+    """
+    Identifies a spreadsheet file as one of xls, xlsx or csv from its leading bytes
+    """
+    with open(path, "rb") as f:
+        signature = f.read(4)
+
+    if signature == XLS_SIGNATURE:
+        return "xls"
+    elif signature == XLSX_SIGNATURE:
+        return "xlsx"
+    return "csv"
+
+
+def iter_rows(path):
+    """
+    Lazily reads the rows of the first sheet of a CSV, XLS or XLSX file as tuples of cell values, so that only the
+    current row is held in memory. The format is determined by the extension of the file.
+    """
+    try:
+        for row in pyexcel.iget_array(file_name=path):
+            yield tuple(row)
+    finally:
+        pyexcel.free_resources()
+
+
+def read_header(path):
+    """
+    Reads only the first row of a CSV, XLS or XLSX file, skipping any comment rows
+    """
+    rows = iter_rows(path)
+    try:
+        for row in rows:
+            if not (row and isinstance(row[0], str) and len(row[0]) > 1 and row[0][0] == "#"):
+                return row
+        return ()
+    finally:
+        rows.close()
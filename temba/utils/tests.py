@@ -44,7 +44,7 @@ from . import (
     sizeof_fmt,
     str_to_bool,
 )
-from .cache import get_cacheable_attr, get_cacheable_result, incrby_existing
+from .cache import LRUCache, get_cacheable_attr, get_cacheable_result, incrby_existing
 from .celery import nonoverlapping_task
 from .currencies import currency_for_country
 from .dates import (
@@ -62,7 +62,8 @@ from .export import TableExporter
 from .gsm7 import calculate_num_segments, is_gsm7, replace_non_gsm7_accents
 from .http import http_headers
 from .locks import LockNotAcquiredException, NonBlockingLock
-from .models import JSONAsTextField, patch_queryset_count
+from .models import JSONAsTextField, iter_keyset_batches, patch_queryset_count
+from .sheets import get_file_type, iter_rows, read_header
 from .templatetags.temba import short_datetime
 from .text import clean_string, decode_base64, random_string, slugify_with, truncate
 from .timezones import TimeZoneFormField, timezone_to_country_code
@@ -678,6 +679,25 @@ class CacheTest(TembaTest):
         incrby_existing("xxx", -2, r)  # non-existent key
         self.assertIsNone(r.get("xxx"))
 
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("c"))
+
+        cache.set("c", 3)  # evicts b as a was used more recently
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.info(), {"size": 2, "max_size": 2, "hits": 3, "misses": 2})
+
+        cache.clear()
+
+        self.assertEqual(cache.info(), {"size": 0, "max_size": 2, "hits": 0, "misses": 0})
+
 
 class EmailTest(TembaTest):
     @override_settings(SEND_EMAILS=True)
@@ -961,6 +981,46 @@ class ModelsTest(TembaTest):
 
             self.assertEqual(qs.count(), 33)
 
+    def test_iter_keyset_batches(self):
+        contact = self.create_contact("Bob", twitter="bob")
+        flow = self.get_flow("color")
+
+        # create runs which share modified_on values so batches have to be split by id
+        now = timezone.now()
+        runs = []
+        for i in range(7):
+            run = FlowRun.objects.create(org=self.org, flow=flow, contact=contact)
+            FlowRun.objects.filter(id=run.id).update(modified_on=now - datetime.timedelta(days=i // 2))
+            run.refresh_from_db()
+            runs.append(run)
+
+        expected = sorted(runs, key=lambda r: (r.modified_on, r.id))
+
+        with self.assertNumQueries(3):
+            batches = list(iter_keyset_batches(FlowRun.objects.filter(flow=flow), "modified_on", batch_size=3))
+
+        self.assertEqual([3, 3, 1], [len(b) for b in batches])
+        self.assertEqual(expected, [r for b in batches for r in b])
+
+        # an exact multiple of the batch size needs one more query to find the end
+        with self.assertNumQueries(3):
+            runs_qs = FlowRun.objects.filter(flow=flow).exclude(id=runs[0].id)
+            batches = list(iter_keyset_batches(runs_qs, "modified_on", batch_size=3))
+
+        self.assertEqual([3, 3], [len(b) for b in batches])
+
+        self.assertEqual([], list(iter_keyset_batches(FlowRun.objects.none(), "modified_on")))
+
+        # or batches of values_list rows which start with the key field and then the id
+        runs_qs = FlowRun.objects.filter(flow=flow).values_list("modified_on", "id", "uuid")
+        batches = list(iter_keyset_batches(runs_qs, "modified_on", batch_size=3))
+        self.assertEqual([(r.modified_on, r.id, r.uuid) for r in expected], [r for b in batches for r in b])
+
+        # or just by id
+        runs_qs = FlowRun.objects.filter(flow=flow).values_list("id", flat=True)
+        batches = list(iter_keyset_batches(runs_qs, "id", batch_size=3))
+        self.assertEqual([[r.id for r in runs[:3]], [r.id for r in runs[3:6]], [runs[6].id]], batches)
+
 
 class ExportTest(TembaTest):
     def setUp(self):
@@ -1055,6 +1115,26 @@ class ExportTest(TembaTest):
         os.unlink(temp_file.name)
 
 
+class SheetsTest(TembaTest):
+    def test_get_file_type(self):
+        self.assertEqual("csv", get_file_type(f"{settings.MEDIA_ROOT}/test_imports/farmers.csv"))
+        self.assertEqual("xls", get_file_type(f"{settings.MEDIA_ROOT}/test_imports/sample_contacts.xls"))
+        self.assertEqual("xlsx", get_file_type(f"{settings.MEDIA_ROOT}/test_imports/sample_contacts.xlsx"))
+
+    def test_iter_rows(self):
+        path = f"{settings.MEDIA_ROOT}/test_imports/farmers.csv"
+
+        rows = iter_rows(path)
+        self.assertEqual(("URN:Tel", "name", "Field: planting_date"), next(rows))
+        self.assertEqual(2, len(list(rows)))
+
+        self.assertEqual(("URN:Tel", "name", "Field: planting_date"), read_header(path))
+
+        # xlsx files are streamed too
+        header = read_header(f"{settings.MEDIA_ROOT}/test_imports/sample_contacts.xlsx")
+        self.assertEqual(header, next(iter_rows(f"{settings.MEDIA_ROOT}/test_imports/sample_contacts.xlsx")))
+
+
 class CurrencyTest(TembaTest):
     def test_currencies(self):
 
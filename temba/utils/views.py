@@ -4,14 +4,14 @@ from math import ceil
 from django import forms
 from django.core.paginator import Paginator
 from django.db import transaction
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
 from temba.contacts.models import ContactGroupCount
-from temba.utils.es import ModelESSearch
+from temba.utils.es import ModelESSearch, decode_search_cursor, encode_search_cursor
 from temba.utils.models import ProxyQuerySet, mapEStoDB
 
 logger = logging.getLogger(__name__)
@@ -221,19 +221,69 @@ class ContactListPaginator(Paginator):
 
 
 class ContactListPaginationMixin(object):
+    """
+    Paginates ES searches by page number up to the ES search buffer size, and beyond that with a cursor param which
+    pages with search_after and so has the same cost at any depth
+    """
+
     paginator_class = ContactListPaginator
 
+    cursor_param = "after"
+
+    is_cursor_page = False
+    next_cursor = None
+
     def paginate_queryset(self, queryset, page_size):
+        if isinstance(queryset, ModelESSearch) and self.cursor_param in self.request.GET:
+            return self.paginate_search_after(queryset, page_size)
+
         paginator, page, new_queryset, is_paginated = super().paginate_queryset(queryset, page_size)
 
         if isinstance(queryset, ModelESSearch):
-            model_queryset = ProxyQuerySet([obj for obj in mapEStoDB(self.model, new_queryset)])
+            hits = list(new_queryset)
+
+            # if this is the last numbered page but there are more results, they can be browsed with a cursor
+            if hits and page.number == paginator.num_pages and paginator.count > page.end_index():
+                sort_values = getattr(hits[-1].meta, "sort", None)
+                if sort_values:
+                    self.next_cursor = encode_search_cursor(list(sort_values))
+
+            model_queryset = ProxyQuerySet([obj for obj in mapEStoDB(self.model, hits)])
             return paginator, page, model_queryset, is_paginated
 
         else:
             model_queryset = ProxyQuerySet([obj for obj in new_queryset])
             return paginator, page, model_queryset, is_paginated
 
+    def paginate_search_after(self, queryset, page_size):
+        cursor = self.request.GET[self.cursor_param]
+        try:
+            after = decode_search_cursor(cursor) if cursor else None
+        except ValueError:
+            raise Http404(_("Invalid cursor"))
+
+        response, next_after = queryset.search_after(after, page_size)
+
+        self.is_cursor_page = True
+        self.next_cursor = encode_search_cursor(next_after) if next_after else None
+
+        paginator = self.get_paginator(queryset, page_size)
+        model_queryset = ProxyQuerySet([obj for obj in mapEStoDB(self.model, response)])
+        return paginator, None, model_queryset, True
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+
+        # the current params without any page or cursor, for building cursor links
+        params = self.request.GET.copy()
+        for param in ("page", "pjax", self.cursor_param):
+            params.pop(param, None)
+
+        context["is_cursor_page"] = self.is_cursor_page
+        context["next_cursor"] = self.next_cursor
+        context["cursor_url_params"] = f"?{params.urlencode()}&" if params else "?"
+        return context
+
 
 class ExternalURLHandler(View):
     """